@@ -0,0 +1,164 @@
+"""
+Inference backends for entropy estimation: fp32, bf16 autocast and int8 dynamic quantization
+
+Run this script to compare the backends on a sample of texts: the throughput of each one, its NLL deviation
+from fp32, and the FACE scores of its spectra against the fp32 spectra.
+"""
+import argparse
+import functools
+import os
+import tempfile
+import time
+import numpy as np
+from lazy import no_grad
+# torch is imported where it is used, so that --help starts fast
+
+BACKENDS = ['fp32', 'bf16', 'int8']
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--input', '-i', type=str, required=True, help='input text file, one text per line')
+parser.add_argument('--model', type=str, default='gpt2', choices=['gpt2', 'gpt2-medium', 'gpt2-large', 'gpt2-xl'])
+parser.add_argument('--model_path', type=str, default='', help='load model locally if specified')
+parser.add_argument('--custom', action='store_true', help='load --model_path with CustomModel instead of GPT-2')
+parser.add_argument('--backends', type=str, nargs='+', default=BACKENDS, choices=BACKENDS)
+parser.add_argument('--n_texts', '-n', type=int, default=100, help='number of texts to compare on')
+parser.add_argument('--max_length', type=int, default=1024)
+parser.add_argument('--threads', type=int, default=0, help='torch threads, default: all cores')
+
+
+def conv1d_to_linear(model):
+    """
+    Replace the GPT-2 style Conv1D layers (y = x @ W + b) by the equivalent nn.Linear, in place,
+    so that they are picked up by dynamic quantization
+    """
+    import torch.nn as nn
+    from transformers.pytorch_utils import Conv1D
+    for name, module in model.named_children():
+        if isinstance(module, Conv1D):
+            linear = nn.Linear(module.weight.shape[0], module.weight.shape[1])
+            linear.weight.data = module.weight.data.t().contiguous()
+            linear.bias.data = module.bias.data
+            setattr(model, name, linear)
+        else:
+            conv1d_to_linear(module)
+    return model
+
+
+def autocast_bf16(module):
+    """
+    Run module.forward under bf16 autocast (on the device of its parameters), returning float32 logits
+    """
+    import torch
+    forward = module.forward
+
+    @functools.wraps(forward)
+    def wrapper(*args, **kwargs):
+        device_type = next(module.parameters()).device.type
+        with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
+            output = forward(*args, **kwargs)
+        if isinstance(output, torch.Tensor):
+            return output.float()
+        if getattr(output, 'logits', None) is not None:
+            output.logits = output.logits.float()
+        return output
+
+    module.forward = wrapper
+    return module
+
+
+def apply_backend(model, backend: str):
+    """
+    fp32: float32 weights; bf16: float32 weights, matmuls in bf16 autocast; int8: linear layers dynamically
+    quantized to int8 (CPU only). The model, its base model and its LM head are all covered, as CustomModel
+    calls the latter two directly.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown backend: {backend}. Please choose from {BACKENDS}.')
+    model = model.float()
+    if backend == 'bf16':
+        modules = [model, getattr(model, 'base_model', None), model.get_output_embeddings()]
+        for i, module in enumerate(modules):
+            if module is not None and all(module is not other for other in modules[:i]):
+                autocast_bf16(module)
+    elif backend == 'int8':
+        import torch
+        import torch.nn as nn
+        model = model.cpu()
+        conv1d_to_linear(model)
+        model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+@no_grad
+def text_nll(model, tokenizer, text: str, max_length: int = 1024):
+    import torch
+    input_ids = tokenizer(text, return_tensors='pt', truncation=True, max_length=max_length)['input_ids']
+    input_ids = input_ids.to(model.device)
+    logits = model(input_ids).logits[0, :-1].float()
+    nlls = torch.logsumexp(logits, dim=-1) - logits.gather(-1, input_ids[0, 1:, None]).squeeze(-1)
+    return nlls.cpu().numpy()
+
+
+def run_backend(args, backend: str, texts: list):
+    """
+    NLLs of texts with one backend, and the number of tokens per second
+    """
+    if args.custom:
+        from model import CustomModel
+        model = CustomModel(args.model_path, backend=backend)
+        nll_fn = lambda text: model.forward(text, max_len=args.max_length).numpy()
+    else:
+        from run_entropy import load_model
+        model, tokenizer = load_model(argparse.Namespace(model=args.model, model_path=args.model_path, backend=backend))
+        nll_fn = lambda text: text_nll(model, tokenizer, text, args.max_length)
+    nll_fn(texts[0]) # warm up
+    start = time.perf_counter()
+    nlls = [nll_fn(text) for text in texts]
+    elapsed = time.perf_counter() - start
+    return nlls, sum(len(x) for x in nlls) / max(elapsed, 1e-9)
+
+
+def spectra_scores(ref_nlls: list, nlls: list, tmpdir: str):
+    """
+    Mean FACE scores of the spectra of nlls against those of ref_nlls
+    """
+    from face import getScores
+    from ragged import spectrum_dtypes, write_ragged
+    from run_fft import FFTProcessor
+    processor = FFTProcessor(method='fft', preprocess='none', value='norm', require_sid=False)
+    paths = []
+    for name, data in [('ref', ref_nlls), ('test', nlls)]:
+        freqs, powers, _ = processor.compute([x.astype(np.float64) for x in data])
+        path = os.path.join(tmpdir, f'{name}.rag')
+        write_ragged(path, {'freq': freqs, 'power': powers}, dtype=spectrum_dtypes('float64'))
+        paths.append(path)
+    scores = getScores(*paths)
+    return {name: float(np.nanmean(values)) for name, values in scores.items()}
+
+
+def main(args):
+    if args.threads > 0:
+        import torch
+        torch.set_num_threads(args.threads)
+    with open(args.input, 'r') as f:
+        texts = [line.strip() for line in f if line.strip() != ''][:args.n_texts]
+    backends = ['fp32'] + [b for b in args.backends if b != 'fp32']
+    results = {backend: run_backend(args, backend, texts) for backend in backends}
+    ref_nlls, ref_speed = results['fp32']
+    # sequences with fewer than 2 NLLs have no spectrum
+    keep = [i for i, x in enumerate(ref_nlls) if len(x) >= 2]
+    ref_flat = np.concatenate(ref_nlls)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for backend in backends:
+            nlls, speed = results[backend]
+            diff = np.concatenate(nlls) - ref_flat
+            scores = spectra_scores([ref_nlls[i] for i in keep], [nlls[i] for i in keep], tmpdir)
+            print(f'{backend}: {speed:.1f} tokens/s ({speed / ref_speed:.2f}x fp32), '
+                  f'NLL deviation mean {np.mean(np.abs(diff)):.4f} max {np.max(np.abs(diff)):.4f} '
+                  f'bias {np.mean(diff):+.4f}, spectra vs fp32: '
+                  + ', '.join(f'{name} {value:.4f}' for name, value in scores.items()))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,214 @@
+"""
+Bootstrap confidence intervals and permutation tests for FACE scores
+
+All resamples are drawn at once as NumPy arrays from a seedable Generator. Small inputs are resampled exactly,
+in blocks of indices; large ones (n * n_resamples > exact_limit) are binned into n_bins bins of equal width,
+and a resample is drawn as the bin counts only (multinomial for the bootstrap, multivariate hypergeometric for
+a permutation, binomial for a sign flip), weighted by the exact mean of each bin. The cost is then
+n_resamples * n_bins instead of n_resamples * n, and the error on a resampled mean is below the bin width.
+
+Compare two face.py outputs (e.g. two models scored against the same human texts):
+    python bootstrap.py --scores model_a.csv model_b.csv --n_resamples 10000
+Compare human and model texts: the scores of each human spectrum with its model spectrum against those of the
+same human spectrum with the next human spectrum of the file (the human-vs-human baseline):
+    python bootstrap.py --human human.fft.txt --model model.fft.txt --paired
+"""
+import argparse
+import numpy as np
+import pandas as pd
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--scores', type=str, nargs='+', default=None,
+                    help='one or two per-pair score CSVs (face.py --output); with two, their means are compared')
+parser.add_argument('--human', type=str, default='', help='human spectra, to compare with --model instead of --scores')
+parser.add_argument('--model', type=str, default='',
+                    help='model spectra: human-vs-model scores are compared with human-vs-human ones')
+parser.add_argument('--grid_size', type=int, default=1000, help='number of points of the common frequency grid')
+parser.add_argument('--metrics', type=str, nargs='+', default=None, help='metrics to use, default: all columns')
+parser.add_argument('--n_resamples', type=int, default=10000)
+parser.add_argument('--confidence', type=float, default=0.95)
+parser.add_argument('--paired', action='store_true',
+                    help='the two score tables are paired line by line (with --human, by human text): \
+                        sign-flip test of the differences')
+parser.add_argument('--n_bins', type=int, default=2048, help='number of bins used for large inputs')
+parser.add_argument('--exact_limit', type=int, default=10 ** 8,
+                    help='resample exactly if n * n_resamples is at most this')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--output', '-o', type=str, default='', help='CSV output, printed if not specified')
+
+
+def finite(values):
+    values = np.asarray(values, dtype=np.float64)
+    return values[np.isfinite(values)]
+
+
+def bin_values(values: np.ndarray, n_bins: int):
+    """
+    (counts, sums) of values in n_bins bins of equal width over their range
+    """
+    low, high = values.min(), values.max()
+    if high == low:
+        bins = np.zeros(len(values), dtype=np.int64)
+    else:
+        bins = np.minimum(((values - low) / (high - low) * n_bins).astype(np.int64), n_bins - 1)
+    counts = np.bincount(bins, minlength=n_bins)
+    sums = np.bincount(bins, weights=values, minlength=n_bins)
+    keep = counts > 0
+    return counts[keep], sums[keep]
+
+
+def _blocks(n: int, n_resamples: int, block_elements: int = 1 << 24):
+    """
+    (start, end) ranges of resamples, each a block of at most block_elements draws of n values
+    """
+    step = max(1, block_elements // max(n, 1))
+    for start in range(0, n_resamples, step):
+        yield start, min(start + step, n_resamples)
+
+
+def bootstrap_means(values, n_resamples: int = 10000, rng=None, n_bins: int = 2048, exact_limit: int = 10 ** 8):
+    """
+    Means of n_resamples bootstrap resamples of values
+    """
+    rng = np.random.default_rng(rng)
+    values = finite(values)
+    n = len(values)
+    if n == 0:
+        return np.full(n_resamples, np.nan)
+    if n * n_resamples <= exact_limit:
+        means = np.empty(n_resamples)
+        for start, end in _blocks(n, n_resamples):
+            means[start:end] = values[rng.integers(0, n, size=(end - start, n))].mean(axis=1)
+        return means
+    counts, sums = bin_values(values, n_bins)
+    draws = rng.multinomial(n, counts / n, size=n_resamples)
+    return draws @ (sums / counts) / n
+
+
+def bootstrap_ci(values, n_resamples: int = 10000, confidence: float = 0.95, rng=None, **kwargs):
+    """
+    (mean, low, high): the mean of values and its percentile bootstrap confidence interval
+    """
+    values = finite(values)
+    if len(values) == 0:
+        return np.nan, np.nan, np.nan
+    means = bootstrap_means(values, n_resamples, rng, **kwargs)
+    alpha = (1 - confidence) / 2
+    low, high = np.percentile(means, [100 * alpha, 100 * (1 - alpha)])
+    return float(values.mean()), float(low), float(high)
+
+
+def permutation_test(values1, values2, n_resamples: int = 10000, rng=None, n_bins: int = 2048,
+                     exact_limit: int = 10 ** 8):
+    """
+    (difference of means, two-sided p-value) of values1 - values2, under random relabelling of the pooled values
+    """
+    rng = np.random.default_rng(rng)
+    values1, values2 = finite(values1), finite(values2)
+    n1, n2 = len(values1), len(values2)
+    if n1 == 0 or n2 == 0:
+        return np.nan, np.nan
+    pooled = np.concatenate([values1, values2])
+    total = pooled.sum()
+    observed = values1.mean() - values2.mean()
+    if len(pooled) * n_resamples <= exact_limit:
+        sums1 = np.empty(n_resamples)
+        for start, end in _blocks(len(pooled), n_resamples):
+            # the first n1 of a random permutation of the pooled values
+            picked = np.argpartition(rng.random((end - start, len(pooled))), n1 - 1, axis=1)[:, :n1]
+            sums1[start:end] = pooled[picked].sum(axis=1)
+    else:
+        counts, sums = bin_values(pooled, n_bins)
+        draws = rng.multivariate_hypergeometric(counts, n1, size=n_resamples, method='marginals')
+        sums1 = draws @ (sums / counts)
+    diffs = sums1 / n1 - (total - sums1) / n2
+    # the observed labelling counts as one of the permutations
+    extreme = np.sum(np.abs(diffs) >= abs(observed) - 1e-12 * max(1.0, abs(observed)))
+    return float(observed), float((extreme + 1) / (n_resamples + 1))
+
+
+def sign_flip_test(values1, values2, n_resamples: int = 10000, rng=None, n_bins: int = 2048,
+                   exact_limit: int = 10 ** 8):
+    """
+    (mean difference, two-sided p-value) of paired values1 - values2, under random sign flips of the differences
+    """
+    rng = np.random.default_rng(rng)
+    diffs = finite(np.asarray(values1, dtype=np.float64) - np.asarray(values2, dtype=np.float64))
+    n = len(diffs)
+    if n == 0:
+        return np.nan, np.nan
+    observed = diffs.mean()
+    if n * n_resamples <= exact_limit:
+        means = np.empty(n_resamples)
+        for start, end in _blocks(n, n_resamples):
+            signs = rng.integers(0, 2, size=(end - start, n), dtype=np.int8) * 2 - 1
+            means[start:end] = signs @ diffs / n
+    else:
+        # a bin of c differences with c_plus positive signs contributes (2 * c_plus - c) * its mean |difference|
+        counts, sums = bin_values(np.abs(diffs), n_bins)
+        positive = rng.binomial(counts, 0.5, size=(n_resamples, len(counts)))
+        means = (2 * positive - counts) @ (sums / counts) / n
+    extreme = np.sum(np.abs(means) >= abs(observed) - 1e-12 * max(1.0, abs(observed)))
+    return float(observed), float((extreme + 1) / (n_resamples + 1))
+
+
+def summarize(df: pd.DataFrame, df2: pd.DataFrame = None, n_resamples: int = 10000, confidence: float = 0.95,
+              paired: bool = False, seed: int = 0, **kwargs):
+    """
+    One row per metric: mean and bootstrap CI of each score table, and with df2 the difference of means
+    and its permutation (or sign-flip, if paired) p-value
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for metric in df.columns:
+        row = {'metric': metric}
+        row['mean'], row['low'], row['high'] = bootstrap_ci(df[metric], n_resamples, confidence, rng, **kwargs)
+        if df2 is not None:
+            row['mean2'], row['low2'], row['high2'] = bootstrap_ci(df2[metric], n_resamples, confidence, rng,
+                                                                   **kwargs)
+            test = sign_flip_test if paired else permutation_test
+            row['diff'], row['p_value'] = test(df[metric], df2[metric], n_resamples, rng, **kwargs)
+        rows.append(row)
+    return pd.DataFrame(rows).set_index('metric')
+
+
+def human_model_scores(human, model, metrics=('SO', 'CORR', 'SAM', 'SPEAR'), grid_size: int = 1000):
+    """
+    Per-pair scores of human spectrum i with model spectrum i, and of human spectrum i with human spectrum i + 1
+    (the last with the first) as the human-vs-human baseline
+    """
+    from face import alignPoints, computeScores
+    xlist, y1matrix, y2matrix = alignPoints(human, model, grid_size)
+    if len(y1matrix) < 2:
+        raise ValueError('At least 2 human spectra are required for the human-vs-human baseline.')
+    model_scores = pd.DataFrame(computeScores(xlist, y1matrix, y2matrix, metrics))
+    human_scores = pd.DataFrame(computeScores(xlist, y1matrix, np.roll(y1matrix, -1, axis=0), metrics))
+    return model_scores, human_scores
+
+
+def main(args):
+    if (args.scores is None) == (len(args.human) == 0 or len(args.model) == 0):
+        raise ValueError('Please provide either --scores, or --human and --model.')
+    if args.scores is None:
+        metrics = args.metrics if args.metrics is not None else ['SO', 'CORR', 'SAM', 'SPEAR']
+        tables = list(human_model_scores(args.human, args.model, metrics, args.grid_size))
+    elif len(args.scores) > 2:
+        raise ValueError('Please provide one or two score files.')
+    else:
+        tables = [pd.read_csv(path) for path in args.scores]
+    metrics = args.metrics if args.metrics is not None else list(tables[0].columns)
+    tables = [df[metrics] for df in tables]
+    if args.paired and (len(tables) < 2 or len(tables[0]) != len(tables[1])):
+        raise ValueError('--paired requires two score files with the same number of rows.')
+    result = summarize(tables[0], tables[1] if len(tables) > 1 else None, n_resamples=args.n_resamples,
+                       confidence=args.confidence, paired=args.paired, seed=args.seed,
+                       n_bins=args.n_bins, exact_limit=args.exact_limit)
+    if len(args.output) > 0:
+        result.to_csv(args.output)
+    else:
+        print(result.to_string())
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
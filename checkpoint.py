@@ -0,0 +1,125 @@
+"""
+Crash-safe, resumable writing of NLL sequences
+
+Finished lines are appended to <output>.journal as 'index<TAB>values' records, in any order. Every
+`every` lines the journal is fsync'ed and its size is recorded in the <output>.ckpt sidecar (written
+atomically), so after a crash the journal is cut back to the last checkpoint and only the lines after it
+are recomputed. Once every expected line is in the journal, the output is assembled in line order
+(through a temporary file and an atomic rename) and the journal and checkpoint are removed.
+
+A finished output is recognized on a rerun (no journal or checkpoint, newer than the input, one sequence
+per expected line and, for .rag, the same metadata) and nothing is recomputed; remove it to start over.
+"""
+import json
+import os
+import numpy as np
+from ragged import RAGGED_SUFFIX, is_ragged, open_nll_writer, read_ragged
+
+
+def output_complete(output: str, n_lines: int, input_file: str = '', meta: dict = None):
+    """
+    Check if output was finished by an earlier run: no journal or checkpoint, newer than the input, n_lines
+    sequences and, for .rag, the same metadata
+    """
+    if not os.path.exists(output) or os.path.exists(output + '.ckpt') or os.path.exists(output + '.journal'):
+        return False
+    if input_file and os.path.getmtime(output) < os.path.getmtime(input_file):
+        return False
+    if is_ragged(output):
+        rag = read_ragged(output)
+        return len(rag) == n_lines and all(rag.meta.get(k) == v for k, v in (meta or {}).items())
+    with open(output, 'rb') as f:
+        return sum(1 for _ in f) == n_lines
+
+
+class CheckpointedNLLWriter(object):
+    def __init__(self, output: str, indices, input_file: str = '', every: int = 100,
+                 dtype='float32', meta: dict = None):
+        self.output = output
+        self.indices = list(indices)
+        self.input_file = input_file
+        self.every = every
+        self.dtype = dtype
+        self.meta = meta
+        self.journal_path = output + '.journal'
+        self.ckpt_path = output + '.ckpt'
+        # keep full float32 precision in the journal when the final output is binary
+        self.value_format = '{:.9g}' if output.endswith(RAGGED_SUFFIX) else '{:.4f}'
+        self.done = set()
+        self._pending = 0
+        self.complete = output_complete(output, len(self.indices), input_file, meta)
+        if self.complete:
+            self.done.update(self.indices)
+            print(f'{output} is complete ({len(self.indices)} lines), skipping')
+            return
+        self._resume()
+        self._journal = open(self.journal_path, 'ab')
+
+    def _resume(self):
+        if not os.path.exists(self.ckpt_path) or not os.path.exists(self.journal_path):
+            # no checkpoint, anything in a journal is not trusted
+            open(self.journal_path, 'wb').close()
+            return
+        with open(self.ckpt_path, 'r') as f:
+            ckpt = json.load(f)
+        if ckpt['input'] != self.input_file or ckpt['n_lines'] != len(self.indices):
+            raise ValueError(f'Checkpoint {self.ckpt_path} was written for {ckpt["n_lines"]} lines of '
+                             f'{ckpt["input"]}, remove it (and {self.journal_path}) to start over')
+        # drop records written after the last checkpoint, they may be torn
+        with open(self.journal_path, 'ab') as f:
+            f.truncate(ckpt['journal_bytes'])
+        for index, _ in self._records():
+            self.done.add(index)
+        print(f'Resuming from {self.ckpt_path}: {len(self.done)}/{len(self.indices)} lines done')
+
+    def _records(self):
+        """
+        Yield (index, byte position) of every record in the journal
+        """
+        pos = 0
+        with open(self.journal_path, 'rb') as f:
+            for line in f:
+                yield int(line[:line.index(b'\t')]), pos
+                pos += len(line)
+
+    def write(self, index: int, nlls):
+        values = ' '.join(self.value_format.format(num) for num in nlls)
+        self._journal.write(f'{index}\t{values}\n'.encode('utf-8'))
+        self.done.add(index)
+        self._pending += 1
+        if self._pending >= self.every:
+            self.commit()
+
+    def commit(self):
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        ckpt = {'input': self.input_file, 'n_lines': len(self.indices), 'journal_bytes': self._journal.tell()}
+        tmp_path = self.ckpt_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(ckpt, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.ckpt_path)
+        self._pending = 0
+
+    def finalize(self):
+        """
+        Assemble the output in line order, once every line is done
+        """
+        if self.complete:
+            return
+        self.commit()
+        self._journal.close()
+        missing = [i for i in self.indices if i not in self.done]
+        if len(missing) > 0:
+            raise RuntimeError(f'{len(missing)} lines are missing from {self.journal_path}, e.g. line {missing[0]}')
+        positions = dict(self._records()) # the last record of an index wins
+        tmp_path = os.path.join(os.path.dirname(self.output), '.tmp.' + os.path.basename(self.output))
+        with open(self.journal_path, 'rb') as fj, open_nll_writer(tmp_path, dtype=self.dtype, meta=self.meta) as fw:
+            for index in self.indices:
+                fj.seek(positions[index])
+                values = fj.readline().rstrip(b'\n').split(b'\t', 1)[1]
+                fw.write(np.asarray(values.split(), dtype=np.float64))
+        os.replace(tmp_path, self.output)
+        os.remove(self.ckpt_path)
+        os.remove(self.journal_path)
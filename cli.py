@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""
+One entry point for all the FACE steps: python cli.py <command> [options], e.g.
+    python cli.py entropy -i data/demo_human.txt -o data/demo_human.nll.rag
+    python cli.py fft -i data/demo_human.nll.rag -o data/demo_human.fft.rag
+    python cli.py score --human data/demo_human.fft.rag --model data/demo_model.fft.rag
+Each command takes the options of its script (python cli.py <command> --help). Only the module of the chosen
+command is imported, and the scripts import torch, transformers, scipy and pandas where they are used, so
+--help and the steps that do not need them start without loading them.
+"""
+import importlib
+import sys
+
+# command: (module, description)
+COMMANDS = {
+    'entropy': ('run_entropy', 'NLLs of texts, one line at a time (sliding windows, worker processes)'),
+    'entropy-batch': ('run_entropy_batch', 'NLLs of texts, in padded batches'),
+    'fft': ('run_fft', 'spectra of NLL sequences'),
+    'score': ('face', 'FACE scores between human and model spectra'),
+    'pipeline': ('pipeline', 'texts to scores in one process, without intermediate files'),
+    'leaderboard': ('leaderboard', 'score many models against one human reference'),
+    'bootstrap': ('bootstrap', 'confidence intervals and significance tests of saved scores'),
+    'serve': ('server', 'scoring server that keeps the model loaded'),
+    'backends': ('backends', 'compare the fp32, bf16 and int8 inference backends'),
+    'convert': ('ragged', 'convert between .rag and text/CSV files'),
+}
+
+
+def usage():
+    lines = ['usage: face <command> [options]', '', 'commands:']
+    lines += [f'  {name:<14} {description}' for name, (_, description) in COMMANDS.items()]
+    lines += ['', 'Run face <command> --help for the options of a command.']
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if len(argv) == 0 or argv[0] in ('-h', '--help'):
+        print(usage())
+        return 0 if len(argv) > 0 else 2
+    command, argv = argv[0], argv[1:]
+    if command not in COMMANDS:
+        print(f'face: unknown command {command}\n\n{usage()}', file=sys.stderr)
+        return 2
+    # the scripts parse sys.argv, and name themselves after sys.argv[0] in their usage
+    sys.argv = [f'face {command}'] + argv
+    module = importlib.import_module(COMMANDS[command][0])
+    if not hasattr(module, 'parser'):
+        # run_entropy*.py build their parser in main(), to merge in --config files
+        module.main()
+        return 0
+    args = module.parser.parse_args()
+    if getattr(args, 'demo', False):
+        module.demo()
+    else:
+        module.main(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,13 +2,18 @@ import argparse
 import json
 
 
-def load_config(args): 
+def load_config(args, parser=None, argv=()):
+    """
+    Merge the "args" list of the configuration file into args.
+    parser should know every argument of the config file; arguments in argv (e.g. the command line) take precedence.
+    """
     args_dict = vars(args)
-    parser = get_args_parser()
+    if parser is None:
+        parser = get_args_parser()
     with open(args.config, "r") as f:
         raw_args = json.loads(f.read()).get("args")
         raw_args = [str(arg) for arg in raw_args]
-        args_new = parser.parse_args(raw_args)
+        args_new = parser.parse_args(raw_args + list(argv))
     args_dict.update(vars(args_new))
     args = argparse.Namespace(**args_dict)
     return args
@@ -0,0 +1,123 @@
+"""
+Pipelined executor: prepare (e.g. tokenize) -> infer -> write
+
+A producer thread prepares upcoming items into a bounded queue, the calling thread runs inference, and a
+writer thread consumes finished items, so that inference does not wait on tokenization or I/O. The time each
+stage is busy is recorded to show which one is the bottleneck.
+"""
+import queue
+import threading
+import time
+from tqdm import tqdm
+
+_DONE = object()
+
+
+class PipelinedExecutor(object):
+    """
+    prepare(item) -> prepared, infer(item, prepared) -> result, write(item, result); items are processed in order
+    """
+    def __init__(self, prepare, infer, write, depth: int = 4, progress=True):
+        self.prepare = prepare
+        self.infer = infer
+        self.write = write
+        self.depth = depth
+        self.progress = progress
+        self.stats = {}
+
+    @staticmethod
+    def _put(q, obj, stop):
+        """
+        Blocking put that gives up once stop is set, returns whether obj was queued
+        """
+        while True:
+            try:
+                q.put(obj, timeout=0.1)
+                return True
+            except queue.Full:
+                if stop.is_set():
+                    return False
+
+    def run(self, items: list):
+        prepared_q = queue.Queue(maxsize=self.depth)
+        result_q = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        errors = []
+        busy = {'prepare': 0.0, 'infer': 0.0, 'write': 0.0}
+        waits = {'input': 0.0, 'output': 0.0}
+        bar = tqdm(total=len(items), disable=not self.progress)
+
+        def producer():
+            try:
+                for item in items:
+                    if stop.is_set():
+                        break
+                    start = time.perf_counter()
+                    prepared = self.prepare(item)
+                    busy['prepare'] += time.perf_counter() - start
+                    if not self._put(prepared_q, (item, prepared), stop):
+                        break
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                self._put(prepared_q, _DONE, stop)
+
+        def writer():
+            try:
+                while True:
+                    obj = result_q.get()
+                    if obj is _DONE:
+                        break
+                    start = time.perf_counter()
+                    self.write(*obj)
+                    busy['write'] += time.perf_counter() - start
+                    bar.update(1)
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+
+        threads = [threading.Thread(target=producer, daemon=True), threading.Thread(target=writer, daemon=True)]
+        for thread in threads:
+            thread.start()
+        wall = time.perf_counter()
+        try:
+            while not stop.is_set():
+                start = time.perf_counter()
+                obj = prepared_q.get()
+                waits['input'] += time.perf_counter() - start
+                if obj is _DONE:
+                    break
+                item, prepared = obj
+                start = time.perf_counter()
+                result = self.infer(item, prepared)
+                busy['infer'] += time.perf_counter() - start
+                start = time.perf_counter()
+                self._put(result_q, (item, result), stop)
+                waits['output'] += time.perf_counter() - start
+        except BaseException:
+            stop.set()
+            raise
+        finally:
+            # let the writer finish the results already computed (they are checkpointed)
+            while threads[1].is_alive():
+                try:
+                    result_q.put(_DONE, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            for thread in threads:
+                thread.join()
+            bar.close()
+        if len(errors) > 0:
+            raise errors[0]
+        wall = time.perf_counter() - wall
+        self.stats = {'wall': wall, **{stage: t / max(wall, 1e-9) for stage, t in busy.items()},
+                      'wait_input': waits['input'], 'wait_output': waits['output']}
+        return self.stats
+
+    def report(self):
+        s = self.stats
+        return (f'stage utilization over {s["wall"]:.1f}s: prepare {s["prepare"]:.1%}, infer {s["infer"]:.1%}, '
+                f'write {s["write"]:.1%} (infer waited {s["wait_input"]:.1f}s for input, '
+                f'{s["wait_output"]:.1f}s for the writer)')
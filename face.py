@@ -1,187 +1,410 @@
 import numpy as np
-import pandas as pd
-from pandas import DataFrame
-from scipy import interpolate
-from scipy.stats import pearsonr
-from scipy.stats import spearmanr
 import argparse
+from ragged import is_ragged, read_ragged
+# pandas is imported where CSV files are read or written, so that .rag inputs and --help do not load it
 
 parser = argparse.ArgumentParser()
-parser.add_argument('--human', type=str, required=True)
-parser.add_argument('--model', type=str, required=True)
+parser.add_argument('--human', type=str, nargs='+', required=True, help='spectrum file(s), concatenated in order')
+parser.add_argument('--model', type=str, nargs='+', required=True, help='spectrum file(s), concatenated in order')
 parser.add_argument('--output', type=str, default='', help='output to stdout if not specified')
+parser.add_argument('--metrics', type=str, nargs='+', default=['SO', 'CORR', 'SAM', 'SPEAR'],
+                    choices=['SO', 'CORR', 'SAM', 'SPEAR'], help='metrics to compute')
+parser.add_argument('--grid_size', type=int, default=1000, help='number of points of the common frequency grid')
+parser.add_argument('--grid_range', type=float, nargs=2, default=[0, 0.5], help='range of the common frequency grid')
+parser.add_argument('--pairing', type=str, default='index', choices=['index', 'exact', 'ivf'],
+                    help='pair spectra by line index, or each model spectrum with its nearest human spectra \
+                        under SAM/cosine distance, by exact (blocked) or approximate (IVF) search')
+parser.add_argument('--neighbors', type=int, default=1, help='number of nearest human spectra per model spectrum')
+parser.add_argument('--n_lists', type=int, default=0, help='number of IVF lists, default: sqrt(number of human spectra)')
+parser.add_argument('--n_probe', type=int, default=8, help='number of IVF lists searched per model spectrum')
+parser.add_argument('--chunk_size', type=int, default=0,
+                    help='if positive (e.g. 2000), stream both files and score this many pairs at a time, so that \
+                        memory does not grow with the number of pairs (with --pairing index)')
+parser.add_argument('--n_resamples', type=int, default=0,
+                    help='if positive, also print the bootstrap confidence interval of each mean score')
+parser.add_argument('--confidence', type=float, default=0.95, help='level of the bootstrap confidence intervals')
+parser.add_argument('--seed', type=int, default=0, help='seed of the bootstrap resampling')
 parser.add_argument('--demo', action='store_true', help='run demo')
 
 
-# Get the basises for interpolation
-def getInterval(freq_power_path: str):
+# Get the flat spectra, and the offsets where each sequence starts (a new sequence starts where freq decreases)
+def getSpectra(freq_power_path: str):
+    if is_ragged(freq_power_path):
+        # memory-mapped, the offsets are stored in the file
+        spectrum = read_ragged(freq_power_path)
+        return spectrum.field('freq'), spectrum.field('power'), np.asarray(spectrum.offsets, dtype=np.int64)
+    import pandas as pd
     spectrum = pd.read_csv(freq_power_path)
-    spectrum['group'] = (spectrum['freq'].shift(1) > spectrum['freq']).cumsum()
-    grouped_spectrum = spectrum.groupby('group')
-    freq_list = []
-    power_list = []
+    freq = spectrum['freq'].to_numpy(dtype=np.float64)
+    power = spectrum['power'].to_numpy(dtype=np.float64)
+    starts = np.flatnonzero(freq[1:] < freq[:-1]) + 1
+    offsets = np.concatenate([[0], starts, [len(freq)]]) if len(freq) > 0 else np.zeros(1, dtype=np.int64)
+    return freq, power, offsets.astype(np.int64)
+
+
+# Concatenate (freq, power, offsets) tuples, in order, as one tuple
+def joinSpectra(parts):
+    starts = np.cumsum([0] + [part[2][-1] for part in parts[:-1]])
+    offsets = np.concatenate([[0]] + [part[2][1:] + start for part, start in zip(parts, starts)])
+    return (np.concatenate([part[0][:part[2][-1]] for part in parts]),
+            np.concatenate([part[1][:part[2][-1]] for part in parts]), offsets.astype(np.int64))
+
+
+# Concatenate the spectra of several files, in order, as one (freq, power, offsets) tuple
+def concatSpectra(paths):
+    if isinstance(paths, str):
+        return getSpectra(paths)
+    return joinSpectra([getSpectra(path) for path in paths])
+
 
-    for _, group in grouped_spectrum:
-        freq_list.append(group['freq'].tolist())
-        power_list.append(group['power'].tolist())
+# Sequences start:end of a (freq, power, offsets) tuple, with offsets from 0
+def sliceSpectra(spectra, start: int, end: int):
+    freq, power, offsets = spectra
+    lo, hi = offsets[start], offsets[end]
+    return freq[lo:hi], power[lo:hi], offsets[start:end + 1] - lo
 
+
+# Read a spectrum file as (freq, power, offsets) tuples of whole sequences, without loading all of it:
+# .rag files are sliced from the memory map chunk_size sequences at a time, CSV files are read chunk_size rows at a time
+def readSpectrumParts(freq_power_path: str, chunk_size: int = 1 << 20):
+    if is_ragged(freq_power_path):
+        spectrum = read_ragged(freq_power_path)
+        freq, power, offsets = spectrum.field('freq'), spectrum.field('power'), spectrum.offsets
+        for start in range(0, len(spectrum), chunk_size):
+            end = min(start + chunk_size, len(spectrum))
+            yield sliceSpectra((freq, power, np.asarray(offsets[start:end + 1], dtype=np.int64)), 0, end - start)
+        return
+    import pandas as pd
+    # the last sequence of a chunk may continue in the next one, so it is carried over
+    carry_freq, carry_power = np.empty(0), np.empty(0)
+    for chunk in pd.read_csv(freq_power_path, usecols=['freq', 'power'], chunksize=chunk_size):
+        freq = np.concatenate([carry_freq, chunk['freq'].to_numpy(dtype=np.float64)])
+        power = np.concatenate([carry_power, chunk['power'].to_numpy(dtype=np.float64)])
+        starts = np.flatnonzero(freq[1:] < freq[:-1]) + 1
+        if len(starts) > 0:
+            yield freq[:starts[-1]], power[:starts[-1]], np.concatenate([[0], starts]).astype(np.int64)
+            freq, power = freq[starts[-1]:], power[starts[-1]:]
+        carry_freq, carry_power = freq, power
+    if len(carry_freq) > 0:
+        yield carry_freq, carry_power, np.array([0, len(carry_freq)], dtype=np.int64)
+
+
+# Iterate over the spectra of one or several files (concatenated in order) in blocks of block_size sequences,
+# the last block may be shorter
+def iterSpectra(paths, block_size: int):
+    paths = [paths] if isinstance(paths, str) else paths
+    pending, n_pending = [], 0
+    for path in paths:
+        for part in readSpectrumParts(path, chunk_size=block_size if is_ragged(path) else max(block_size, 1 << 16)):
+            pending.append(part)
+            n_pending += len(part[2]) - 1
+            if n_pending < block_size:
+                continue
+            merged, start = joinSpectra(pending), 0
+            while n_pending - start >= block_size:
+                yield sliceSpectra(merged, start, start + block_size)
+                start += block_size
+            pending, n_pending = [sliceSpectra(merged, start, n_pending)], n_pending - start
+    if n_pending > 0:
+        yield joinSpectra(pending)
+
+
+# Get the basises for interpolation
+def getInterval(freq_power_path: str):
+    freq, power, offsets = getSpectra(freq_power_path)
+    freq_list = [freq[start:end].tolist() for start, end in zip(offsets[:-1], offsets[1:])]
+    power_list = [power[start:end].tolist() for start, end in zip(offsets[:-1], offsets[1:])]
     return freq_list, power_list
 
-# Interpolate
-def getF(freq_list: list, power_list: list):
-    f = interpolate.interp1d(freq_list, power_list, fill_value="extrapolate")
-    return f
-
-# Interpolate all pairs of sequences between two files
-def alignPoints(filepath1: str, filepath2: str):
-    freq_list_list_1, power_list_list_1 = getInterval(filepath1)
-    freq_list_list_2, power_list_list_2 = getInterval(filepath2)
-    y1listlist, y2listlist = [], []
-    short_length = len(freq_list_list_1) if len(freq_list_list_1) < len(
-        freq_list_list_2) else len(freq_list_list_2)
-
-    for i in range(short_length):
-        freq_list1 = freq_list_list_1[i]
-        power_list1 = power_list_list_1[i]
-        freq_list2 = freq_list_list_2[i]
-        power_list2 = power_list_list_2[i]
-
-        func1 = getF(freq_list1, power_list1)
-        func2 = getF(freq_list2, power_list2)
-        # interpolate
-        x = np.linspace(0, 0.5, 1000)
-        y1 = func1(x)
-        y2 = func2(x)
-        try:
-            assert len(x) == len(y1) == len(y2)
-        except AssertionError:
-            print(f'Error in sample {i}: x of shape {x.shape}, y1 of shape {y1.shape}, y2 of shape {y2.shape}')
-            raise
-        y1listlist.append(y1)
-        y2listlist.append(y2)
 
-    return x, y1listlist, y2listlist
+# Get the common frequency grid that all spectra are interpolated onto
+def getGrid(grid_size: int = 1000, grid_range=(0, 0.5)):
+    return np.linspace(grid_range[0], grid_range[1], grid_size)
+
+
+# Interpolate all sequences onto the grid x in one pass, with linear extrapolation
+# (same as interp1d(..., fill_value="extrapolate") applied to each sequence)
+def interpolateBatch(freq: np.ndarray, power: np.ndarray, offsets: np.ndarray, x: np.ndarray):
+    starts = offsets[:-1]
+    lengths = np.diff(offsets)
+    n_seqs, n_grid = len(lengths), len(x)
+    too_short = np.flatnonzero(lengths < 2)
+    if len(too_short) > 0:
+        raise ValueError(f'Error in sample {too_short[0]}: at least 2 points are required for interpolation')
+    # index[k, j] = number of points in sequence k with freq < x[j], i.e., searchsorted(freq_k, x[j])
+    seq_ids = np.repeat(np.arange(n_seqs), lengths)
+    grid_pos = np.searchsorted(x, freq[:offsets[-1]], side='right')
+    counts = np.bincount(seq_ids * (n_grid + 1) + grid_pos, minlength=n_seqs * (n_grid + 1))
+    index = np.cumsum(counts.reshape(n_seqs, n_grid + 1)[:, :n_grid], axis=1)
+    # Clip so that the first and last intervals are used for extrapolation
+    index = np.clip(index, 1, lengths[:, None] - 1)
+    hi = starts[:, None] + index
+    lo = hi - 1
+    x_lo, x_hi = freq[lo], freq[hi]
+    y_lo, y_hi = power[lo], power[hi]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (y_hi - y_lo) / (x_hi - x_lo)
+        y = slope * (x - x_lo) + y_lo
+    return y # shape: [n_seqs, n_grid]
+
+
+# Interpolate all pairs of sequences between two files, or (freq, power, offsets) tuples already in memory
+def alignPoints(filepath1, filepath2, grid_size: int = 1000, grid_range=(0, 0.5)):
+    freq1, power1, offsets1 = filepath1 if isinstance(filepath1, tuple) else getSpectra(filepath1)
+    freq2, power2, offsets2 = filepath2 if isinstance(filepath2, tuple) else getSpectra(filepath2)
+    n_pairs = min(len(offsets1), len(offsets2)) - 1
+    x = getGrid(grid_size, grid_range)
+    y1matrix = interpolateBatch(freq1, power1, offsets1[:n_pairs + 1], x)
+    y2matrix = interpolateBatch(freq2, power2, offsets2[:n_pairs + 1], x)
+    return x, y1matrix, y2matrix
+
+
+# Pair every model spectrum (file 2) with its nearest human spectra (file 1) under SAM/cosine distance,
+# instead of by line index; y1matrix[i * neighbors + j] is the j-th nearest neighbour of model spectrum i
+def alignNearest(filepath1, filepath2, grid_size: int = 1000, grid_range=(0, 0.5),
+                 method='exact', neighbors: int = 1, n_lists: int = 0, n_probe: int = 8):
+    from pairing import embed_spectra, make_index
+    freq1, power1, offsets1 = filepath1 if isinstance(filepath1, tuple) else getSpectra(filepath1)
+    freq2, power2, offsets2 = filepath2 if isinstance(filepath2, tuple) else getSpectra(filepath2)
+    x = getGrid(grid_size, grid_range)
+    y1matrix = interpolateBatch(freq1, power1, offsets1, x)
+    y2matrix = interpolateBatch(freq2, power2, offsets2, x)
+    index = make_index(method, n_lists=n_lists, n_probe=n_probe).fit(embed_spectra(y1matrix))
+    _, ids = index.search(embed_spectra(y2matrix), neighbors)
+    found = ids >= 0
+    return x, y1matrix[ids[found]], np.repeat(y2matrix, found.sum(axis=1), axis=0)
+
+
+# Row-wise trapezoid area under each spectrum
+def rowTrapz(ymatrix, xlist):
+    dx = np.diff(xlist)
+    return (dx * (ymatrix[:, 1:] + ymatrix[:, :-1]) / 2.0).sum(axis=1)
+
+
+# Row-wise Pearson correlation, NaN for constant rows
+def rowPearson(y1matrix, y2matrix):
+    y1m = y1matrix - y1matrix.mean(axis=1, keepdims=True)
+    y2m = y2matrix - y2matrix.mean(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y1m /= np.linalg.norm(y1m, axis=1, keepdims=True)
+        y2m /= np.linalg.norm(y2m, axis=1, keepdims=True)
+        corr = np.einsum('ij,ij->i', y1m, y2m)
+    return np.clip(corr, -1.0, 1.0)
+
+
+# Row-wise ranks, ties get their average rank (as scipy.stats.rankdata)
+def rowRank(ymatrix):
+    n_rows, n_cols = ymatrix.shape
+    order = np.argsort(ymatrix, axis=1, kind='mergesort')
+    ysorted = np.take_along_axis(ymatrix, order, axis=1)
+    # start of each run of tied values, every row starts a new run
+    is_start = np.ones(ysorted.shape, dtype=bool)
+    is_start[:, 1:] = ysorted[:, 1:] != ysorted[:, :-1]
+    is_start = is_start.ravel()
+    run_id = np.cumsum(is_start) - 1
+    run_start = np.flatnonzero(is_start)
+    run_len = np.diff(np.append(run_start, is_start.size))
+    run_rank = run_start % n_cols + (run_len + 1) / 2.0
+    ranks = np.empty((n_rows, n_cols), dtype=np.float64)
+    np.put_along_axis(ranks, order, run_rank[run_id].reshape(n_rows, n_cols), axis=1)
+    return ranks
+
+
+# Replace inf/NaN (and the row maximum) with the row mean of the remaining points,
+# for pairs whose two spectra have different numbers of finite points
+def repairNonFinite(y1matrix, y2matrix):
+    y1matrix, y2matrix = y1matrix.copy(), y2matrix.copy()
+    rows = np.flatnonzero(np.isfinite(y1matrix).sum(axis=1) != np.isfinite(y2matrix).sum(axis=1))
+    if len(rows) == 0:
+        return y1matrix, y2matrix
+    y1, y2 = y1matrix[rows], y2matrix[rows]
+    with np.errstate(invalid='ignore'):
+        exclude_mask = np.logical_or(y1 == np.nanmax(y1, axis=1, keepdims=True), np.logical_not(np.isfinite(y1)))
+        n_keep = np.logical_not(exclude_mask).sum(axis=1, keepdims=True)
+        y1_mean = np.where(exclude_mask, 0, y1).sum(axis=1, keepdims=True) / n_keep
+        y2_mean = np.where(exclude_mask, 0, y2).sum(axis=1, keepdims=True) / n_keep
+    y1 = np.where(exclude_mask, y1_mean, y1)
+    y2 = np.where(exclude_mask, y2_mean, y2)
+    for y, name in ((y1, 'y1'), (y2, 'y2')):
+        bad = np.flatnonzero(np.logical_not(np.isfinite(y).all(axis=1)))
+        if len(bad) > 0:
+            i = rows[bad[0]]
+            raise ValueError(f'Error in sample {i}: {name} {y[bad[0]]}')
+    y1matrix[rows] = y1
+    y2matrix[rows] = y2
+    return y1matrix, y2matrix
+
+
+# Compute Spectral Overlap (SO) on aligned spectra
+def computeSO(xlist, y1listlist, y2listlist):
+    y1matrix = np.abs(np.asarray(y1listlist, dtype=np.float64))
+    y2matrix = np.abs(np.asarray(y2listlist, dtype=np.float64))
+    area_floor = rowTrapz(np.minimum(y1matrix, y2matrix), xlist)
+    area_roof = rowTrapz(np.maximum(y1matrix, y2matrix), xlist)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        so = np.round(area_floor / area_roof, 4)
+    return area_floor, area_roof, so
 
 
 # Compute Spectral Overlap (SO)
 def getSO(filepath1: str, filepath2: str):
-    area_floor_list, area_roof_list, so_list = [], [], []
     xlist, y1listlist, y2listlist = alignPoints(filepath1, filepath2)
+    return computeSO(xlist, y1listlist, y2listlist)
 
-    for i in range(len(y1listlist)):
-        y1list = y1listlist[i]
-        y2list = y2listlist[i]
-        y1list = [abs(i) for i in y1list]
-        y2list = [abs(i) for i in y2list]
-        ylists = []
-        ylists.append(y1list)
-        ylists.append(y2list)
 
-        y_intersection = np.amin(ylists, axis=0)
-        y_roof = np.amax(ylists, axis=0)
-        area_floor = np.trapz(y_intersection, xlist)
-        area_roof = np.trapz(y_roof, xlist)
-
-        area_floor_list.append(area_floor)
-        area_roof_list.append(area_roof)
-        so_list.append(round(area_floor / area_roof, 4))
-
-    return area_floor_list, area_roof_list, so_list
+# Compute Spearman Rank Correlation (SPEAR) on aligned spectra
+def computeSpearmanr(xlist, y1listlist, y2listlist):
+    y1matrix = np.asarray(y1listlist, dtype=np.float64)
+    y2matrix = np.asarray(y2listlist, dtype=np.float64)
+    corr = rowPearson(rowRank(y1matrix), rowRank(y2matrix))
+    # NaN propagates, as in scipy.stats.spearmanr
+    corr[np.isnan(y1matrix).any(axis=1) | np.isnan(y2matrix).any(axis=1)] = np.nan
+    return corr
 
 
 # Compute Spearman Rank Correlation (SPEAR)
 def getSpearmanr(filepath1: str, filepath2: str):
     xlist, y1listlist, y2listlist = alignPoints(filepath1, filepath2)
-    corr_list = []
-    for i in range(len(y1listlist)):
-        y1list = y1listlist[i]
-        y2list = y2listlist[i]
-        corr, _ = spearmanr(y1list, y2list)
-        corr_list.append(corr)
-    return corr_list
+    return computeSpearmanr(xlist, y1listlist, y2listlist)
+
+# Compute Pearson Correlation (CORR) on aligned spectra
+def computePearson(xlist, y1listlist, y2listlist):
+    y1matrix, y2matrix = repairNonFinite(np.asarray(y1listlist, dtype=np.float64),
+                                         np.asarray(y2listlist, dtype=np.float64))
+    return rowPearson(y1matrix, y2matrix)
+
 
 # Compute Pearson Correlation (CORR)
 def getPearson(filepath1: str, filepath2: str):
     xlist, y1listlist, y2listlist = alignPoints(filepath1, filepath2)
-    corr_list = []
-    for i in range(len(y1listlist)):
-        y1list = y1listlist[i]
-        y2list = y2listlist[i]
-        y1 = np.array(y1list)
-        y2 = np.array(y2list)
-        y1_ninf = len(y1[np.isfinite(y1)])
-        y2_ninf = len(y2[np.isfinite(y2)])
-        if y1_ninf != y2_ninf:
-            # replace inf with mean (after removing max)
-            max_mask = y1 == np.nanmax(y1)
-            inf_mask = np.logical_not(np.isfinite(y1))
-            nan_mask = np.isnan(y1)
-            exclude_mask = np.logical_or(max_mask, inf_mask, nan_mask)
-            y1_ma = np.ma.array(y1, mask=exclude_mask)
-            y2_ma = np.ma.array(y2, mask=exclude_mask)
-            y1[inf_mask] = y1_ma.mean()
-            y1[nan_mask] = y1_ma.mean()
-            y2[inf_mask] = y2_ma.mean()
-            y2[nan_mask] = y2_ma.mean()
-            try:
-                assert len(y1[np.isfinite(y1)])==len(y1)
-            except AssertionError:
-                print(f'Error in sample {i}: y1 {y1}')
-                raise
-            try:
-                assert len(y2[np.isfinite(y2)])==len(y2)
-            except AssertionError:
-                print(f'Error in sample {i}: y2 {y2}')
-                raise
-        try:
-            corr, _ = pearsonr(y1, y2)
-        except ValueError:
-            print(f'Error in sample {i}: y1 of shape {y1.shape}, y2 of shape {y2.shape}')
-            raise
-        corr_list.append(corr)
-    return corr_list
+    return computePearson(xlist, y1listlist, y2listlist)
+
+
+# Compute Spectral Angle Mapper (SAM) on aligned spectra
+def computeSAM(xlist, y1listlist, y2listlist):
+    y1matrix = np.asarray(y1listlist, dtype=np.float64)
+    y2matrix = np.asarray(y2listlist, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Normalize the spectra
+        y1matrix = y1matrix / np.linalg.norm(y1matrix, axis=1, keepdims=True)
+        y2matrix = y2matrix / np.linalg.norm(y2matrix, axis=1, keepdims=True)
+        # Calculate the dot product and the SAM similarity
+        dot_product = np.einsum('ij,ij->i', y1matrix, y2matrix)
+        sam = np.arccos(dot_product) / np.pi
+    return sam
 
 
 # Compute Spectral Angle Mapper (SAM)
 def getSAM(filepath1: str, filepath2: str):
     xlist, y1listlist, y2listlist = alignPoints(filepath1, filepath2)
-    sam_list = []
+    return computeSAM(xlist, y1listlist, y2listlist)
 
-    for i in range(len(y1listlist)):
-        y1list = y1listlist[i]
-        y2list = y2listlist[i]
-        ylists = []
-        ylists.append(y1list)
-        ylists.append(y2list)
 
-        # Normalize the spectra
-        y1list /= np.linalg.norm(y1list)
-        y2list /= np.linalg.norm(y2list)
-        # Calculate the dot product
-        dot_product = np.dot(y1list, y2list)
-        # Calculate the SAM similarity
-        sam_similarity = np.arccos(dot_product) / np.pi
-        sam_list.append(sam_similarity)
+# Metric kernels on aligned spectra, each returns one score per pair
+METRICS = {
+    'SO': lambda xlist, y1listlist, y2listlist: computeSO(xlist, y1listlist, y2listlist)[2],
+    'CORR': computePearson,
+    'SAM': computeSAM,
+    'SPEAR': computeSpearmanr,
+}
+
 
-    return sam_list
+# Check the metric names before any work is done
+def checkMetrics(metrics):
+    for name in metrics:
+        if name not in METRICS:
+            raise ValueError(f'Unknown metric: {name}. Please choose from {list(METRICS)}.')
+
+
+# Compute the selected metrics on spectra already interpolated onto the grid
+def computeScores(xlist, y1matrix, y2matrix, metrics=('SO', 'CORR', 'SAM', 'SPEAR')):
+    checkMetrics(metrics)
+    scores = {}
+    for name in metrics:
+        scores[name] = METRICS[name](xlist, y1matrix, y2matrix)
+    return scores
+
+
+# Compute any subset of the metrics, loading and aligning the two files only once
+def getScores(filepath1, filepath2, metrics=('SO', 'CORR', 'SAM', 'SPEAR'),
+              grid_size: int = 1000, grid_range=(0, 0.5), pairing='index', **pairing_args):
+    checkMetrics(metrics)
+    if pairing == 'index':
+        xlist, y1listlist, y2listlist = alignPoints(filepath1, filepath2, grid_size, grid_range)
+    else:
+        xlist, y1listlist, y2listlist = alignNearest(filepath1, filepath2, grid_size, grid_range,
+                                                     method=pairing, **pairing_args)
+    return computeScores(xlist, y1listlist, y2listlist, metrics)
+
+
+# Score the pairs of two spectrum files (or lists of files) block_size pairs at a time, streaming both in lockstep,
+# so that memory does not grow with the number of pairs; yields the scores of each block
+def scoreChunks(filepath1, filepath2, metrics=('SO', 'CORR', 'SAM', 'SPEAR'),
+                grid_size: int = 1000, grid_range=(0, 0.5), block_size: int = 2000):
+    checkMetrics(metrics)
+    x = getGrid(grid_size, grid_range)
+    first = 0
+    for spectra1, spectra2 in zip(iterSpectra(filepath1, block_size), iterSpectra(filepath2, block_size)):
+        n_pairs = min(len(spectra1[2]), len(spectra2[2])) - 1
+        try:
+            y1matrix = interpolateBatch(*sliceSpectra(spectra1, 0, n_pairs), x)
+            y2matrix = interpolateBatch(*sliceSpectra(spectra2, 0, n_pairs), x)
+            scores = computeScores(x, y1matrix, y2matrix, metrics)
+        except ValueError as e:
+            # the sample numbers in the message count from the start of the block
+            raise ValueError(f'In pairs {first} to {first + n_pairs - 1}: {e}') from e
+        first += n_pairs
+        yield scores
 
 
 def demo():
     pass
 
 def main(args):
-    human_file = args.human
-    model_file = args.model
-    _, _, SO_list = getSO(human_file, model_file)
-    CORR_list = getPearson(human_file, model_file)
-    SAM_list = getSAM(human_file, model_file)
-    SPEAR_list = getSpearmanr(human_file, model_file)
-
-    df = DataFrame({'SO': SO_list, 'CORR': CORR_list, 'SAM': SAM_list, 'SPEAR': SPEAR_list})
+    if args.chunk_size > 0:
+        return mainChunked(args)
+    pairing_args = {}
+    if args.pairing != 'index':
+        pairing_args = {'neighbors': args.neighbors, 'n_lists': args.n_lists, 'n_probe': args.n_probe}
+    human = args.human[0] if len(args.human) == 1 else concatSpectra(args.human)
+    model = args.model[0] if len(args.model) == 1 else concatSpectra(args.model)
+    scores = getScores(human, model, metrics=args.metrics,
+                       grid_size=args.grid_size, grid_range=args.grid_range, pairing=args.pairing, **pairing_args)
+
+    from pandas import DataFrame
+    df = DataFrame(scores)
     if len(args.output) > 0:
         df.to_csv(args.output, index=False)
     else:
         print(df.describe())
+    if args.n_resamples > 0:
+        from bootstrap import summarize
+        print(summarize(df, n_resamples=args.n_resamples, confidence=args.confidence, seed=args.seed))
+
+# As main, scoring --chunk_size pairs at a time and appending them to --output; the scores are only kept
+# in memory for the summary printed without --output, or for the bootstrap
+def mainChunked(args):
+    if args.pairing != 'index':
+        raise ValueError('--chunk_size requires --pairing index')
+    import pandas as pd
+    kept, written = [], False
+    for scores in scoreChunks(args.human, args.model, metrics=args.metrics, grid_size=args.grid_size,
+                              grid_range=args.grid_range, block_size=args.chunk_size):
+        df = pd.DataFrame(scores)
+        if len(args.output) > 0:
+            df.to_csv(args.output, mode='a' if written else 'w', header=not written, index=False)
+            written = True
+        if len(args.output) == 0 or args.n_resamples > 0:
+            kept.append(df)
+    df = pd.concat(kept, ignore_index=True) if len(kept) > 0 else pd.DataFrame(columns=args.metrics, dtype=np.float64)
+    if len(args.output) > 0:
+        if not written:
+            df.to_csv(args.output, index=False)
+    else:
+        print(df.describe())
+    if args.n_resamples > 0:
+        from bootstrap import summarize
+        print(summarize(df, n_resamples=args.n_resamples, confidence=args.confidence, seed=args.seed))
 
 if __name__ == '__main__':
     args = parser.parse_args()
@@ -0,0 +1,17 @@
+"""
+Helpers for deferring heavy imports (torch, transformers, ...) until they are needed, so that the scripts
+parse their arguments and print --help without loading them
+"""
+import functools
+
+
+def no_grad(fn):
+    """
+    As the @torch.no_grad() decorator, importing torch only when fn is called
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        import torch
+        with torch.no_grad():
+            return fn(*args, **kwargs)
+    return wrapper
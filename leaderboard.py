@@ -0,0 +1,140 @@
+"""
+Score many model outputs against one human reference in a single job
+
+Model outputs are found under --data_dir as <model>/<domain>_split/<files> (the layout of data/), and may be
+NLL files (text or .rag) or spectra (CSV or .rag); the files of a (model, domain) are concatenated in natural
+order. The reference spectra are loaded and interpolated onto the grid once, then reused for every model.
+The output is a tidy table with one row per (model, domain, metric):
+    python leaderboard.py --human news=human/news.fft.rag story=human/story.fft.rag wiki=human/wiki.fft.rag \
+        --data_dir data -o leaderboard.csv
+"""
+import argparse
+import glob
+import os
+import re
+import numpy as np
+import pandas as pd
+from face import METRICS, checkMetrics
+from pipeline import FACEPipeline, Spectra
+from ragged import is_ragged, read_nll, read_ragged
+from run_fft import METHODS, FFTProcessor
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--human', type=str, nargs='+', required=True,
+                    help='reference NLLs or spectra, as domain=path entries, or a path used for every domain; \
+                        a path may be a glob, its files are concatenated in natural order')
+parser.add_argument('--data_dir', type=str, default='data', help='directory of <model>/<domain>_split/ outputs')
+parser.add_argument('--pattern', type=str, default='*.nll', help='file pattern inside each <domain>_split directory')
+parser.add_argument('--models', type=str, nargs='+', default=None, help='only score these models')
+parser.add_argument('--domains', type=str, nargs='+', default=None, help='only score these domains')
+parser.add_argument('--output', '-o', type=str, default='', help='tidy CSV output, a summary is printed if not specified')
+parser.add_argument('--metrics', type=str, nargs='+', default=['SO', 'CORR', 'SAM', 'SPEAR'], choices=list(METRICS))
+parser.add_argument('--grid_size', type=int, default=1000, help='number of points of the common frequency grid')
+parser.add_argument('--grid_range', type=float, nargs=2, default=[0, 0.5], help='range of the common frequency grid')
+# spectra of NLL inputs, as run_fft.py
+parser.add_argument('--method', type=str, default='fft', choices=METHODS)
+parser.add_argument('--preprocess', '-p', type=str, default='none', choices=['none', 'zscore', 'minmax', 'log', 'logzs'])
+parser.add_argument('--value', type=str, default='norm', choices=['norm', 'real', 'imag'])
+parser.add_argument('--fft_workers', type=int, default=1, help='number of workers used by scipy.fft')
+
+
+def natural_key(path: str):
+    """
+    split.200 sorts before split.1000
+    """
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', path)]
+
+
+def is_spectrum_file(path: str):
+    if is_ragged(path):
+        return read_ragged(path).meta.get('kind', 'nll') == 'spectrum'
+    with open(path, 'r') as f:
+        return 'freq' in f.readline().strip().split(',')
+
+
+def load_spectra(paths: list, pipeline: FACEPipeline):
+    """
+    Spectra of the files in order, computed in memory for NLL files
+    """
+    parts = []
+    for path in paths:
+        if is_spectrum_file(path):
+            parts.append(Spectra.load(path))
+        else:
+            parts.append(pipeline.spectra(read_nll(path)))
+    return Spectra.concat(parts)
+
+
+def find_outputs(data_dir: str, pattern: str, models=None, domains=None):
+    """
+    {(model, domain): [files]} for the <model>/<domain>_split/<pattern> files under data_dir
+    """
+    outputs = {}
+    for split_dir in sorted(glob.glob(os.path.join(data_dir, '*', '*_split'))):
+        model = os.path.basename(os.path.dirname(split_dir))
+        domain = os.path.basename(split_dir)[:-len('_split')]
+        if (models is not None and model not in models) or (domains is not None and domain not in domains):
+            continue
+        files = sorted(glob.glob(os.path.join(split_dir, pattern)), key=natural_key)
+        if len(files) > 0:
+            outputs[(model, domain)] = files
+    return outputs
+
+
+def parse_references(entries: list):
+    """
+    {domain: [files]}, the domain None applies to every domain
+    """
+    references = {}
+    for entry in entries:
+        domain, path = entry.split('=', 1) if '=' in entry else (None, entry)
+        files = sorted(glob.glob(path), key=natural_key)
+        if len(files) == 0:
+            raise FileNotFoundError(f'No reference file matches {path}')
+        references[domain] = files
+    return references
+
+
+def score_all(references: dict, outputs: dict, pipeline: FACEPipeline):
+    """
+    Tidy DataFrame of the score statistics of every (model, domain, metric)
+    """
+    reference_spectra = {}
+    rows = []
+    for (model, domain), files in outputs.items():
+        key = domain if domain in references else None
+        if key not in references:
+            print(f'Skipping {model}/{domain}: no reference for domain {domain}')
+            continue
+        if key not in reference_spectra:
+            # loaded and interpolated once, the grid is cached by Spectra
+            reference_spectra[key] = load_spectra(references[key], pipeline)
+        scores = pipeline.score(reference_spectra[key], load_spectra(files, pipeline))
+        for metric, values in scores.items():
+            values = pd.Series(values, dtype=np.float64)
+            rows.append({'model': model, 'domain': domain, 'metric': metric, 'mean': values.mean(),
+                         'std': values.std(), 'median': values.median(), 'count': int(values.count()),
+                         'n_pairs': len(values)})
+    return pd.DataFrame(rows, columns=['model', 'domain', 'metric', 'mean', 'std', 'median', 'count', 'n_pairs'])
+
+
+def main(args):
+    checkMetrics(args.metrics)
+    fft_processor = FFTProcessor(method=args.method, preprocess=args.preprocess, value=args.value,
+                                 require_sid=False, workers=args.fft_workers)
+    pipeline = FACEPipeline(fft_processor=fft_processor, metrics=args.metrics,
+                            grid_size=args.grid_size, grid_range=args.grid_range)
+    references = parse_references(args.human)
+    outputs = find_outputs(args.data_dir, args.pattern, args.models, args.domains)
+    if len(outputs) == 0:
+        raise FileNotFoundError(f'No {args.pattern} files under {args.data_dir}/<model>/<domain>_split/')
+    df = score_all(references, outputs, pipeline)
+    if len(args.output) > 0:
+        df.to_csv(args.output, index=False)
+    else:
+        print(df.pivot_table(index='model', columns=['domain', 'metric'], values='mean').round(4))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
@@ -1,6 +1,6 @@
 from modelscope import AutoTokenizer, AutoModelForCausalLM
 import torch
-import torch.nn.functional as F
+from backends import apply_backend
 
 
 def get_device_map(device: int):
@@ -8,43 +8,188 @@ def get_device_map(device: int):
         return "auto"
     return device
 
+
+def chunked_nll(hidden: torch.Tensor, lm_head, targets: torch.Tensor, chunk_size=512) -> torch.Tensor:
+    """
+    NLLs of targets [T] given the final hidden states [T, H] that predict them.
+    The vocabulary projection is done chunk_size positions at a time, so only [chunk_size, V] logits exist at once,
+    and NLL = logsumexp(logits) - logits[target] is computed in float32 (stable, unlike log(softmax)).
+    """
+    nlls = torch.empty(targets.shape[0], dtype=torch.float32, device=hidden.device)
+    for start in range(0, targets.shape[0], chunk_size):
+        end = start + chunk_size
+        logits = lm_head(hidden[start:end]).to(torch.float32)
+        nlls[start:end] = torch.logsumexp(logits, dim=-1) - logits.gather(-1, targets[start:end, None]).squeeze(-1)
+    return nlls
+
+def sliding_windows(n_tokens: int, window: int, stride: int):
+    """
+    Yield (begin, end, first): tokens[begin:end] are fed to the model and the targets tokens[first:end] are scored.
+    Each window advances by stride and keeps window - stride tokens of context, every target 1..n_tokens-1 is scored once.
+    stride < window, so that the first target of a window is predicted from at least one token of the window.
+    The context is recomputed in each window (its positions change, so the keys and values cannot be reused),
+    and each token goes through the model about window / stride times.
+    """
+    if not 0 < stride < window:
+        raise ValueError(f'stride must be in (0, {window}), got {stride}')
+    end = min(window, n_tokens)
+    yield 0, end, 1
+    while end < n_tokens:
+        new_end = min(end + stride, n_tokens)
+        yield max(0, new_end - window), new_end, end
+        end = new_end
+
+
 class CustomModel(object):
-    def __init__(self, model_dir, device=0):
-        self.device = get_device_map(device)
+    def __init__(self, model_dir, device=0, chunk_size=512, backend=None):
+        """
+        backend is one of backends.BACKENDS, by default the weights are loaded in bfloat16.
+        int8 (dynamic quantization) runs on CPU, as does everything when no GPU is available.
+        """
+        self.device = get_device_map(device) if torch.cuda.is_available() and backend != 'int8' else 'cpu'
+        self.chunk_size = chunk_size
+        self.backend = backend
 
         self.model = AutoModelForCausalLM.from_pretrained(
             model_dir,
             device_map=self.device,
             trust_remote_code=True,
-            torch_dtype=torch.bfloat16,
+            torch_dtype=torch.bfloat16 if backend is None else torch.float32,
             use_safetensors=True,
         )
+        if backend is not None:
+            self.model = apply_backend(self.model, backend)
         self.model.requires_grad_(False)
         self.model.eval()
 
         self.tokenizer = AutoTokenizer.from_pretrained(
             model_dir, trust_remote_code=True
         )
+        # pad on the right, so that every text keeps the positions it has when it is run alone
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.tokenizer.padding_side = 'right'
+        self.plain_lm_head = self._check_lm_head()
 
     def generate(self, inputs, configs=None):
         inputs = self.tokenizer(
             inputs, return_tensors="pt", return_token_type_ids=False
         )
         for k, v in inputs.items():
-            inputs[k] = v.cuda(self.device)
-        outputs = self.model.generate(**inputs, **configs)
+            inputs[k] = v.to(self.model.device)
+        outputs = self.model.generate(**inputs, **(configs or {}))
         output_texts = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
         return output_texts
         
-    def forward(self, input_text: str, max_len=1024, return_tokens=False) -> torch.Tensor:
+    def _hidden_states(self, token_ids: torch.Tensor, attention_mask: torch.Tensor = None) -> torch.Tensor:
+        """
+        Final hidden states [B, L, H], i.e., the input of the LM head, without computing the full logits
+        """
+        base_model = self.model.base_model
+        outputs = base_model(input_ids=token_ids, attention_mask=attention_mask)
+        return outputs[0]
+
+    def _check_lm_head(self, probe='The quick brown fox jumps over the lazy dog.') -> bool:
+        """
+        Check once whether the logits are the LM head applied to the final hidden states, so that the NLLs can be
+        computed from the hidden states. Models that rescale or cap the logits (e.g. Gemma 2, Cohere) fail the
+        check and use the full logits.
+        """
+        lm_head = self.model.get_output_embeddings()
+        if lm_head is None or self.model.base_model is self.model:
+            return False
+        token_ids = self.tokenizer(probe, return_tensors='pt')['input_ids'].to(self.model.device)
+        try:
+            with torch.no_grad():
+                logits = self.model(token_ids)['logits'][0].to(torch.float32)
+                projected = lm_head(self._hidden_states(token_ids)[0]).to(torch.float32)
+        except Exception:
+            return False
+        return logits.shape == projected.shape and torch.allclose(logits, projected, rtol=1e-2, atol=1e-2)
+
+    def forward(self, input_text: str, max_len=1024, return_tokens=False):
+        """
+        Logits [L, V] and NLLs [L-1] of a text, nlls[i] = -log P(token[i+1] | history), and the token ids if
+        return_tokens; use nll() when the logits are not needed
+        """
         token_ids = self.tokenizer(input_text, return_tensors='pt')['input_ids'] # shape: [1, L]
         max_len = min(token_ids.shape[1], max_len)
-        inputs = token_ids[:, :max_len].cuda(self.device)
-        logits = self.model(inputs)['logits'][0].cpu().to(torch.float32)
-        probs = F.softmax(logits, dim=-1) # shape: [L, V]
-        nlls = torch.zeros(probs.shape[0]-1, dtype=torch.float32) # NLLs for position i from 1 to L
-        for i in range(probs.shape[0] - 1): # probs[i] is the probability distribution of the (i+1)th token, i.e., P(token[i+1] | history)
-            nlls[i] = -torch.log(probs[i, token_ids[0, i+1]]) # NLL[i] = -log P(token[i+1] | history)
+        inputs = token_ids[:, :max_len].to(self.model.device)
+        logits = self.model(inputs)['logits'][0]
+        nlls = chunked_nll(logits[:-1], lambda x: x, inputs[0, 1:], self.chunk_size).cpu()
+        logits = logits.cpu().to(torch.float32)
         if return_tokens:
             return logits, nlls, token_ids
-        return logits, nlls
\ No newline at end of file
+        return logits, nlls
+
+    def nll(self, input_text: str, max_len=1024, return_tokens=False, stride=0):
+        """
+        NLLs [L-1] of a text as forward(), without the [L, V] logits (and the token ids if return_tokens).
+        If stride > 0, a text longer than max_len is scored whole with sliding windows instead of being truncated.
+        """
+        token_ids = self.tokenizer(input_text, return_tensors='pt')['input_ids'] # shape: [1, L]
+        if stride > 0 and token_ids.shape[1] > max_len:
+            nlls = self._window_nll(token_ids, max_len, stride)
+            return (nlls, token_ids) if return_tokens else nlls
+        max_len = min(token_ids.shape[1], max_len)
+        inputs = token_ids[:, :max_len].to(self.model.device)
+        targets = inputs[0, 1:]
+        if self.plain_lm_head:
+            hidden = self._hidden_states(inputs)[0]
+            nlls = chunked_nll(hidden[:-1], self.model.get_output_embeddings(), targets, self.chunk_size).cpu()
+        else:
+            logits = self.model(inputs)['logits'][0]
+            nlls = chunked_nll(logits[:-1], lambda x: x, targets, self.chunk_size).cpu()
+        if return_tokens:
+            return nlls, token_ids
+        return nlls
+
+    def _window_nll(self, token_ids: torch.Tensor, window: int, stride: int) -> torch.Tensor:
+        """
+        NLLs [L-1] of a long text, window tokens at a time with window - stride tokens of overlapping context
+        """
+        token_ids = token_ids[0].to(self.model.device)
+        nlls = []
+        for begin, end, first in sliding_windows(token_ids.shape[0], window, stride):
+            inputs = token_ids[None, begin:end]
+            # hidden state at position j predicts token j+1
+            targets = token_ids[first:end]
+            if self.plain_lm_head:
+                hidden = self._hidden_states(inputs)[0, first - 1 - begin:end - 1 - begin]
+                nlls.append(chunked_nll(hidden, self.model.get_output_embeddings(), targets, self.chunk_size))
+            else:
+                logits = self.model(inputs)['logits'][0, first - 1 - begin:end - 1 - begin]
+                nlls.append(chunked_nll(logits, lambda x: x, targets, self.chunk_size))
+        return torch.cat(nlls).cpu()
+
+    def encode_batch(self, input_texts: list, max_len=1024):
+        """
+        Tokenize a batch of texts, padded to the longest one
+        """
+        return self.tokenizer(input_texts, return_tensors='pt', padding=True, truncation=True,
+                              max_length=max_len, return_token_type_ids=False)
+
+    def forward_batch(self, input_texts: list, max_len=1024) -> list:
+        """
+        NLLs of a batch of texts, padded to the longest one and masked; the i-th result matches nll(input_texts[i])
+        """
+        return self.forward_encoded(self.encode_batch(input_texts, max_len))
+
+    def forward_encoded(self, inputs) -> list:
+        """
+        NLLs of a batch tokenized by encode_batch
+        """
+        token_ids = inputs['input_ids'].to(self.model.device) # shape: [B, L]
+        mask = inputs['attention_mask'].to(self.model.device)
+        if token_ids.shape[1] < 2:
+            return [torch.zeros(0, dtype=torch.float32) for _ in range(token_ids.shape[0])]
+        # only the positions of real (non-padding) targets are projected to the vocabulary
+        nll_mask = mask[:, 1:] > 0
+        targets = token_ids[:, 1:][nll_mask] # shape: [T]
+        if self.plain_lm_head:
+            hidden = self._hidden_states(token_ids, mask)[:, :-1][nll_mask] # shape: [T, H]
+            nlls = chunked_nll(hidden, self.model.get_output_embeddings(), targets, self.chunk_size)
+        else:
+            logits = self.model(input_ids=token_ids, attention_mask=mask)['logits'][:, :-1][nll_mask]
+            nlls = chunked_nll(logits, lambda x: x, targets, self.chunk_size)
+        return list(nlls.cpu().split(nll_mask.sum(dim=1).tolist()))
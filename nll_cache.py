@@ -0,0 +1,152 @@
+"""
+Persistent, content-addressed NLL cache
+
+Entries are keyed by sha256 of (model identity, tokenizer, NLL settings, text) and stored as float32 blobs in
+a SQLite database (WAL mode), which several processes can read and write at the same time. When the total
+size exceeds max_bytes, the least recently used entries are evicted. Within a process, one NLLCache can be used
+from several threads (e.g. looked up by the inference thread and filled by a writer thread).
+"""
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+
+
+def model_fingerprint(model, tokenizer, **settings):
+    """
+    Identity of an NLL estimator: model config and weight files, tokenizer vocabulary, and settings
+    such as max_length, stride or precision
+    """
+    config = getattr(model, 'config', None)
+    name = getattr(config, '_name_or_path', '') or getattr(model, 'name_or_path', '')
+    weights = []
+    if os.path.isdir(name):
+        for path in sorted(glob.glob(os.path.join(name, '*.safetensors')) + glob.glob(os.path.join(name, '*.bin'))):
+            stat = os.stat(path)
+            weights.append([os.path.basename(path), stat.st_size, int(stat.st_mtime)])
+    vocab = json.dumps(sorted(tokenizer.get_vocab().items()), ensure_ascii=False)
+    return {
+        'model': name,
+        'config': config.to_json_string(use_diff=False) if config is not None else '',
+        'weights': weights,
+        'dtype': str(getattr(model, 'dtype', '')),
+        'tokenizer': type(tokenizer).__name__,
+        'vocab': hashlib.sha256(vocab.encode('utf-8')).hexdigest(),
+        'settings': settings,
+    }
+
+
+def open_cache(args, model, tokenizer, **settings):
+    """
+    NLLCache at args.cache, None if no cache is asked for
+    """
+    if not args.cache:
+        return None
+    return NLLCache(args.cache, model_fingerprint(model, tokenizer, **settings), max_bytes=args.cache_size << 20)
+
+
+def write_cached(cache, fw, data: list):
+    """
+    Write the lines of data that are cached and not done yet to the NLL writer fw
+    """
+    if cache is None:
+        return
+    todo = [i for i in fw.indices if i not in fw.done]
+    for i, nlls in zip(todo, cache.get_many([data[i] for i in todo])):
+        if nlls is not None:
+            fw.write(i, nlls.tolist())
+
+
+class NLLCache(object):
+    """
+    NLL sequences of texts under one model fingerprint, size-bounded with LRU eviction
+    """
+    def __init__(self, path: str, fingerprint: dict, max_bytes: int = 4 << 30, evict_every: int = 1000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+        self.namespace = hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode('utf-8')).hexdigest()
+        self.hits, self.misses = 0, 0
+        self._puts = 0
+        # the connection is shared by the threads that use the cache, one at a time
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(path, timeout=600, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS nll (key TEXT PRIMARY KEY, value BLOB NOT NULL, '
+                          'size INTEGER NOT NULL, last_used REAL NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS nll_last_used ON nll (last_used)')
+
+    def key(self, text: str):
+        return hashlib.sha256(f'{self.namespace}\0{text}'.encode('utf-8')).hexdigest()
+
+    def get_many(self, texts: list):
+        """
+        Cached NLLs (float32 arrays) of texts, None for the misses
+        """
+        keys = [self.key(text) for text in texts]
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self.conn.execute(f'SELECT key, value FROM nll WHERE key IN ({",".join("?" * len(chunk))})',
+                                         chunk)
+                for key, value in rows:
+                    found[key] = np.frombuffer(value, dtype='<f4')
+            if len(found) > 0:
+                now = time.time()
+                self.conn.executemany('UPDATE nll SET last_used = ? WHERE key = ?', [(now, key) for key in found])
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return [found.get(key) for key in keys]
+
+    def get(self, text: str):
+        return self.get_many([text])[0]
+
+    def put_many(self, texts: list, results: list):
+        now = time.time()
+        rows = []
+        for text, nlls in zip(texts, results):
+            value = np.asarray(nlls, dtype='<f4').tobytes()
+            rows.append((self.key(text), value, len(value), now))
+        with self._lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.executemany('INSERT OR REPLACE INTO nll (key, value, size, last_used) VALUES (?, ?, ?, ?)',
+                                  rows)
+            self.conn.execute('COMMIT')
+            self._puts += len(rows)
+            if self._puts >= self.evict_every:
+                self.evict()
+
+    def put(self, text: str, nlls):
+        self.put_many([text], [nlls])
+
+    def evict(self):
+        """
+        Delete the least recently used entries until the total size is within max_bytes
+        """
+        with self._lock:
+            self._puts = 0
+            self.conn.execute('BEGIN IMMEDIATE')
+            total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM nll').fetchone()[0]
+            if total > self.max_bytes:
+                excess = total - self.max_bytes
+                freed = 0
+                keys = []
+                for key, size in self.conn.execute('SELECT key, size FROM nll ORDER BY last_used'):
+                    keys.append((key,))
+                    freed += size
+                    if freed >= excess:
+                        break
+                self.conn.executemany('DELETE FROM nll WHERE key = ?', keys)
+            self.conn.execute('COMMIT')
+
+    def close(self):
+        with self._lock:
+            self.evict()
+            self.conn.close()
+        print(f'NLL cache {self.path}: {self.hits} hits, {self.misses} misses')
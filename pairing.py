@@ -0,0 +1,152 @@
+"""
+Nearest-neighbour search over spectra, for pairing unpaired human and model texts
+
+Spectra interpolated onto a common grid are embedded as L2-normalized float32 vectors, so that the largest
+inner product is the smallest spectral angle (SAM) / cosine distance. ExactIndex searches all of them with
+blocked matrix products; IVFIndex (inverted file) clusters them with spherical k-means and only searches the
+n_probe clusters closest to each query, which is sublinear in the number of indexed spectra.
+"""
+import numpy as np
+
+
+def embed_spectra(ymatrix: np.ndarray):
+    """
+    Rows as unit float32 vectors; non-finite values count as 0, and all-zero rows stay zero
+    """
+    vectors = np.nan_to_num(np.asarray(ymatrix, dtype=np.float32), nan=0.0, posinf=0.0, neginf=0.0)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    np.divide(vectors, norms, out=vectors, where=norms > 0)
+    return vectors
+
+
+def _merge_topk(scores: np.ndarray, ids: np.ndarray, k: int):
+    """
+    Top-k (largest score first) of each row of scores, with the matching ids
+    """
+    if k == 1:
+        best = scores.argmax(axis=1)[:, None]
+        return np.take_along_axis(scores, best, axis=1), np.take_along_axis(ids, best, axis=1)
+    if scores.shape[1] > k:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, part, axis=1)
+        ids = np.take_along_axis(ids, part, axis=1)
+    order = np.argsort(-scores, axis=1, kind='stable')
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+
+def _block_rows(n_cols: int, block_elements: int):
+    """
+    Number of rows of a [rows, n_cols] score block of at most block_elements elements
+    """
+    return max(1, block_elements // max(n_cols, 1))
+
+
+class ExactIndex(object):
+    """
+    Brute-force maximum inner product search, with score blocks of at most block_elements elements
+    """
+    def __init__(self, block_elements: int = 1 << 24):
+        self.block_elements = block_elements
+        self.base = None
+
+    def fit(self, base: np.ndarray):
+        self.base = base
+        return self
+
+    def search(self, queries: np.ndarray, k: int = 1):
+        """
+        Scores (cosine) and ids [n_queries, k] of the k nearest indexed vectors of each query
+        """
+        k = min(k, len(self.base))
+        scores = np.empty((len(queries), k), dtype=np.float32)
+        ids = np.empty((len(queries), k), dtype=np.int64)
+        block_size = _block_rows(len(self.base), self.block_elements)
+        for start in range(0, len(queries), block_size):
+            end = start + block_size
+            block = queries[start:end] @ self.base.T
+            block_ids = np.broadcast_to(np.arange(len(self.base)), block.shape)
+            scores[start:end], ids[start:end] = _merge_topk(block, block_ids, k)
+        return scores, ids
+
+
+class IVFIndex(object):
+    """
+    Inverted file index: the indexed vectors are grouped by their nearest of n_lists centroids (spherical k-means
+    on a sample), and a query is only compared with the vectors of its n_probe nearest lists
+    """
+    def __init__(self, n_lists: int = 0, n_probe: int = 8, n_iter: int = 10, sample_size: int = 256,
+                 block_elements: int = 1 << 24, seed: int = 0):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_iter = n_iter
+        self.sample_size = sample_size
+        self.block_elements = block_elements
+        self.seed = seed
+
+    def _nearest_lists(self, vectors: np.ndarray, n: int):
+        lists = np.empty((len(vectors), n), dtype=np.int64)
+        block_size = _block_rows(len(self.centroids), self.block_elements)
+        for start in range(0, len(vectors), block_size):
+            block = vectors[start:start + block_size] @ self.centroids.T
+            ids = np.broadcast_to(np.arange(len(self.centroids)), block.shape)
+            lists[start:start + block_size] = _merge_topk(block, ids, n)[1]
+        return lists
+
+    def fit(self, base: np.ndarray):
+        rng = np.random.default_rng(self.seed)
+        n_lists = self.n_lists if self.n_lists > 0 else max(1, int(np.sqrt(len(base))))
+        n_lists = min(n_lists, len(base))
+        # k-means on at most sample_size vectors per list
+        sample = base[rng.choice(len(base), min(len(base), n_lists * self.sample_size), replace=False)]
+        self.centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+        for _ in range(self.n_iter):
+            assign = self._nearest_lists(sample, 1)[:, 0]
+            # per-list sums, with reduceat over the sample sorted by list
+            order = np.argsort(assign, kind='stable')
+            counts = np.bincount(assign, minlength=n_lists)
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            sums = self.centroids.copy()
+            sums[counts > 0] = np.add.reduceat(sample[order], starts[counts > 0], axis=0)
+            self.centroids = embed_spectra(sums)
+        # inverted lists, as one permutation of the base plus offsets
+        assign = self._nearest_lists(base, 1)[:, 0]
+        self.order = np.argsort(assign, kind='stable')
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=n_lists))])
+        self.base = base[self.order]
+        return self
+
+    def search(self, queries: np.ndarray, k: int = 1):
+        """
+        Scores (cosine) and ids [n_queries, k] of the approximate k nearest indexed vectors of each query;
+        id -1 (score -inf) if the probed lists hold fewer than k vectors
+        """
+        k = min(k, len(self.base))
+        n_probe = min(self.n_probe, len(self.centroids))
+        probes = self._nearest_lists(queries, n_probe)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        # one matrix product per list, with all the queries that probe it
+        query_ids = np.repeat(np.arange(len(queries)), n_probe)
+        by_list = np.argsort(probes.ravel(), kind='stable')
+        list_starts = np.searchsorted(probes.ravel()[by_list], np.arange(len(self.centroids) + 1))
+        for lst in range(len(self.centroids)):
+            begin, end = self.offsets[lst], self.offsets[lst + 1]
+            list_queries = query_ids[by_list[list_starts[lst]:list_starts[lst + 1]]]
+            if len(list_queries) == 0 or begin == end:
+                continue
+            block_size = _block_rows(end - begin, self.block_elements)
+            for start in range(0, len(list_queries), block_size):
+                q = list_queries[start:start + block_size]
+                block = queries[q] @ self.base[begin:end].T
+                block_ids = np.broadcast_to(self.order[begin:end], block.shape)
+                scores[q], ids[q] = _merge_topk(np.concatenate([scores[q], block], axis=1),
+                                                np.concatenate([ids[q], block_ids], axis=1), k)
+        return scores, ids
+
+
+def make_index(method: str = 'exact', n_lists: int = 0, n_probe: int = 8):
+    if method == 'exact':
+        return ExactIndex()
+    if method == 'ivf':
+        return IVFIndex(n_lists=n_lists, n_probe=n_probe)
+    raise ValueError(f'Unknown index: {method}. Please choose from exact, ivf.')
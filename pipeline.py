@@ -0,0 +1,264 @@
+"""
+End-to-end FACE evaluation in memory: text -> NLL -> spectrum -> scores
+
+The same steps as run_entropy.py, run_fft.py and face.py, without the intermediate files; NLLs and spectra
+are written only if asked for. Human spectra can be computed once, saved and reused for many model runs:
+    python pipeline.py --human human.txt --human_spectra human.fft.rag --model model1.txt -o model1.scores.csv
+    python pipeline.py --human_spectra human.fft.rag --model model2.txt -o model2.scores.csv
+"""
+import argparse
+import os
+import numpy as np
+from face import METRICS, computeScores, getGrid, getSpectra, interpolateBatch
+from ragged import RAGGED_SUFFIX, open_nll_writer, spectrum_dtypes, write_ragged
+from run_fft import METHODS, FFTProcessor
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--human', type=str, default='', help='human-written texts, one per line')
+parser.add_argument('--human_spectra', type=str, default='',
+                    help='spectra of the human texts (.rag or CSV): loaded if the file exists, else computed from --human and saved')
+parser.add_argument('--model', type=str, required=True, help='model-generated texts, one per line')
+parser.add_argument('--output', '-o', type=str, default='', help='per-pair scores (CSV), output to stdout if not specified')
+parser.add_argument('--save_nll', type=str, default='', help='also write the model NLLs (.rag or text)')
+parser.add_argument('--save_spectra', type=str, default='', help='also write the model spectra (.rag or CSV)')
+# estimator
+parser.add_argument('--estimator', type=str, default='gpt2', choices=['gpt2', 'gpt2-medium', 'gpt2-large', 'gpt2-xl'])
+parser.add_argument('--model_path', type=str, default='', help='load the estimator locally if specified')
+parser.add_argument('--custom', action='store_true', help='load --model_path with CustomModel instead of GPT-2')
+parser.add_argument('--backend', type=str, default=None, choices=['fp32', 'bf16', 'int8'])
+parser.add_argument('--max_length', type=int, default=1024)
+parser.add_argument('--max_tokens', type=int, default=8192, help='token budget of the length-sorted batches')
+parser.add_argument('--cache', type=str, default='', help='NLL cache database')
+parser.add_argument('--cache_size', type=int, default=4096, help='maximum size of the NLL cache in MB')
+# spectrum
+parser.add_argument('--method', type=str, default='fft', choices=METHODS)
+parser.add_argument('--preprocess', '-p', type=str, default='none', choices=['none', 'zscore', 'minmax', 'log', 'logzs'])
+parser.add_argument('--value', type=str, default='norm', choices=['norm', 'real', 'imag'])
+parser.add_argument('--fft_workers', type=int, default=1, help='number of workers used by scipy.fft')
+# scores
+parser.add_argument('--metrics', type=str, nargs='+', default=['SO', 'CORR', 'SAM', 'SPEAR'], choices=list(METRICS))
+parser.add_argument('--grid_size', type=int, default=1000, help='number of points of the common frequency grid')
+parser.add_argument('--grid_range', type=float, nargs=2, default=[0, 0.5], help='range of the common frequency grid')
+
+
+class Spectra(object):
+    """
+    Spectra of a set of sequences as flat freq/power arrays plus offsets; the interpolation onto a grid is
+    cached, so spectra reused as the reference of many comparisons are only interpolated once
+    """
+    def __init__(self, freq: np.ndarray, power: np.ndarray, offsets: np.ndarray, meta: dict = None):
+        self.freq = freq
+        self.power = power
+        self.offsets = offsets
+        self.meta = dict(meta or {})
+        self._grids = {}
+
+    @classmethod
+    def from_lists(cls, freqs: list, powers: list, meta: dict = None):
+        offsets = np.zeros(len(freqs) + 1, dtype=np.int64)
+        np.cumsum([len(f) for f in freqs], out=offsets[1:])
+        if len(freqs) == 0:
+            return cls(np.empty(0), np.empty(0), offsets, meta)
+        return cls(np.concatenate(freqs), np.concatenate(powers), offsets, meta)
+
+    @classmethod
+    def concat(cls, parts: list):
+        if len(parts) == 1:
+            return parts[0]
+        offsets = [np.zeros(1, dtype=np.int64)]
+        for part in parts:
+            offsets.append(np.asarray(part.offsets[1:], dtype=np.int64) + offsets[-1][-1])
+        return cls(np.concatenate([part.freq for part in parts]), np.concatenate([part.power for part in parts]),
+                   np.concatenate(offsets), parts[0].meta)
+
+    @classmethod
+    def load(cls, path: str):
+        return cls(*getSpectra(path))
+
+    def save(self, path: str, dtype='float32'):
+        freqs, powers = self.split()
+        if path.endswith(RAGGED_SUFFIX):
+            write_ragged(path, {'freq': freqs, 'power': powers}, dtype=spectrum_dtypes(dtype), meta=self.meta)
+        else:
+            import pandas as pd
+            sids = np.repeat(np.arange(len(self)), np.diff(self.offsets))
+            pd.DataFrame({'sid': sids, 'freq': self.freq, 'power': self.power}).to_csv(path, index=False)
+
+    def split(self):
+        if len(self) == 0:
+            return [], []
+        return np.split(self.freq, self.offsets[1:-1]), np.split(self.power, self.offsets[1:-1])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def on_grid(self, grid_size: int = 1000, grid_range=(0, 0.5)):
+        """
+        All spectra interpolated onto the grid, shape [n_seqs, grid_size]; the rows of spectra with fewer than
+        2 points (which cannot be interpolated) are NaN, so that they get NaN scores
+        """
+        key = (grid_size, tuple(grid_range))
+        if key not in self._grids:
+            x = getGrid(grid_size, grid_range)
+            lengths = np.diff(self.offsets)
+            valid = lengths >= 2
+            if valid.all():
+                self._grids[key] = interpolateBatch(self.freq, self.power, self.offsets, x)
+            else:
+                points = np.flatnonzero(np.repeat(valid, lengths)) + self.offsets[0]
+                offsets = np.concatenate([[0], np.cumsum(lengths[valid])]).astype(np.int64)
+                y = np.full((len(self), grid_size), np.nan)
+                y[valid] = interpolateBatch(self.freq[points], self.power[points], offsets, x)
+                self._grids[key] = y
+        return self._grids[key]
+
+
+class NLLEstimator(object):
+    """
+    NLLs of texts in memory, with length-sorted batches under a token budget (and an optional NLL cache)
+    """
+    def __init__(self, model='gpt2', model_path='', custom=False, backend=None, max_length=1024,
+                 max_tokens=8192, cache='', cache_size=4096):
+        import torch
+        from run_entropy_batch import load_model
+        from nll_cache import open_cache
+        self.torch = torch
+        self.max_length = max_length
+        self.max_tokens = max_tokens
+        # a local GPT-2 directory is loaded by load_model like a model name
+        args = argparse.Namespace(model=model_path or model, model_path=model_path, backend=backend,
+                                  cache=cache, cache_size=cache_size)
+        if custom:
+            from model import CustomModel
+            self.custom = CustomModel(model_path, backend=backend)
+            self.model, self.tokenizer = self.custom.model, self.custom.tokenizer
+        else:
+            self.custom = None
+            self.model, self.tokenizer = load_model(args)
+        self.cache = open_cache(args, self.model, self.tokenizer, max_length=max_length, stride=0, backend=backend)
+
+    def _compute(self, texts: list):
+        from run_entropy_batch import compute_batch_nll, make_token_batches
+        token_ids = self.tokenizer(texts, truncation=True, max_length=self.max_length)['input_ids']
+        results = [None] * len(texts)
+        with self.torch.no_grad():
+            for batch in make_token_batches([len(ids) for ids in token_ids], self.max_tokens):
+                if len(token_ids[batch[0]]) < 2: # only lines without any NLL left
+                    for i in batch:
+                        results[i] = np.zeros(0, dtype=np.float32)
+                    continue
+                encoded_input = self.tokenizer.pad({'input_ids': [token_ids[i] for i in batch]}, return_tensors='pt')
+                if self.custom is not None:
+                    nlls = self.custom.forward_encoded(encoded_input)
+                else:
+                    nlls = compute_batch_nll(self.model, encoded_input.to(self.model.device))
+                for i, out_masked in zip(batch, nlls):
+                    results[i] = out_masked.float().cpu().numpy()
+        return results
+
+    def __call__(self, texts: list):
+        if self.cache is None:
+            return self._compute(texts)
+        results = self.cache.get_many(texts)
+        todo = [i for i, nlls in enumerate(results) if nlls is None]
+        if len(todo) > 0:
+            computed = self._compute([texts[i] for i in todo])
+            self.cache.put_many([texts[i] for i in todo], computed)
+            for i, nlls in zip(todo, computed):
+                results[i] = nlls
+        return results
+
+
+class FACEPipeline(object):
+    """
+    texts -> NLLs (estimator) -> spectra (FFTProcessor) -> scores (face metrics), all in memory
+    """
+    def __init__(self, estimator: NLLEstimator = None, fft_processor: FFTProcessor = None,
+                 metrics=('SO', 'CORR', 'SAM', 'SPEAR'), grid_size: int = 1000, grid_range=(0, 0.5)):
+        self.estimator = estimator
+        self.fft_processor = fft_processor or FFTProcessor(method='fft', preprocess='none', value='norm',
+                                                           require_sid=False)
+        self.metrics = list(metrics)
+        self.grid_size = grid_size
+        self.grid_range = tuple(grid_range)
+
+    def nll(self, texts: list):
+        if self.estimator is None:
+            raise ValueError('An NLLEstimator is required to score texts')
+        return self.estimator(texts)
+
+    def spectra(self, nlls: list):
+        # empty sequences are skipped, as when the NLLs are read back from a file by run_fft.py
+        nlls = [np.asarray(x, dtype=np.float64) for x in nlls if len(x) > 0]
+        freqs, powers, _ = self.fft_processor.compute(nlls)
+        return Spectra.from_lists(freqs, powers, meta=self.fft_processor.meta())
+
+    def score(self, human: Spectra, model: Spectra):
+        """
+        Per-pair scores of the first min(len(human), len(model)) pairs, NaN for the pairs with a spectrum
+        that cannot be interpolated
+        """
+        n_pairs = min(len(human), len(model))
+        x = getGrid(self.grid_size, self.grid_range)
+        y1matrix = human.on_grid(self.grid_size, self.grid_range)[:n_pairs]
+        y2matrix = model.on_grid(self.grid_size, self.grid_range)[:n_pairs]
+        valid = ~(np.isnan(y1matrix).all(axis=1) | np.isnan(y2matrix).all(axis=1))
+        if valid.all():
+            return computeScores(x, y1matrix, y2matrix, self.metrics)
+        scores = {}
+        for name, values in computeScores(x, y1matrix[valid], y2matrix[valid], self.metrics).items():
+            scores[name] = np.full(n_pairs, np.nan)
+            scores[name][valid] = values
+        return scores
+
+    def run(self, model_texts: list, human, save_nll: str = '', save_spectra: str = ''):
+        """
+        Scores of model_texts against human, which is a list of texts or Spectra (reused as is)
+        """
+        if not isinstance(human, Spectra):
+            human = self.spectra(self.nll(human))
+        nlls = self.nll(model_texts)
+        if save_nll:
+            with open_nll_writer(save_nll) as fw:
+                for x in nlls:
+                    fw.write(x)
+        model = self.spectra(nlls)
+        if save_spectra:
+            model.save(save_spectra)
+        return self.score(human, model)
+
+
+def read_texts(path: str):
+    with open(path, 'r') as f:
+        return [line.strip() for line in f.readlines()]
+
+
+def main(args):
+    if not args.human and not (args.human_spectra and os.path.exists(args.human_spectra)):
+        parser.error('either --human or an existing --human_spectra file is required')
+    estimator = NLLEstimator(model=args.estimator, model_path=args.model_path, custom=args.custom,
+                             backend=args.backend, max_length=args.max_length, max_tokens=args.max_tokens,
+                             cache=args.cache, cache_size=args.cache_size)
+    fft_processor = FFTProcessor(method=args.method, preprocess=args.preprocess, value=args.value,
+                                 require_sid=False, workers=args.fft_workers)
+    pipeline = FACEPipeline(estimator, fft_processor, metrics=args.metrics,
+                            grid_size=args.grid_size, grid_range=args.grid_range)
+    if args.human_spectra and os.path.exists(args.human_spectra):
+        human = Spectra.load(args.human_spectra)
+    else:
+        human = pipeline.spectra(pipeline.nll(read_texts(args.human)))
+        if args.human_spectra:
+            human.save(args.human_spectra)
+    scores = pipeline.run(read_texts(args.model), human, save_nll=args.save_nll, save_spectra=args.save_spectra)
+
+    import pandas as pd
+    df = pd.DataFrame(scores)
+    if len(args.output) > 0:
+        df.to_csv(args.output, index=False)
+    else:
+        print(df.describe())
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
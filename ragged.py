@@ -0,0 +1,338 @@
+"""
+Binary ragged-array container for NLL and spectrum files (*.rag)
+
+Layout (little endian):
+    magic           8 bytes, b'FACERAG1'
+    values          n_values records of a structured dtype, one field per column (e.g. value, or freq/power)
+    offsets         int64[n_seqs + 1], aligned to 8 bytes, sequence i is values[offsets[i]:offsets[i+1]]
+    footer          JSON with the field types, the counts, the byte positions and the metadata
+    footer length   uint64
+    magic           8 bytes
+The footer is written last, so a file can be produced in one streaming pass.
+"""
+import argparse
+import array
+import json
+import os
+import numpy as np
+
+MAGIC = b'FACERAG1'
+RAGGED_SUFFIX = '.rag'
+FORMAT_VERSION = 1
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--input', '-i', type=str, required=True, help='input file, .rag or text/CSV')
+parser.add_argument('--output', '-o', type=str, required=True, help='output file, .rag or text/CSV')
+parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float16'],
+                    help='value type when converting to .rag')
+
+
+def is_ragged(path: str):
+    """
+    Check the magic bytes of a file
+    """
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except (FileNotFoundError, IsADirectoryError):
+        return False
+
+
+class RaggedWriter(object):
+    """
+    Streaming writer, one call of write() per sequence. dtype is one type for all fields, or a dict per field.
+    The file is written to path + '.tmp' and renamed to path by close(); if the with-block raises, the
+    partial file is removed instead, so that path never holds a file with a valid footer but missing sequences
+    """
+    def __init__(self, path: str, fields=('value',), dtype='float32', meta: dict = None):
+        self.path = path
+        dtypes = dtype if isinstance(dtype, dict) else {name: dtype for name in fields}
+        self.dtype = np.dtype([(name, np.dtype(dtypes[name]).newbyteorder('<')) for name in fields])
+        self.meta = dict(meta or {})
+        self.offsets = array.array('q', [0])
+        self.tmp_path = path + '.tmp'
+        self._f = open(self.tmp_path, 'wb')
+        self._f.write(MAGIC)
+
+    def write(self, *columns):
+        if len(columns) != len(self.dtype.names):
+            raise ValueError(f'Expected {len(self.dtype.names)} columns {self.dtype.names}, got {len(columns)}')
+        n = len(columns[0])
+        records = np.empty(n, dtype=self.dtype)
+        for name, col in zip(self.dtype.names, columns):
+            records[name] = col
+        self._f.write(records.tobytes())
+        self.offsets.append(self.offsets[-1] + n)
+
+    def close(self):
+        if self._f.closed:
+            return
+        values_end = len(MAGIC) + self.offsets[-1] * self.dtype.itemsize
+        self._f.write(b'\0' * (-values_end % 8))
+        offsets_start = values_end + (-values_end % 8)
+        self._f.write(np.asarray(self.offsets, dtype='<i8').tobytes())
+        footer = json.dumps({
+            'version': FORMAT_VERSION,
+            'fields': list(self.dtype.names),
+            'dtypes': [self.dtype[name].str for name in self.dtype.names],
+            'n_seqs': len(self.offsets) - 1,
+            'n_values': self.offsets[-1],
+            'values_start': len(MAGIC),
+            'offsets_start': offsets_start,
+            'meta': self.meta,
+        }).encode('utf-8')
+        self._f.write(footer)
+        self._f.write(np.uint64(len(footer)).astype('<u8').tobytes())
+        self._f.write(MAGIC)
+        self._f.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        """
+        Close and remove the partial file, without writing the footer
+        """
+        if self._f.closed:
+            return
+        self._f.close()
+        os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+class RaggedArray(object):
+    """
+    A values buffer plus an offsets index; sequence i is values[offsets[i]:offsets[i+1]]
+    """
+    def __init__(self, values: np.ndarray, offsets: np.ndarray, meta: dict = None):
+        self.values = values
+        self.offsets = offsets
+        self.meta = dict(meta or {})
+
+    @property
+    def fields(self):
+        return self.values.dtype.names
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int):
+        seq = self.values[self.offsets[i]:self.offsets[i + 1]]
+        if len(self.fields) == 1:
+            return seq[self.fields[0]]
+        return seq
+
+    def field(self, name: str):
+        """
+        Flat (zero-copy) view of one column
+        """
+        return self.values[name]
+
+    def split(self, name: str = None, dtype=None):
+        """
+        One view per sequence of a column, cast to dtype first if given
+        """
+        flat = self.field(name or self.fields[0])
+        if dtype is not None:
+            flat = flat.astype(dtype)
+        return np.split(flat, self.offsets[1:-1]) if len(self) > 0 else []
+
+
+def read_ragged(path: str, mmap=True):
+    """
+    Open a .rag file, memory-mapped (zero-copy) by default
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a ragged array file')
+        f.seek(-len(MAGIC) - 8, os.SEEK_END)
+        footer_len = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is truncated (missing footer)')
+        f.seek(-len(MAGIC) - 8 - footer_len, os.SEEK_END)
+        footer = json.loads(f.read(footer_len).decode('utf-8'))
+    dtype = np.dtype(list(zip(footer['fields'], footer['dtypes'])))
+    n_seqs, n_values = footer['n_seqs'], footer['n_values']
+    if mmap:
+        values = np.memmap(path, dtype=dtype, mode='r', offset=footer['values_start'], shape=(n_values,)) \
+            if n_values > 0 else np.empty(0, dtype=dtype)
+        offsets = np.memmap(path, dtype='<i8', mode='r', offset=footer['offsets_start'], shape=(n_seqs + 1,))
+    else:
+        with open(path, 'rb') as f:
+            f.seek(footer['values_start'])
+            values = np.fromfile(f, dtype=dtype, count=n_values)
+            f.seek(footer['offsets_start'])
+            offsets = np.fromfile(f, dtype='<i8', count=n_seqs + 1)
+    return RaggedArray(values, offsets, footer['meta'])
+
+
+def write_ragged(path: str, columns: dict, dtype='float32', meta: dict = None):
+    """
+    Write lists of per-sequence arrays, e.g. {'freq': freqs, 'power': powers}
+    """
+    names = list(columns)
+    with RaggedWriter(path, fields=names, dtype=dtype, meta=meta) as writer:
+        for seqs in zip(*[columns[name] for name in names]):
+            writer.write(*seqs)
+
+
+class NLLTextWriter(object):
+    """
+    Writes one NLL sequence per line as '%.4f' text
+    """
+    def __init__(self, path: str, mode='w'):
+        self.path = path
+        self._f = open(path, mode)
+
+    def write(self, nlls):
+        self._f.write(' '.join(f'{num:.4f}' for num in nlls) + '\n')
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_nll_writer(path: str, dtype='float32', meta: dict = None):
+    """
+    Writer for NLL sequences, binary if path ends with .rag, text otherwise
+    """
+    if path.endswith(RAGGED_SUFFIX):
+        return RaggedWriter(path, fields=('value',), dtype=dtype, meta={'kind': 'nll', **(meta or {})})
+    return NLLTextWriter(path)
+
+
+def read_nll(path: str, N: int = np.inf, keep_empty=False):
+    """
+    Read NLL sequences as a list of float64 arrays, from .rag or text. Empty sequences (empty lines, e.g. of
+    one-token texts) are skipped in both formats, unless keep_empty, which keeps one sequence per line
+    """
+    if is_ragged(path):
+        data = read_ragged(path).split('value', dtype=np.float64)
+        if not keep_empty:
+            data = [x for x in data if len(x) > 0]
+        return data if N == np.inf else data[:int(N)]
+    data = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line == '' and not keep_empty:
+                continue
+            data.append(np.asarray(line.split(), dtype=np.float64))
+            if len(data) >= N:
+                break
+    return data
+
+
+def iter_nll(path: str, chunk_size: int):
+    """
+    Read NLL sequences lazily, as lists of at most chunk_size float64 arrays, skipping empty sequences
+    as read_nll
+    """
+    if is_ragged(path):
+        rag = read_ragged(path)
+        for start in range(0, len(rag), chunk_size):
+            end = min(start + chunk_size, len(rag))
+            offsets = rag.offsets[start:end + 1]
+            flat = np.asarray(rag.field('value')[offsets[0]:offsets[-1]], dtype=np.float64)
+            chunk = [x for x in np.split(flat, offsets[1:-1] - offsets[0]) if len(x) > 0]
+            if len(chunk) > 0:
+                yield chunk
+        return
+    chunk = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line == '':
+                continue
+            chunk.append(np.asarray(line.split(), dtype=np.float64))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def nll_text_to_ragged(src: str, dst: str, dtype='float32', meta: dict = None):
+    with open_nll_writer(dst, dtype=dtype, meta=meta) as writer:
+        for nlls in read_nll(src, keep_empty=True):
+            writer.write(nlls)
+
+
+def ragged_to_nll_text(src: str, dst: str):
+    rag = read_ragged(src)
+    with NLLTextWriter(dst) as writer:
+        for i in range(len(rag)):
+            writer.write(rag[i].tolist())
+
+
+def spectrum_dtypes(dtype='float32'):
+    """
+    Field types of a spectrum file, freq is kept at least float32 so that neighbouring frequencies stay distinct
+    """
+    return {'freq': 'float32' if np.dtype(dtype).itemsize < 4 else dtype, 'power': dtype}
+
+
+def spectrum_csv_to_ragged(src: str, dst: str, dtype='float32', meta: dict = None):
+    """
+    Sequences are split by the sid column if present, otherwise where freq decreases
+    """
+    import pandas as pd
+    spectrum = pd.read_csv(src)
+    freq = spectrum['freq'].to_numpy()
+    if 'sid' in spectrum.columns:
+        starts = np.flatnonzero(np.diff(spectrum['sid'].to_numpy()) != 0) + 1
+    else:
+        starts = np.flatnonzero(freq[1:] < freq[:-1]) + 1
+    bounds = np.concatenate([[0], starts, [len(freq)]]) if len(freq) > 0 else [0]
+    power = spectrum['power'].to_numpy()
+    with RaggedWriter(dst, fields=('freq', 'power'), dtype=spectrum_dtypes(dtype),
+                      meta={'kind': 'spectrum', **(meta or {})}) as writer:
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            writer.write(freq[start:end], power[start:end])
+
+
+def ragged_to_spectrum_csv(src: str, dst: str, require_sid=True):
+    import pandas as pd
+    rag = read_ragged(src)
+    columns = {}
+    if require_sid:
+        columns['sid'] = np.repeat(np.arange(len(rag)), rag.lengths)
+    columns['freq'] = rag.field('freq')
+    columns['power'] = rag.field('power')
+    pd.DataFrame(columns).to_csv(dst, index=False)
+
+
+def main(args):
+    if is_ragged(args.input):
+        kind = read_ragged(args.input).meta.get('kind', 'nll')
+        if kind == 'spectrum':
+            ragged_to_spectrum_csv(args.input, args.output)
+        else:
+            ragged_to_nll_text(args.input, args.output)
+    else:
+        with open(args.input, 'r') as f:
+            header = f.readline()
+        if 'freq' in header.split(','):
+            spectrum_csv_to_ragged(args.input, args.output, dtype=args.dtype)
+        else:
+            nll_text_to_ragged(args.input, args.output, dtype=args.dtype)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
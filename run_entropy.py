@@ -1,14 +1,17 @@
 import argparse
 import os
+import sys
 import json
-import torch
-from transformers import GPT2LMHeadModel, GPT2Tokenizer
+import time
+import multiprocessing as mp
 from tqdm import tqdm
-import torch.nn as nn
 import numpy as np
-from einops import rearrange
 from config import load_config
-from model import CustomModel
+from checkpoint import CheckpointedNLLWriter, output_complete
+from lazy import no_grad
+from ragged import open_nll_writer, read_nll
+from nll_cache import open_cache, write_cached
+# torch, transformers and the models are imported where they are used, so that --help starts fast
 
 
 def create_parser():
@@ -16,7 +19,9 @@ def create_parser():
     parser.add_argument('--input', '-i', type=str, default='', 
                         help='input file', required=True)
     parser.add_argument('--output', '-o', type=str, default='',
-                        help='output file', required=True)
+                        help='output file, binary ragged array if it ends with .rag', required=True)
+    parser.add_argument('--output_dtype', type=str, default='float32', choices=['float32', 'float16'],
+                        help='value type of .rag output')
     parser.add_argument(
         '--model', type=str, default='gpt2',
         choices=['gpt2', 'gpt2-medium', 'gpt2-large', 'gpt2-xl'],
@@ -25,6 +30,25 @@ def create_parser():
             (negative log-likelihood output) in replace of the default models'
     )
     parser.add_argument('--model_path', type=str, default='', help='load model locally if specified')
+    parser.add_argument('--max_length', type=int, default=1024, help='maximum number of tokens fed to the model at once')
+    parser.add_argument('--stride', type=int, default=0,
+                        help='if > 0, score documents longer than --max_length whole with sliding windows that advance \
+                            by stride tokens (keeping max_length - stride tokens of context), instead of truncating them. \
+                            Must be smaller than --max_length; the context is recomputed in every window, so a token \
+                            costs about max_length / stride forward passes')
+    parser.add_argument('--checkpoint_every', type=int, default=100,
+                        help='number of lines between checkpoints, an interrupted run resumes from the last one')
+    parser.add_argument('--cache', type=str, default='',
+                        help='NLL cache database shared across runs and processes, keyed by model, settings and text')
+    parser.add_argument('--cache_size', type=int, default=4096, help='maximum size of the NLL cache in MB')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='if > 1, split the input across this many processes, each with its own model copy, \
+                            and merge their shards in line order')
+    parser.add_argument('--backend', type=str, default=None, choices=['fp32', 'bf16', 'int8'],
+                        help='inference backend: float32, bf16 autocast, or int8 dynamic quantization (CPU); \
+                            compare them with backends.py. Default: float32 for GPT-2, bfloat16 weights for custom models')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='torch threads per worker, default: number of cores / workers')
 
     parser.add_argument(
         "--config",
@@ -36,6 +60,9 @@ def create_parser():
 
 
 def load_model(args):
+    import torch
+    from transformers import GPT2LMHeadModel, GPT2Tokenizer
+    from backends import apply_backend
     if len(args.model_path)>0:
         model_path = args.model_path
         model = GPT2LMHeadModel.from_pretrained(model_path)
@@ -47,7 +74,11 @@ def load_model(args):
         model = GPT2LMHeadModel.from_pretrained(model_path)
         tokenizer = GPT2Tokenizer.from_pretrained(model_path)
     tokenizer.pad_token = tokenizer.eos_token
-    if torch.cuda.is_available():
+    if args.backend is not None:
+        model = apply_backend(model, args.backend)
+    if args.backend == 'int8':
+        device = torch.device('cpu') # dynamically quantized layers run on CPU only
+    elif torch.cuda.is_available():
         device = torch.device('cuda')
     elif torch.backends.mps.is_available():
         device = torch.device('mps')
@@ -57,83 +88,229 @@ def load_model(args):
     return model, tokenizer
 
 
-@torch.no_grad()
-def process(model, tokenizer, args):
+def window_nll(model, input_ids, window: int, stride: int):
+    """
+    NLLs of every token after the first of a long document, with sliding windows of overlapping context
+    """
+    import torch
+    import torch.nn as nn
+    from model import sliding_windows
+    log_softmax = nn.LogSoftmax(dim=-1)
+    input_ids = input_ids[0]
+    nlls = []
+    for begin, end, first in sliding_windows(input_ids.shape[0], window, stride):
+        logits = model(input_ids[None, begin:end]).logits[0]
+        # logits at position j predict token j+1
+        log_probs = log_softmax(logits[first - 1 - begin:end - 1 - begin])
+        targets = input_ids[first:end]
+        nlls.append(-log_probs.gather(-1, targets[:, None]).squeeze(-1))
+    return torch.cat(nlls)
+
+
+def shard_path(output: str, shard: int, n_shards: int):
+    """
+    Output of one worker, e.g. out.nll.txt -> out.nll.shard0of4.txt, keeping the extension (and so the format)
+    """
+    if n_shards == 1:
+        return output
+    base, ext = os.path.splitext(output)
+    return f'{base}.shard{shard}of{n_shards}{ext}'
+
+
+@no_grad
+def process(model, tokenizer, args, shard: int = 0, n_shards: int = 1):
+    """
+    Lines shard, shard + n_shards, ... of the input, written to shard_path(args.output, shard, n_shards).
+    Returns the number of lines and tokens computed and the time spent.
+    """
+    import torch.nn as nn
+    from einops import rearrange
     device = model.device
     criterian = nn.NLLLoss(reduction='none')
     log_softmax = nn.LogSoftmax(dim=1)
 
     with open(args.input, 'r') as fr:
         data = [line.strip() for line in fr.readlines()]
-    with open(args.output, 'w') as fw:
-        for line in tqdm(data):
-            encoded_input = tokenizer(line,
-                                      max_length=1024,
-                                      truncation=True,
-                                      return_tensors='pt').to(device)
-            input_ids = encoded_input['input_ids']
-
-            try:
-                output = model(**encoded_input, labels=input_ids)
-            except Exception:
-                print('line:', line)
-                print('input_ids:', input_ids)
-                raise
-            logits = output.logits.to(device)
-            target = encoded_input['input_ids'].to(device)
-
-            logits = rearrange(logits, 'B L V -> B V L')
-            shift_logits = logits[
-                ..., :, :-1]  # Use the first L-1 tokens to predict the next
-            shift_target = target[..., 1:]
-
-            nll_loss = criterian(log_softmax(shift_logits),
-                                 shift_target).squeeze()
-            res = nll_loss.tolist()
-            if not isinstance(res, list):
-                res = [res]
-
-            try:
-                res_str = ' '.join(f'{num:.4f}' for num in res)
-            except Exception:
-                print('line:', line)
-                print('input_ids:', input_ids)
-                print('logits.shape:', logits.shape)
-                print('res:', res)
-                raise
-            else:
-                fw.write(f'{res_str}\n')
-
-
-@torch.no_grad()
-def process_custom(args):
+    fw = CheckpointedNLLWriter(shard_path(args.output, shard, n_shards), range(shard, len(data), n_shards),
+                               input_file=args.input, every=args.checkpoint_every,
+                               dtype=args.output_dtype, meta={'model': args.model_path or args.model})
+    cache = open_cache(args, model, tokenizer, max_length=args.max_length, stride=args.stride, backend=args.backend)
+    write_cached(cache, fw, data)
+    start, n_lines, n_tokens = time.time(), 0, 0
+    for i in tqdm(fw.indices, desc=f'shard {shard}' if n_shards > 1 else None, position=shard):
+        if i in fw.done:
+            continue
+        line = data[i]
+        if args.stride > 0:
+            input_ids = tokenizer(line, return_tensors='pt')['input_ids'].to(device)
+            if input_ids.shape[1] > args.max_length:
+                res = window_nll(model, input_ids, args.max_length, args.stride).tolist()
+                fw.write(i, res)
+                if cache is not None:
+                    cache.put(line, res)
+                n_lines, n_tokens = n_lines + 1, n_tokens + len(res)
+                continue
+        encoded_input = tokenizer(line,
+                                  max_length=args.max_length,
+                                  truncation=True,
+                                  return_tensors='pt').to(device)
+        input_ids = encoded_input['input_ids']
+
+        try:
+            output = model(**encoded_input, labels=input_ids)
+        except Exception:
+            print('line:', line)
+            print('input_ids:', input_ids)
+            raise
+        logits = output.logits.to(device)
+        target = encoded_input['input_ids'].to(device)
+
+        logits = rearrange(logits, 'B L V -> B V L')
+        shift_logits = logits[
+            ..., :, :-1]  # Use the first L-1 tokens to predict the next
+        shift_target = target[..., 1:]
+
+        nll_loss = criterian(log_softmax(shift_logits),
+                             shift_target).squeeze()
+        res = nll_loss.tolist()
+        if not isinstance(res, list):
+            res = [res]
+
+        try:
+            fw.write(i, res)
+        except Exception:
+            print('line:', line)
+            print('input_ids:', input_ids)
+            print('logits.shape:', logits.shape)
+            print('res:', res)
+            raise
+        if cache is not None:
+            cache.put(line, res)
+        n_lines, n_tokens = n_lines + 1, n_tokens + len(res)
+    elapsed = time.time() - start
+    fw.finalize()
+    if cache is not None:
+        cache.close()
+    return n_lines, n_tokens, elapsed
+
+
+@no_grad
+def process_custom(args, shard: int = 0, n_shards: int = 1):
     """
-    For custom models specified in configuration file
+    For custom models specified in configuration file, sharded like process()
     """
+    import torch
+    from model import CustomModel
     # Load model and data
-    model = CustomModel(args.model_path)
+    model = CustomModel(args.model_path, backend=args.backend)
     with open(args.input, 'r') as f:
         data = [line.strip() for line in f.readlines()]
-    # Compute
-    results = []
-    for line in tqdm(data):
-        _, nlls = model.forward(line)
-        results.append(nlls)
-    # Write results
-    with open(args.output, 'w') as f:
-        for res in results:
-            if isinstance(res, torch.Tensor):
-                res = res.numpy().tolist()
-            res_str = ' '.join(f'{num:.4f}' for num in res)
-            f.write(f'{res_str}\n')
+    # Compute and write results, skipping the lines done by an interrupted run
+    fw = CheckpointedNLLWriter(shard_path(args.output, shard, n_shards), range(shard, len(data), n_shards),
+                               input_file=args.input, every=args.checkpoint_every,
+                               dtype=args.output_dtype, meta={'model': args.model_path})
+    cache = open_cache(args, model.model, model.tokenizer, max_length=args.max_length, stride=args.stride,
+                       backend=args.backend)
+    write_cached(cache, fw, data)
+    start, n_lines, n_tokens = time.time(), 0, 0
+    for i in tqdm(fw.indices, desc=f'shard {shard}' if n_shards > 1 else None, position=shard):
+        if i in fw.done:
+            continue
+        line = data[i]
+        nlls = model.nll(line, max_len=args.max_length, stride=args.stride)
+        if isinstance(nlls, torch.Tensor):
+            nlls = nlls.numpy().tolist()
+        fw.write(i, nlls)
+        if cache is not None:
+            cache.put(line, nlls)
+        n_lines, n_tokens = n_lines + 1, n_tokens + len(nlls)
+    elapsed = time.time() - start
+    fw.finalize()
+    if cache is not None:
+        cache.close()
+    return n_lines, n_tokens, elapsed
 
 
-if __name__ == "__main__":
+def run_shard(args, shard: int, n_shards: int, threads: int):
+    """
+    Worker process: load a model copy and compute one shard
+    """
+    import torch
+    torch.set_num_threads(threads)
+    if args.config is not None:
+        return process_custom(args, shard, n_shards)
+    model, tokenizer = load_model(args)
+    return process(model, tokenizer, args, shard, n_shards)
+
+
+def merge_shards(args, n_shards: int):
+    """
+    Interleave the shards back into line order: line i is line i // n_shards of shard i % n_shards
+    """
+    paths = [shard_path(args.output, k, n_shards) for k in range(n_shards)]
+    shards = [read_nll(path, keep_empty=True) for path in paths] # one sequence per input line
+    n_lines = sum(len(shard) for shard in shards)
+    tmp_path = os.path.join(os.path.dirname(args.output), '.tmp.' + os.path.basename(args.output))
+    with open_nll_writer(tmp_path, dtype=args.output_dtype, meta={'model': args.model_path or args.model}) as fw:
+        for i in range(n_lines):
+            fw.write(shards[i % n_shards][i // n_shards])
+    os.replace(tmp_path, args.output)
+    for path in paths:
+        os.remove(path)
+
+
+def process_sharded(args):
+    """
+    Data-parallel estimation with args.workers processes. A shard already finished by an interrupted run is
+    not recomputed, and an unfinished one resumes from its checkpoint.
+    """
+    n_shards = args.workers
+    with open(args.input, 'r') as f:
+        n_lines = sum(1 for _ in f)
+    if output_complete(args.output, n_lines, args.input, meta={'model': args.model_path or args.model}):
+        print(f'{args.output} is complete ({n_lines} lines), skipping')
+        return
+    threads = args.threads if args.threads > 0 else max(1, (os.cpu_count() or 1) // n_shards)
+    shards = [k for k in range(n_shards) if not os.path.exists(shard_path(args.output, k, n_shards))
+              or os.path.exists(shard_path(args.output, k, n_shards) + '.ckpt')]
+    start = time.time()
+    stats = []
+    if len(shards) > 0:
+        pool = mp.get_context('spawn').Pool(len(shards))
+        stats = pool.starmap(run_shard, [(args, k, n_shards, threads) for k in shards])
+        pool.close()
+        pool.join()
+    merge_shards(args, n_shards)
+    wall = time.time() - start
+    n_lines, n_tokens = sum(s[0] for s in stats), sum(s[1] for s in stats)
+    compute = max([s[2] for s in stats], default=0)
+    for k, (lines, tokens, elapsed) in zip(shards, stats):
+        print(f'shard {k}: {lines} lines, {tokens / max(elapsed, 1e-9):.1f} tokens/s')
+    print(f'{n_shards} workers x {threads} threads: {n_lines} lines, {n_tokens} tokens, '
+          f'{n_tokens / max(compute, 1e-9):.1f} tokens/s ({n_lines / max(compute, 1e-9):.2f} lines/s) in compute, '
+          f'{wall:.1f}s wall including model loading')
+
+
+def main():
     parser = create_parser()
     args = parser.parse_args()
     if args.config is not None:
-        args = load_config(args)
-        process_custom(args)
+        args = load_config(args, parser, sys.argv[1:])
+    if args.stride < 0 or args.stride >= args.max_length:
+        parser.error(f'--stride must be in [0, --max_length), got {args.stride}')
+    if args.workers > 1:
+        process_sharded(args)
     else:
-        model, tokenizer = load_model(args)
-        process(model, tokenizer, args)
\ No newline at end of file
+        if args.threads > 0:
+            import torch
+            torch.set_num_threads(args.threads)
+        if args.config is not None:
+            n_lines, n_tokens, elapsed = process_custom(args)
+        else:
+            model, tokenizer = load_model(args)
+            n_lines, n_tokens, elapsed = process(model, tokenizer, args)
+        print(f'{n_lines} lines, {n_tokens / max(elapsed, 1e-9):.1f} tokens/s')
+
+
+if __name__ == "__main__":
+    main()
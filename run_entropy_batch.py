@@ -1,13 +1,14 @@
 import argparse
 import os
+import sys
 import json
-import torch
-from transformers import GPT2LMHeadModel, GPT2Tokenizer
-from tqdm import tqdm
-import torch.nn as nn
-from einops import rearrange
 import numpy as np
-from model import Model
+from config import load_config
+from checkpoint import CheckpointedNLLWriter
+from lazy import no_grad
+from nll_cache import open_cache, write_cached
+from executor import PipelinedExecutor
+# torch, transformers and the models are imported where they are used, so that --help starts fast
 
 
 def create_parser():
@@ -15,7 +16,9 @@ def create_parser():
     parser.add_argument('--input', '-i', type=str, default='', 
                         help='input file', required=True)
     parser.add_argument('--output','-o', type=str, default='',
-                        help='output file', required=True)
+                        help='output file, binary ragged array if it ends with .rag', required=True)
+    parser.add_argument('--output_dtype', type=str, default='float32', choices=['float32', 'float16'],
+                        help='value type of .rag output')
     parser.add_argument(
         '--model',
         type=str,
@@ -27,24 +30,40 @@ def create_parser():
     )
     parser.add_argument('--model_path', type=str, default='', 
                         help='load custom models specified by the path')
+    parser.add_argument('--config', type=str, default=None, help='path to the configuration file')
     parser.add_argument('--batch_size', '-bs', type=int, default=32)
     parser.add_argument('--start_batch', type=int, default=0)
+    parser.add_argument('--checkpoint_every', type=int, default=100,
+                        help='number of lines between checkpoints, an interrupted run resumes from the last one')
+    parser.add_argument('--max_tokens', type=int, default=0,
+                        help='if > 0, sort lines by token length and build batches of at most this many (padded) tokens, \
+                            instead of fixed --batch_size batches in file order')
+    parser.add_argument('--backend', type=str, default=None, choices=['fp32', 'bf16', 'int8'],
+                        help='inference backend: float32, bf16 autocast, or int8 dynamic quantization (CPU); \
+                            compare them with backends.py. Default: float32 for GPT-2, bfloat16 weights for custom models')
+    parser.add_argument('--prefetch', type=int, default=4,
+                        help='number of batches tokenized ahead of (and waiting to be written after) the model')
+    parser.add_argument('--cache', type=str, default='',
+                        help='NLL cache database shared across runs and processes, keyed by model, settings and text')
+    parser.add_argument('--cache_size', type=int, default=4096, help='maximum size of the NLL cache in MB')
     return parser
 
 
 def load_model(args):
-    if len(args.model_path)>0:
-        model_path = args.model_path
-        model = GPT2LMHeadModel.from_pretrained(model_path)
-        tokenizer = GPT2Tokenizer(tokenizer_file=os.path.join(model_path, 'tokenizer.json'),
-                                  vocab_file=os.path.join(model_path, 'vocab.json'),
-                                  merges_file=os.path.join(model_path, 'merges.txt'))
-    else:
-        model_path = args.model
-        model = GPT2LMHeadModel.from_pretrained(model_path)
-        tokenizer = GPT2Tokenizer.from_pretrained(model_path)
+    """
+    GPT-2 model and tokenizer, by name or from a local directory (--model_path is handled by process_custom)
+    """
+    import torch
+    from transformers import GPT2LMHeadModel, GPT2Tokenizer
+    from backends import apply_backend
+    model = GPT2LMHeadModel.from_pretrained(args.model)
+    tokenizer = GPT2Tokenizer.from_pretrained(args.model)
     tokenizer.pad_token = tokenizer.eos_token
-    if torch.cuda.is_available():
+    if args.backend is not None:
+        model = apply_backend(model, args.backend)
+    if args.backend == 'int8':
+        device = torch.device('cpu') # dynamically quantized layers run on CPU only
+    elif torch.cuda.is_available():
         device = torch.device('cuda')
     elif torch.backends.mps.is_available():
         device = torch.device('mps')
@@ -54,15 +73,61 @@ def load_model(args):
     return model, tokenizer
 
 
-@torch.no_grad()
+def compute_batch_nll(model, encoded_input):
+    """
+    NLLs of each line in a padded batch, with the padding positions removed
+    """
+    import torch
+    import torch.nn as nn
+    from einops import rearrange
+    criterian = nn.NLLLoss(reduction='none')
+    log_softmax = nn.LogSoftmax(dim=1)
+    input_ids = encoded_input['input_ids']
+    mask = encoded_input['attention_mask']
+
+    output = model(**encoded_input)
+    logits = rearrange(output.logits, 'B L V -> B V L')
+    shift_logits = logits[..., :, :-1] # Use the first L-1 tokens to predict the next
+    shift_target = input_ids[..., 1:]
+    mask = mask[..., 1:]
+
+    nll_loss = criterian(log_softmax(shift_logits), shift_target) # shape: [B, L-1]
+    return [torch.masked_select(nll_loss[i, :], mask[i, :] > 0) for i in range(nll_loss.size(0))]
+
+
+def make_token_batches(lengths: list, max_tokens: int):
+    """
+    Sort lines by length (longest first) and group them greedily, so that batch_size * longest length <= max_tokens.
+    A line longer than max_tokens gets a batch of its own.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    batches, batch = [], []
+    for i in order:
+        if len(batch) > 0 and (len(batch) + 1) * lengths[batch[0]] > max_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+def padding_efficiency(lengths: list, batches: list):
+    """
+    Fraction of the computed (padded) tokens that are real tokens
+    """
+    real = sum(lengths[i] for batch in batches for i in batch)
+    padded = sum(len(batch) * max(lengths[i] for i in batch) for batch in batches)
+    return real / padded if padded > 0 else 1.0
+
+
+@no_grad
 def process(model, tokenizer, args):
     """
     For pretrained models from Huggingface transformers 
     """
     device = model.device
     print(f'model is on device: {device}')
-    criterian = nn.NLLLoss(reduction='none')
-    log_softmax = nn.LogSoftmax(dim=1)
 
     with open(args.input, 'r') as fr:
         data = [line.strip() for line in fr.readlines()]
@@ -70,73 +135,163 @@ def process(model, tokenizer, args):
     if len(data) % args.batch_size > 0:
         num_batches += 1
 
-    with open(args.output, 'w') as fw:
-        for i in tqdm(range(args.start_batch, num_batches)):
-            batch = data[i*args.batch_size: (i*args.batch_size+args.batch_size)]
-            if len(batch) == 0:
-                continue
-            try:
-                encoded_input = tokenizer(batch, return_tensors='pt', padding=True, truncation=True).to(device)
-            except Exception:
-                raise
-            input_ids = encoded_input['input_ids']
-            mask = encoded_input['attention_mask']
-
-            try:
-                output = model(**encoded_input, labels=input_ids)
-            except RuntimeError:
-                print(f'batch index: {i}')
-                # print(f'batch: {batch}')
-                print('encoded_input.input_ids: {}'.format(input_ids))
-                raise
-            logits = output.logits.to(device)
-            target = encoded_input['input_ids'].to(device)
-
-            logits = rearrange(logits, 'B L V -> B V L') 
-            shift_logits = logits[..., :, :-1] # Use the first L-1 tokens to predict the next
-            shift_target = target[..., 1:]
-            mask = mask[..., 1:]
-
-            nll_loss = criterian(log_softmax(shift_logits), shift_target).squeeze()
-            for i in range(nll_loss.size(0)):
-                out = nll_loss[i,:].squeeze()
-                out_masked = torch.masked_select(out, mask[i,:]>0)
-                res_str = ' '.join(f'{num:.4f}' for num in out_masked)
-                fw.write(f'{res_str}\n')
-
-
-@torch.no_grad()
+    fw = CheckpointedNLLWriter(args.output, range(args.start_batch*args.batch_size, len(data)),
+                               input_file=args.input, every=args.checkpoint_every,
+                               dtype=args.output_dtype, meta={'model': args.model_path or args.model})
+    cache = open_cache(args, model, tokenizer, max_length=tokenizer.model_max_length, stride=0,
+                       backend=args.backend)
+    write_cached(cache, fw, data)
+    # skip the lines done by an interrupted run
+    batches = [[j for j in range(i*args.batch_size, min(i*args.batch_size+args.batch_size, len(data))) if j not in fw.done]
+               for i in range(args.start_batch, num_batches)]
+    batches = [line_ids for line_ids in batches if len(line_ids) > 0]
+
+    def prepare(line_ids):
+        return tokenizer([data[j] for j in line_ids], return_tensors='pt', padding=True, truncation=True)
+
+    def infer(line_ids, encoded_input):
+        encoded_input = encoded_input.to(device)
+        try:
+            return [out_masked.cpu() for out_masked in compute_batch_nll(model, encoded_input)]
+        except RuntimeError:
+            print(f'batch lines: {line_ids}')
+            print('encoded_input.input_ids: {}'.format(encoded_input['input_ids']))
+            raise
+
+    def write(line_ids, nlls):
+        for j, out_masked in zip(line_ids, nlls):
+            fw.write(j, out_masked.tolist())
+        if cache is not None:
+            cache.put_many([data[j] for j in line_ids], [out_masked.numpy() for out_masked in nlls])
+
+    executor = PipelinedExecutor(prepare, infer, write, depth=args.prefetch)
+    executor.run(batches)
+    print(executor.report())
+    fw.finalize()
+    if cache is not None:
+        cache.close()
+
+
+@no_grad
+def process_sorted(model, tokenizer, args):
+    """
+    For pretrained models from Huggingface transformers, with length-sorted batches under a token budget.
+    Lines are tokenized once, and the output is assembled in the original line order.
+    """
+    import torch
+    device = model.device
+    print(f'model is on device: {device}')
+
+    with open(args.input, 'r') as fr:
+        data = [line.strip() for line in fr.readlines()]
+    fw = CheckpointedNLLWriter(args.output, range(len(data)), input_file=args.input, every=args.checkpoint_every,
+                               dtype=args.output_dtype, meta={'model': args.model_path or args.model})
+    cache = open_cache(args, model, tokenizer, max_length=tokenizer.model_max_length, stride=0,
+                       backend=args.backend)
+    write_cached(cache, fw, data)
+    token_ids = tokenizer(data, truncation=True)['input_ids']
+    lengths = [len(ids) for ids in token_ids]
+    # only the lines not done by an interrupted run (or cached) are scheduled
+    todo = [i for i in range(len(data)) if i not in fw.done]
+    batches = [[todo[j] for j in batch] for batch in make_token_batches([lengths[i] for i in todo], args.max_tokens)]
+    fixed_batches = [list(range(i, min(i + args.batch_size, len(data)))) for i in range(0, len(data), args.batch_size)]
+    print(f'{len(batches)} batches, padding efficiency: {padding_efficiency(lengths, batches):.2%} '
+          f'(fixed batches of {args.batch_size}: {padding_efficiency(lengths, fixed_batches):.2%})')
+
+    def prepare(batch):
+        if lengths[batch[0]] == 0: # only empty lines left
+            return None
+        return tokenizer.pad({'input_ids': [token_ids[i] for i in batch]}, return_tensors='pt')
+
+    def infer(batch, encoded_input):
+        if encoded_input is None:
+            return [torch.zeros(0) for _ in batch]
+        try:
+            return [out_masked.cpu() for out_masked in compute_batch_nll(model, encoded_input.to(device))]
+        except RuntimeError:
+            print(f'batch lines: {batch}')
+            raise
+
+    def write(batch, nlls):
+        for i, out_masked in zip(batch, nlls):
+            fw.write(i, out_masked.tolist())
+        if cache is not None:
+            cache.put_many([data[i] for i in batch], [out_masked.numpy() for out_masked in nlls])
+
+    executor = PipelinedExecutor(prepare, infer, write, depth=args.prefetch)
+    executor.run(batches)
+    print(executor.report())
+    fw.finalize()
+    if cache is not None:
+        cache.close()
+
+
+@no_grad
 def process_custom(args):
     """
-    For custom models
+    For custom models, specified by --model_path or a configuration file
     """
-    model = Model(args.model_path)
+    from model import CustomModel
+    model = CustomModel(args.model_path, backend=args.backend)
 
     with open(args.input, 'r') as fr:
         data = [line.strip() for line in fr.readlines()]
-    num_batches = len(data) // args.batch_size
-    if len(data) % args.batch_size > 0:
-        num_batches += 1
-    
-    with open(args.output, 'w') as fw:
-        for i in tqdm(range(args.start_batch, num_batches)):
-            batch = data[i*args.batch_size: (i*args.batch_size+args.batch_size)]
-            if len(batch) == 0:
-                continue 
-            try:
-                res = model.forward_batch(batch)
-            except Exception:
-                print(f'batch index: {i}')
-                # print(f'batch: {batch}')
-                raise
-            #todo: implement batch nll calculation
+    fw = CheckpointedNLLWriter(args.output, range(args.start_batch*args.batch_size, len(data)),
+                               input_file=args.input, every=args.checkpoint_every,
+                               dtype=args.output_dtype, meta={'model': args.model_path})
+    cache = open_cache(args, model.model, model.tokenizer, max_length=1024, stride=0, backend=args.backend)
+    write_cached(cache, fw, data)
+    # skip the lines done by an interrupted run or cached
+    todo = [i for i in fw.indices if i not in fw.done]
+    if args.max_tokens > 0:
+        lengths = [len(ids) for ids in model.tokenizer([data[i] for i in todo], truncation=True, max_length=1024)['input_ids']] \
+            if len(todo) > 0 else []
+        token_batches = make_token_batches(lengths, args.max_tokens)
+        fixed_batches = [list(range(i, min(i + args.batch_size, len(todo)))) for i in range(0, len(todo), args.batch_size)]
+        print(f'{len(token_batches)} batches, padding efficiency: {padding_efficiency(lengths, token_batches):.2%} '
+              f'(fixed batches of {args.batch_size}: {padding_efficiency(lengths, fixed_batches):.2%})')
+        batches = [[todo[j] for j in batch] for batch in token_batches]
+    else:
+        batches = [todo[i: i+args.batch_size] for i in range(0, len(todo), args.batch_size)]
 
+    def prepare(batch):
+        return model.encode_batch([data[j] for j in batch])
 
-if __name__ == "__main__":
+    def infer(batch, inputs):
+        try:
+            return [nlls.float() for nlls in model.forward_encoded(inputs)]
+        except Exception:
+            print(f'batch lines: {batch}')
+            raise
+
+    def write(batch, res):
+        for j, nlls in zip(batch, res):
+            fw.write(j, nlls.tolist())
+        if cache is not None:
+            cache.put_many([data[j] for j in batch], [nlls.numpy() for nlls in res])
+
+    executor = PipelinedExecutor(prepare, infer, write, depth=args.prefetch)
+    executor.run(batches)
+    print(executor.report())
+    fw.finalize()
+    if cache is not None:
+        cache.close()
+
+
+def main():
     parser = create_parser()
     args = parser.parse_args()
+    if args.config is not None:
+        args = load_config(args, parser, sys.argv[1:])
     if args.model_path:
-        pass
+        process_custom(args)
     else:
         model, tokenizer = load_model(args)
-        process(model, tokenizer, args)
\ No newline at end of file
+        if args.max_tokens > 0:
+            process_sorted(model, tokenizer, args)
+        else:
+            process(model, tokenizer, args)
+
+
+if __name__ == "__main__":
+    main()
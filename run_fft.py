@@ -1,91 +1,108 @@
-from scipy import signal
-from scipy.fft import fft, fftfreq, fftshift
 from typing import Union
 import numpy as np
-import pandas as pd
 import tqdm
 import argparse
 import os
+from ragged import RAGGED_SUFFIX, RaggedWriter, iter_nll, read_nll, spectrum_dtypes, write_ragged
+# scipy and pandas are imported by the methods that use them, so that --help and .rag output do not load them
+
+METHODS = ['fft', 'periodogram', 'welch', 'multitaper']
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--input', '-i', type=str, default='', help='input file')
-parser.add_argument('--output', '-o', type=str, default='', help='output file or dir')
-parser.add_argument('--method', type=str, default='fft', choices=['fft', 'periodogram'])
+parser.add_argument('--output', '-o', type=str, default='', help='output file or dir, binary ragged array if it ends with .rag')
+parser.add_argument('--method', type=str, default='fft', choices=METHODS)
+parser.add_argument('--window', type=str, default=None,
+                    help='window of periodogram / welch, default: boxcar for periodogram, hann for welch')
+parser.add_argument('--nperseg', type=int, default=256, help='welch segment length (shorter sequences use their length)')
+parser.add_argument('--noverlap', type=int, default=None, help='welch segment overlap, default: nperseg // 2')
+parser.add_argument('--nw', type=float, default=2.5,
+                    help='multitaper time-half-bandwidth product (sequences shorter than 2 * nw + 1 use (length - 1) / 2)')
+parser.add_argument('--n_tapers', type=int, default=0, help='number of multitaper DPSS tapers, default: 2 * nw - 1')
 parser.add_argument('--preprocess', '-p', type=str, default='none', choices=['none', 'zscore', 'minmax', 'log', 'logzs'])
 parser.add_argument('--value', type=str, default='norm', choices=['norm', 'real', 'imag'])
 parser.add_argument('--require_sid', action='store_true', default=True, help='if true, append sequence id to output file')
+parser.add_argument('--workers', type=int, default=1, help='number of workers used by scipy.fft, -1 for all CPU cores')
+parser.add_argument('--output_dtype', type=str, default='float32', choices=['float32', 'float16'], help='value type of .rag output')
+parser.add_argument('--chunk_size', type=int, default=0, help='if > 0, stream the input in chunks of this many sequences to bound memory')
 parser.add_argument('--verbose', action='store_true', help='verbose mode')
 parser.add_argument('--demo', action='store_true', help='run demo')
 
 
 # FFT Processor class
 class FFTProcessor(object):
-    def __init__(self, method, preprocess, value, require_sid, verbose=False):
+    def __init__(self, method, preprocess, value, require_sid, verbose=False, workers=1,
+                 window=None, nperseg=256, noverlap=None, nw=2.5, n_tapers=0, block_elements=1 << 24):
+        if method not in METHODS:
+            raise ValueError(f'Unknown method: {method}. Please choose from {METHODS}.')
         self.method = method
         self.preprocess = preprocess
         self.value = value
         self.require_sid = require_sid
         self.verbose = verbose
+        self.workers = workers
+        self.window = window
+        self.nperseg = nperseg
+        self.noverlap = noverlap
+        self.nw = nw
+        self.n_tapers = n_tapers
+        self.block_elements = block_elements
     
     def _read_data(self, data_file: str, N: int = np.inf):
+        """
+        Read NLL sequences from a text file (one sequence per line) or a .rag file
+        """
+        return read_nll(data_file, N)
+    
+    def _preprocess(self, input_data: list, block_elements: int = 1 << 20):
+        """
+        Normalize the sequences in blocks of about block_elements values: each block is concatenated into one
+        float64 buffer, normalized in place with segment-wise reductions, and returned as views of the buffer.
+        minmax maps constant sequences to 0.
+        """
+        if self.preprocess == 'none':
+            return input_data
+        if self.preprocess not in ('zscore', 'minmax', 'log', 'logzs'):
+            raise ValueError(f'Unknown preprocess method: {self.preprocess}. Please choose from [none, zscore, minmax, log, logzs].')
+        lengths = np.fromiter((len(d) for d in input_data), dtype=np.int64, count=len(input_data))
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        # sequence index ranges [a, b) of the blocks
+        bounds = np.searchsorted(offsets, np.arange(0, offsets[-1], block_elements), side='right') - 1
+        bounds = np.unique(np.concatenate([[0], bounds, [len(input_data)]]))
         data = []
-        with open(data_file, 'r') as f:
-            count = 0
-            for line in f:
-                line = line.strip()
-                if line == '':
-                    continue
-                num = list(map(float, line.split()))
-                data.append(num)
-                count += 1
-                if count >= N:
-                    break
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            flat = np.concatenate([np.asarray(d, dtype=np.float64) for d in input_data[a:b]])
+            self._preprocess_flat(flat, lengths[a:b])
+            data.extend(np.split(flat, offsets[a + 1:b] - offsets[a]))
         return data
-    
-    def _preprocess(self, input_data: list):
-        data = input_data.copy()
-        if self.preprocess == 'zscore':
-            data_zs = []
+
+    def _preprocess_flat(self, flat: np.ndarray, lengths: np.ndarray):
+        """
+        Normalize in place the consecutive sequences of the given lengths in flat
+        """
+        # reductions over the non-empty segments, broadcast back with np.repeat
+        lengths = lengths[lengths > 0]
+        if len(lengths) == 0:
+            return flat
+        starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        if self.preprocess in ('log', 'logzs'):
+            flat += 1
+            np.log(flat, out=flat)
+        if self.preprocess in ('zscore', 'logzs'):
             epsion = 1e-6
-            for d in data:
-                d = np.asarray(d)
-                d_mean = np.mean(d)
-                d_std = np.std(d)
-                d_norm = (d - d_mean) / (d_std + epsion)
-                data_zs.append(d_norm)
-            data = data_zs.copy()
+            flat -= np.repeat(np.add.reduceat(flat, starts) / lengths, lengths)
+            d_std = np.sqrt(np.add.reduceat(flat * flat, starts) / lengths)
+            flat /= np.repeat(d_std + epsion, lengths)
         elif self.preprocess == 'minmax':
-            data_mm = []
-            for d in data:
-                d = np.asarray(d)
-                d_min = np.min(d)
-                d_max = np.max(d)
-                d_norm = (d - d_min) / (d_max - d_min)
-                data_mm.append(d_norm)
-            data = data_mm.copy()
-        elif self.preprocess == 'log':
-            data_log = []
-            for d in data:
-                d = np.asarray(d)
-                d_log = np.log(d + 1)
-                data_log.append(d_log)
-            data = data_log.copy()
-        elif self.preprocess == 'logzs':
-            data_logzs = []
-            epsion = 1e-6
-            for d in data:
-                d = np.asarray(d)
-                d_log = np.log(d + 1)
-                d_mean = np.mean(d_log)
-                d_std = np.std(d_log)
-                d_norm = (d_log - d_mean) / (d_std + epsion)
-                data_logzs.append(d_norm)
-            data = data_logzs.copy()
-        elif self.preprocess != 'none':
-            raise ValueError(f'Unknown preprocess method: {self.preprocess}. Please choose from [none, zscore, minmax, log, logzs].')
-        return data
-    
+            d_min = np.minimum.reduceat(flat, starts)
+            d_range = np.maximum.reduceat(flat, starts) - d_min
+            d_range[d_range == 0] = 1
+            flat -= np.repeat(d_min, lengths)
+            flat /= np.repeat(d_range, lengths)
+        return flat
+
     def _create_input_df(self, data: list, require_sid=True):
+        import pandas as pd
         if require_sid:
             df = pd.DataFrame({
                 'value': np.concatenate(data),
@@ -97,60 +114,114 @@ class FFTProcessor(object):
             })
         return df
 
-    def _periodogram_batch(self, data: list[np.ndarray], require_sid=False):
+    def _periodogram_batch(self, data: list, require_sid=False, verbose=False):
         """
-        Periodogram method (with smoothing window)
+        Periodogram method (with smoothing window), one call per group of equal-length sequences
         """
-        freqs, powers, seq_ids = [], [], []
-        for i in tqdm.tqdm(range(len(data))):
-            f, p = self._periodogram(data[i])
-            freqs.append(f)
-            powers.append(p)
-            if require_sid:
-                seq_ids.append(np.array([i] * len(f)))
-        return freqs, powers, seq_ids
-    
+        return self._bucket_batch(data, self._periodogram, require_sid, verbose)
+
     def _periodogram(self, data: np.ndarray):
-        f, p = signal.periodogram(data)
+        from scipy import signal
+        window = self.window if self.window is not None else 'boxcar'
+        f, p = signal.periodogram(data, window=window, axis=-1)
         return f, p
-    
-    def _fft_batch(self, data: list, require_sid=False, verbose=False):
+
+    def _welch(self, data: np.ndarray):
+        """
+        Welch's method: average of the periodograms of overlapping windowed segments
         """
-        FFT batch
-        """
-        freqs, powers = [], []
-        sids = [] if require_sid else None
-        for i in tqdm.tqdm(range(len(data)), disable = not verbose):
-            x = data[i]
-            try:
-                f, p = self._fft(x)
-            except Exception:
-                print(f'Error in sample {i}: {x}')
-                raise
-            freqs.append(f)
-            powers.append(p)
-            if require_sid:
-                sids.append(np.array([i] * len(f)))
+        from scipy import signal
+        N = data.shape[-1]
+        nperseg = min(self.nperseg, N)
+        noverlap = self.noverlap if self.noverlap is not None else nperseg // 2
+        window = self.window if self.window is not None else 'hann'
+        f, p = signal.welch(data, window=window, nperseg=nperseg, noverlap=min(noverlap, nperseg - 1), axis=-1)
+        return f, p
+
+    def _multitaper(self, data: np.ndarray):
+        """
+        Multitaper method: average of the periodograms with n_tapers orthogonal DPSS (Slepian) tapers,
+        one-sided power spectral density as signal.periodogram. Sequences too short for nw (which must be below
+        N / 2) use nw = (N - 1) / 2, and at most 2 * nw - 1 tapers; no sequence uses more than N tapers
+        """
+        from scipy import signal
+        from scipy.fft import rfft, rfftfreq
+        N = data.shape[-1]
+        n_tapers = self.n_tapers if self.n_tapers > 0 else max(1, int(2 * self.nw) - 1)
+        freq_x = rfftfreq(N)
+        if N < 2:
+            return freq_x, np.zeros((len(data), len(freq_x)))
+        nw = min(self.nw, (N - 1) / 2)
+        if nw < self.nw:
+            n_tapers = min(n_tapers, max(1, int(2 * nw) - 1))
+        n_tapers = min(n_tapers, N)
+        tapers = signal.windows.dpss(N, nw, Kmax=n_tapers, return_ratios=False).reshape(-1, N)
+        x = data - data.mean(axis=-1, keepdims=True)
+        p = np.mean(np.abs(rfft(x[:, None, :] * tapers, axis=-1, workers=self.workers)) ** 2, axis=1)
+        # one-sided: double all but the DC and Nyquist terms
+        p[:, 1:len(freq_x) - (N % 2 == 0)] *= 2
+        return freq_x, p
+
+    def _bucket_batch(self, data: list, transform, require_sid=False, verbose=False):
+        """
+        Apply transform to 2-D arrays of equal-length sequences, one length bucket at a time
+        (split into blocks of at most block_elements values)
+        """
+        freqs, powers = [None] * len(data), [None] * len(data)
+        sids = [None] * len(data) if require_sid else None
+        for N, idx in tqdm.tqdm(self._length_buckets(data), disable = not verbose):
+            if N == 0:
+                raise ValueError(f'Error in sample {idx[0]}: empty sequence')
+            block_size = max(1, self.block_elements // N)
+            for start in range(0, len(idx), block_size):
+                block = idx[start:start + block_size]
+                x = np.stack([np.asarray(data[i]) for i in block]) # shape: [B, N]
+                f, p = transform(x)
+                for j, i in enumerate(block):
+                    freqs[i] = f
+                    powers[i] = p[j]
+                    if require_sid:
+                        sids[i] = np.full(len(f), i)
         return freqs, powers, sids
 
+    def _length_buckets(self, data: list):
+        """
+        Group sequence indices by length, so that each group can be stacked into a 2-D array
+        """
+        if len(data) == 0:
+            return []
+        lengths = np.fromiter((len(d) for d in data), dtype=np.int64, count=len(data))
+        order = np.argsort(lengths, kind='stable')
+        bounds = np.flatnonzero(np.diff(lengths[order])) + 1
+        return [(int(lengths[idx[0]]), idx) for idx in np.split(order, bounds)]
+
+    def _fft_batch(self, data: list, require_sid=False, verbose=False):
+        """
+        FFT batch, one rfft call per group of equal-length sequences
+        """
+        return self._bucket_batch(data, self._fft, require_sid, verbose)
+
     def _fft(self, data: Union[np.ndarray, list]):
         """
-        FFT
+        FFT over the last axis, keeping the non-negative frequencies below Nyquist
         """
+        from scipy.fft import rfft, rfftfreq
         if isinstance(data, list):
             data = np.asarray(data)
         N = data.shape[-1]
-        freq_x = fftshift(fftfreq(N))
-        fft_res = fftshift(fft(data))
+        n_half = (N + 1) // 2
+        freq_x = rfftfreq(N)[:n_half]
+        fft_res = rfft(data, axis=-1, workers=self.workers)[..., :n_half]
         if self.value == 'real':
             sp_x = fft_res.real
         elif self.value == 'imag':
             sp_x = fft_res.imag
         else:
             sp_x = np.abs(fft_res) # equivalent to np.sqrt(fft_res.real**2 + fft_res.imag**2)
-        return freq_x[len(freq_x)//2:], sp_x[len(sp_x)//2:]
+        return freq_x, sp_x
     
     def _create_fft_df(self, freqs, powers, sids=None):
+        import pandas as pd
         if sids is not None:
             df = pd.DataFrame.from_dict({
                 'sid': np.concatenate(sids),
@@ -164,13 +235,12 @@ class FFTProcessor(object):
             })
         return df
     
-    def process(self, input_data: Union[str, list]):
+    def compute(self, input_data: Union[str, list]):
         """
-        Carry out FFT analysis on data stored in input_file
+        Carry out FFT analysis on data stored in input_file, returning per-sequence freqs, powers (and sids)
         """
         if isinstance(input_data, str):
-            data_list = self._read_data(input_data)
-            data = [np.asarray(d) for d in data_list]
+            data = self._read_data(input_data)
         else:
             data = input_data.copy()
 
@@ -180,14 +250,47 @@ class FFTProcessor(object):
         # Compute
         if self.method == 'periodogram':
             freqs, powers, sids = self._periodogram_batch(data, require_sid=self.require_sid, verbose=self.verbose)
-        elif self.method == 'fft':
+        elif self.method == 'welch':
+            freqs, powers, sids = self._bucket_batch(data, self._welch, self.require_sid, self.verbose)
+        elif self.method == 'multitaper':
+            freqs, powers, sids = self._bucket_batch(data, self._multitaper, self.require_sid, self.verbose)
+        else:
             freqs, powers, sids = self._fft_batch(data, require_sid=self.require_sid, verbose=self.verbose)
+        return freqs, powers, sids
+
+    def process(self, input_data: Union[str, list]):
+        """
+        Carry out FFT analysis on data stored in input_file
+        """
+        freqs, powers, sids = self.compute(input_data)
 
         # Collect result 
         df = self._create_fft_df(freqs, powers, sids)
 
         return df
 
+    def process_stream(self, input_file: str, chunk_size: int):
+        """
+        Carry out FFT analysis chunk by chunk, yielding (freqs, powers, sids) with global sequence ids
+        """
+        start = 0
+        for chunk in iter_nll(input_file, chunk_size):
+            freqs, powers, sids = self.compute(chunk)
+            if sids is not None:
+                sids = [sid + start for sid in sids]
+            start += len(chunk)
+            yield freqs, powers, sids
+
+    def meta(self):
+        meta = {'kind': 'spectrum', 'method': self.method, 'preprocess': self.preprocess, 'value': self.value}
+        if self.method == 'periodogram':
+            meta.update(window=self.window)
+        elif self.method == 'welch':
+            meta.update(window=self.window, nperseg=self.nperseg, noverlap=self.noverlap)
+        elif self.method == 'multitaper':
+            meta.update(nw=self.nw, n_tapers=self.n_tapers)
+        return meta
+
 
 def demo():
     fft_processor = FFTProcessor(method='fft', preprocess='none', value='real', require_sid=False)
@@ -204,9 +307,41 @@ def main(args):
                                  preprocess=args.preprocess, 
                                  value=args.value, 
                                  require_sid=args.require_sid,
-                                 verbose=args.verbose)
-    df = fft_processor.process(args.input)
-    df.to_csv(args.output, index=False)
+                                 verbose=args.verbose,
+                                 workers=args.workers,
+                                 window=args.window,
+                                 nperseg=args.nperseg,
+                                 noverlap=args.noverlap,
+                                 nw=args.nw,
+                                 n_tapers=args.n_tapers)
+    if args.chunk_size > 0:
+        main_stream(fft_processor, args)
+    elif args.output.endswith(RAGGED_SUFFIX):
+        freqs, powers, _ = fft_processor.compute(args.input)
+        write_ragged(args.output, {'freq': freqs, 'power': powers},
+                     dtype=spectrum_dtypes(args.output_dtype), meta=fft_processor.meta())
+    else:
+        df = fft_processor.process(args.input)
+        df.to_csv(args.output, index=False)
+
+
+
+def main_stream(fft_processor: FFTProcessor, args):
+    """
+    Bounded-memory mode, only one chunk of sequences and spectra is held at a time
+    """
+    chunks = fft_processor.process_stream(args.input, args.chunk_size)
+    if args.output.endswith(RAGGED_SUFFIX):
+        with RaggedWriter(args.output, fields=('freq', 'power'), dtype=spectrum_dtypes(args.output_dtype),
+                          meta=fft_processor.meta()) as writer:
+            for freqs, powers, _ in chunks:
+                for f, p in zip(freqs, powers):
+                    writer.write(f, p)
+    else:
+        with open(args.output, 'w') as fw:
+            for i, (freqs, powers, sids) in enumerate(chunks):
+                df = fft_processor._create_fft_df(freqs, powers, sids)
+                df.to_csv(fw, header=(i == 0), index=False)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,269 @@
+"""
+Local scoring service that keeps the entropy model loaded between requests
+
+Requests are JSON over HTTP, on a TCP port or a Unix socket:
+    POST /nll      {"texts": [...]}                             -> {"nll": [[...], ...]}
+    POST /spectra  {"texts": [...]}                             -> {"spectra": [{"freq": [...], "power": [...]}, ...]}
+    POST /score    {"texts": [...], "human": [...]}             -> {"scores": {"SO": [...], ...}, "mean": {...}}
+                   {"texts": [...], "reference": "news"}        (spectra loaded at startup with --reference)
+    GET  /health                                                -> model, queue and batching statistics
+The texts of concurrent requests are micro-batched: the first waiting request opens a window of --batch_window
+ms (or until --max_batch_texts texts are queued), and all the texts queued by then go through the model together.
+    python server.py --model_path /models/gpt2 --port 8000 --reference news=human/news.fft.rag
+    curl -s localhost:8000/score -d '{"texts": ["..."], "reference": "news"}'
+    python server.py --custom --model_path /models/mistral-7b --socket /tmp/face.sock
+    curl -s --unix-socket /tmp/face.sock http://localhost/nll -d '{"texts": ["..."]}'
+"""
+import argparse
+import json
+import os
+import queue
+import signal
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from face import METRICS, checkMetrics
+from pipeline import FACEPipeline, NLLEstimator, Spectra
+from run_fft import METHODS, FFTProcessor
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--host', type=str, default='127.0.0.1')
+parser.add_argument('--port', type=int, default=8000)
+parser.add_argument('--socket', type=str, default='', help='listen on this Unix socket instead of --host/--port')
+parser.add_argument('--batch_window', type=float, default=10, help='micro-batching window in milliseconds')
+parser.add_argument('--max_batch_texts', type=int, default=256, help='run a batch as soon as this many texts are queued')
+parser.add_argument('--reference', type=str, nargs='*', default=[],
+                    help='name=path reference spectra (.rag or CSV) loaded at startup, for /score requests')
+# estimator, as pipeline.py
+parser.add_argument('--estimator', type=str, default='gpt2', choices=['gpt2', 'gpt2-medium', 'gpt2-large', 'gpt2-xl'])
+parser.add_argument('--model_path', type=str, default='', help='load the estimator locally if specified')
+parser.add_argument('--custom', action='store_true', help='load --model_path with CustomModel instead of GPT-2')
+parser.add_argument('--backend', type=str, default=None, choices=['fp32', 'bf16', 'int8'])
+parser.add_argument('--max_length', type=int, default=1024)
+parser.add_argument('--max_tokens', type=int, default=8192, help='token budget of the length-sorted batches')
+parser.add_argument('--cache', type=str, default='', help='NLL cache database')
+parser.add_argument('--cache_size', type=int, default=4096, help='maximum size of the NLL cache in MB')
+# spectrum and scores
+parser.add_argument('--method', type=str, default='fft', choices=METHODS)
+parser.add_argument('--preprocess', '-p', type=str, default='none', choices=['none', 'zscore', 'minmax', 'log', 'logzs'])
+parser.add_argument('--value', type=str, default='norm', choices=['norm', 'real', 'imag'])
+parser.add_argument('--metrics', type=str, nargs='+', default=['SO', 'CORR', 'SAM', 'SPEAR'], choices=list(METRICS))
+parser.add_argument('--grid_size', type=int, default=1000, help='number of points of the common frequency grid')
+parser.add_argument('--grid_range', type=float, nargs=2, default=[0, 0.5], help='range of the common frequency grid')
+
+
+class MicroBatcher(object):
+    """
+    Run the NLL estimator on the texts of concurrent submit() calls together, from one worker thread
+    """
+    def __init__(self, estimator, window: float = 0.01, max_texts: int = 256):
+        self.estimator = estimator
+        self.window = window
+        self.max_texts = max_texts
+        self.queue = queue.Queue()
+        self.stats = {'batches': 0, 'requests': 0, 'texts': 0, 'busy': 0.0}
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, texts: list):
+        """
+        Future of the NLLs of texts
+        """
+        future = Future()
+        self.queue.put((list(texts), future))
+        return future
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _collect(self):
+        """
+        The first waiting request, and the requests that arrive within the window after it
+        """
+        first = self.queue.get()
+        if first is None:
+            return None
+        items, n_texts = [first], len(first[0])
+        deadline = time.monotonic() + self.window
+        while n_texts < self.max_texts:
+            timeout = deadline - time.monotonic()
+            try:
+                item = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self.queue.put(None) # stop after this batch
+                break
+            items.append(item)
+            n_texts += len(item[0])
+        return items
+
+    def _run(self):
+        while True:
+            items = self._collect()
+            if items is None:
+                return
+            texts = [text for item_texts, _ in items for text in item_texts]
+            start = time.perf_counter()
+            try:
+                nlls = self.estimator(texts) if len(texts) > 0 else []
+            except Exception as e:
+                for _, future in items:
+                    future.set_exception(e)
+                continue
+            self.stats['busy'] += time.perf_counter() - start
+            self.stats['batches'] += 1
+            self.stats['requests'] += len(items)
+            self.stats['texts'] += len(texts)
+            begin = 0
+            for item_texts, future in items:
+                future.set_result(nlls[begin:begin + len(item_texts)])
+                begin += len(item_texts)
+
+
+def to_json(values):
+    """
+    List of floats, with NaN as null
+    """
+    values = np.asarray(values, dtype=np.float64)
+    return [None if np.isnan(v) else v for v in values.tolist()]
+
+
+class ScoringService(object):
+    """
+    The endpoints, independent of the transport
+    """
+    def __init__(self, pipeline: FACEPipeline, batcher: MicroBatcher, references: dict = None):
+        self.pipeline = pipeline
+        self.batcher = batcher
+        self.references = references or {}
+
+    def nll(self, texts: list):
+        return self.batcher.submit(texts).result()
+
+    def handle(self, path: str, request: dict):
+        if path not in ('/nll', '/spectra', '/score'):
+            raise KeyError(path)
+        texts = request.get('texts')
+        if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+            raise ValueError('"texts" must be a list of strings')
+        if path == '/nll':
+            return {'nll': [to_json(x) for x in self.nll(texts)]}
+        if path == '/spectra':
+            # one entry per text, empty for the texts without any NLL
+            nlls = self.nll(texts)
+            spectra = iter(zip(*self.pipeline.spectra(nlls).split()))
+            return {'spectra': [dict(zip(('freq', 'power'), map(to_json, next(spectra)))) if len(x) > 0
+                                else {'freq': [], 'power': []} for x in nlls]}
+        if path == '/score':
+            if 'reference' in request:
+                if request['reference'] not in self.references:
+                    raise ValueError(f'Unknown reference: {request["reference"]}. Loaded: {list(self.references)}')
+                human = self.references[request['reference']]
+            elif isinstance(request.get('human'), list):
+                human = self.pipeline.spectra(self.nll(request['human']))
+            else:
+                raise ValueError('/score requires "human" texts or a "reference" name')
+            scores = self.pipeline.score(human, self.pipeline.spectra(self.nll(texts)))
+            return {'scores': {name: to_json(values) for name, values in scores.items()},
+                    'mean': {name: to_json([np.nanmean(values) if np.isfinite(values).any() else np.nan])[0]
+                             for name, values in scores.items()}}
+
+    def health(self):
+        stats = dict(self.batcher.stats)
+        stats['mean_batch_texts'] = stats['texts'] / max(stats['batches'], 1)
+        return {'status': 'ok', 'queued': self.batcher.queue.qsize(), 'references': list(self.references),
+                'stats': stats}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self, code: int, body: dict):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._reply(200, self.server.service.health())
+        else:
+            self._reply(404, {'error': f'Unknown endpoint: {self.path}'})
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length) or b'{}')
+            self._reply(200, self.server.service.handle(self.path, request))
+        except KeyError:
+            self._reply(404, {'error': f'Unknown endpoint: {self.path}'})
+        except (ValueError, TypeError) as e:
+            self._reply(400, {'error': str(e)})
+        except Exception as e:
+            self._reply(500, {'error': f'{type(e).__name__}: {e}'})
+
+    def address_string(self):
+        # Unix socket clients have no (host, port) address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service: ScoringService, host: str = '127.0.0.1', port: int = 8000, socket_path: str = ''):
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, RequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.service = service
+    return server
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def main(args):
+    checkMetrics(args.metrics)
+    estimator = NLLEstimator(model=args.estimator, model_path=args.model_path, custom=args.custom,
+                             backend=args.backend, max_length=args.max_length, max_tokens=args.max_tokens,
+                             cache=args.cache, cache_size=args.cache_size)
+    fft_processor = FFTProcessor(method=args.method, preprocess=args.preprocess, value=args.value,
+                                 require_sid=False)
+    pipeline = FACEPipeline(estimator, fft_processor, metrics=args.metrics,
+                            grid_size=args.grid_size, grid_range=args.grid_range)
+    references = {}
+    for entry in args.reference:
+        name, path = entry.split('=', 1)
+        references[name] = Spectra.load(path)
+        references[name].on_grid(args.grid_size, args.grid_range) # interpolated once, before the first request
+    batcher = MicroBatcher(estimator, window=args.batch_window / 1000, max_texts=args.max_batch_texts)
+    server = make_server(ScoringService(pipeline, batcher, references), args.host, args.port, args.socket)
+    signal.signal(signal.SIGTERM, _interrupt) # shut down cleanly, removing the socket
+    print(f'Serving on {args.socket or f"http://{args.host}:{args.port}"}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        if estimator.cache is not None:
+            estimator.cache.close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
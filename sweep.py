@@ -0,0 +1,326 @@
+"""
+Incremental evaluation sweeps over models x domains x split files, driven by a JSON file in configs/
+
+The sweep is a dependency graph of stages, each one a run of a cli.py command:
+    texts --entropy--> NLLs --fft--> spectra --score--> per-pair scores of a (model, domain) --> summary.csv
+An input file enters the graph at the stage given by its name: *.fft.rag / *.fft.csv / *.fft.txt are spectra,
+*.nll / *.nll.txt / *.nll.rag are NLLs, and anything else is texts (one per line). A stage is skipped if its
+output exists and was produced with the same fingerprint: the command, its parameters and the fingerprints of
+its inputs (size and modification time for source files, the producing stage's fingerprint for generated
+ones), so changing a parameter or an input reruns exactly the stages downstream of it. Independent stages run
+concurrently, each in its own process.
+    python sweep.py configs/sweep_example.json --jobs 8
+The config names the human reference and model inputs per domain, as path patterns with {domain} and globs
+(split files are ordered naturally and concatenated for scoring), and the options of each stage:
+    {
+        "output_dir": "sweeps/example",
+        "domains": ["news", "story", "wiki"],
+        "human": "data/demo_human.nll.txt",
+        "models": {"opt-125m": "data/opt-125m/{domain}_split/*.split.*.nll",
+                   "opt-6.7b": "data/opt-6.7b/{domain}_split/*.split.*.nll"},
+        "entropy": {"command": "entropy-batch", "args": ["--max_tokens", "8192"], "jobs": 1},
+        "fft": {"args": ["--method", "fft"]},
+        "score": {"args": ["--metrics", "SO", "CORR", "SAM", "SPEAR"]}
+    }
+This is configs/sweep_example.json, which runs on the files of the repository. Its inputs are NLLs, so the entropy
+stage is not used; with texts, e.g. "human": "data/human/{domain}.txt", the "entropy" options apply, and they may
+point --config to a model config, e.g. "args": ["--config", "configs/gpt2_config.json"].
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from leaderboard import natural_key
+
+CLI = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cli.py')
+NLL_SUFFIXES = ('.nll', '.nll.txt', '.nll.rag')
+SPECTRUM_SUFFIXES = ('.fft.rag', '.fft.csv', '.fft.txt')
+
+parser = argparse.ArgumentParser()
+parser.add_argument('config', type=str, help='sweep configuration (JSON)')
+parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1, help='number of stages run at once')
+parser.add_argument('--dry_run', '-n', action='store_true', help='only print the stages that would run')
+parser.add_argument('--force', action='store_true', help='rerun every stage, even if up to date')
+
+
+class Stage(object):
+    """
+    One node of the graph: a cli.py command producing output from the outputs of deps and the source files
+    """
+    def __init__(self, kind: str, output: str, args: list, deps: list = (), sources: list = (), params=None):
+        self.kind = kind
+        self.output = output
+        self.args = list(args)
+        self.deps = list(deps)
+        self.sources = list(sources)
+        self.params = params
+        self.fingerprint = None
+
+    def command(self):
+        return [sys.executable, CLI] + self.args
+
+
+def source_fingerprint(path: str):
+    st = os.stat(path)
+    return [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+
+
+def fingerprint(stage: Stage):
+    """
+    Hash of the command, its parameters and the fingerprints of its inputs, computed once per stage
+    """
+    if stage.fingerprint is None:
+        key = {'kind': stage.kind, 'args': stage.args, 'params': stage.params,
+               'deps': [fingerprint(dep) for dep in stage.deps],
+               'sources': [source_fingerprint(path) for path in stage.sources]}
+        stage.fingerprint = hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+    return stage.fingerprint
+
+
+def strip_suffix(path: str):
+    name = os.path.basename(path)
+    for suffix in SPECTRUM_SUFFIXES + NLL_SUFFIXES + ('.txt',):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return os.path.splitext(name)[0]
+
+
+def file_sources(args: list):
+    """
+    The arguments that name existing files (e.g. --config), whose content is an input of the stage
+    """
+    return [arg for arg in args if isinstance(arg, str) and os.path.isfile(arg)]
+
+
+def work_key(stage: Stage):
+    """
+    What a stage computes, regardless of where its output goes: the command and parameters with the output path
+    left out, its (already deduplicated) dependencies and its source files
+    """
+    key = {'kind': stage.kind, 'args': [None if arg == stage.output else arg for arg in stage.args],
+           'params': stage.params, 'deps': [dep.output for dep in stage.deps], 'sources': stage.sources}
+    return json.dumps(key, sort_keys=True)
+
+
+class SweepGraph(object):
+    """
+    The stages of a sweep config, deduplicated by output path and by the work they do
+    """
+    def __init__(self, config: dict):
+        self.config = config
+        self.output_dir = config.get('output_dir', 'sweeps')
+        self.stages = {}
+        self.by_work = {}
+
+    def add(self, stage: Stage):
+        key = work_key(stage)
+        if key in self.by_work:
+            return self.by_work[key]
+        if stage.output not in self.stages:
+            self.stages[stage.output] = stage
+            self.by_work[key] = stage
+        return self.stages[stage.output]
+
+    def spectrum_stage(self, name: str, domain: str, path: str):
+        """
+        Stage producing the spectra of one input file (None if the file already holds spectra), under
+        <output_dir>/<name>/<domain>/, or <output_dir>/<name>/ for an input shared by all domains
+        """
+        if path.endswith(SPECTRUM_SUFFIXES):
+            return None
+        out_dir = os.path.join(self.output_dir, name, domain) if domain else os.path.join(self.output_dir, name)
+        stem = strip_suffix(path)
+        nll_stage, nll_path = None, path
+        if not path.endswith(NLL_SUFFIXES):
+            entropy = self.config.get('entropy', {})
+            nll_path = os.path.join(out_dir, stem + '.nll.rag')
+            options = [str(arg) for arg in entropy.get('args', [])]
+            args = [entropy.get('command', 'entropy-batch'), '--input', path, '--output', nll_path] + options
+            nll_stage = self.add(Stage('entropy', nll_path, args, sources=[path] + file_sources(options)))
+        options = [str(arg) for arg in self.config.get('fft', {}).get('args', [])]
+        fft_path = os.path.join(out_dir, stem + '.fft.rag')
+        args = ['fft', '--input', nll_path, '--output', fft_path] + options
+        return self.add(Stage('fft', fft_path, args, deps=[nll_stage] if nll_stage else [],
+                              sources=([] if nll_stage else [path]) + file_sources(options)))
+
+    def spectrum_inputs(self, name: str, domain: str, pattern: str):
+        """
+        (stages, spectrum paths, source files) of the files matching pattern for domain, in natural order
+        """
+        paths = sorted(glob.glob(pattern.format(domain=domain)), key=natural_key)
+        if len(paths) == 0:
+            raise FileNotFoundError(f'No file matches {pattern.format(domain=domain)} ({name}, {domain})')
+        stages, outputs, sources = [], [], []
+        # a pattern without {domain} is shared by all the domains, and its spectra computed once
+        shared = '{domain}' not in pattern
+        for path in paths:
+            stage = self.spectrum_stage(name, '' if shared else domain, path)
+            if stage is None:
+                outputs.append(path)
+                sources.append(path)
+            else:
+                outputs.append(stage.output)
+                stages.append(stage)
+        return stages, outputs, sources
+
+    def build(self):
+        options = [str(arg) for arg in self.config.get('score', {}).get('args', [])]
+        score_stages = []
+        for domain in self.config.get('domains', ['']):
+            human_stages, human_paths, human_sources = self.spectrum_inputs('human', domain, self.config['human'])
+            for model, pattern in self.config['models'].items():
+                stages, paths, sources = self.spectrum_inputs(model, domain, pattern)
+                output = os.path.join(self.output_dir, model, f'{domain or model}.scores.csv')
+                args = ['score', '--human'] + human_paths + ['--model'] + paths + ['--output', output] + options
+                score_stages.append(self.add(Stage('score', output, args, deps=human_stages + stages,
+                                                   sources=human_sources + sources + file_sources(options),
+                                                   params={'model': model, 'domain': domain})))
+        summary = os.path.join(self.output_dir, 'summary.csv')
+        self.add(Stage('summary', summary, [], deps=score_stages))
+        return self
+
+
+def write_summary(stage: Stage):
+    """
+    Mean, std and count of every metric of every (model, domain), from the per-pair score files
+    """
+    import pandas as pd
+    rows = []
+    for dep in stage.deps:
+        df = pd.read_csv(dep.output)
+        for metric in df.columns:
+            rows.append({'model': dep.params['model'], 'domain': dep.params['domain'], 'metric': metric,
+                         'mean': df[metric].mean(), 'std': df[metric].std(), 'count': int(df[metric].count())})
+    tmp_path = stage.output + '.tmp'
+    pd.DataFrame(rows, columns=['model', 'domain', 'metric', 'mean', 'std', 'count']).to_csv(tmp_path, index=False)
+    os.replace(tmp_path, stage.output)
+
+
+def run_stage(stage: Stage, log_dir: str):
+    """
+    Run one stage (in a subprocess, except the summary), its output going to a log file
+    """
+    os.makedirs(os.path.dirname(stage.output) or '.', exist_ok=True)
+    if stage.kind == 'summary':
+        write_summary(stage)
+        return
+    name = os.path.relpath(stage.output, os.path.dirname(log_dir)).replace(os.sep, '__')
+    log_path = os.path.join(log_dir, name + '.log')
+    with open(log_path, 'w') as log:
+        log.write(' '.join(stage.command()) + '\n')
+        log.flush()
+        result = subprocess.run(stage.command(), stdout=log, stderr=subprocess.STDOUT)
+    if result.returncode != 0:
+        raise RuntimeError(f'exit code {result.returncode}, see {log_path}')
+
+
+class SweepRunner(object):
+    """
+    Run the out-of-date stages of a graph, each as soon as its dependencies are done, with at most jobs
+    stages at once (and at most the "jobs" of a stage kind in the config, e.g. one model-loading stage per GPU)
+    """
+    def __init__(self, graph: SweepGraph, jobs: int = 1, force: bool = False):
+        if jobs < 1:
+            raise ValueError(f'jobs must be at least 1, got {jobs}')
+        self.graph = graph
+        self.jobs = jobs
+        self.force = force
+        self.state_path = os.path.join(graph.output_dir, '.sweep_state.json')
+        self.state = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path, 'r') as f:
+                self.state = json.load(f)
+        self.limits = {kind: graph.config.get(kind, {}).get('jobs', jobs) for kind in ('entropy', 'fft', 'score')}
+        for kind, limit in self.limits.items():
+            if not isinstance(limit, int) or limit < 1:
+                raise ValueError(f'"jobs" of {kind} must be an integer of at least 1, got {limit}')
+
+    def up_to_date(self, stage: Stage):
+        return not self.force and os.path.exists(stage.output) and self.state.get(stage.output) == fingerprint(stage)
+
+    def save_state(self):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.state_path)
+
+    def plan(self):
+        """
+        The stages to run: out of date, or downstream of a stage that runs
+        """
+        todo = set()
+        for output, stage in self.graph.stages.items(): # insertion order is a topological order
+            if not self.up_to_date(stage) or any(dep.output in todo for dep in stage.deps):
+                todo.add(output)
+        return [stage for output, stage in self.graph.stages.items() if output in todo]
+
+    def run(self, dry_run: bool = False):
+        todo = self.plan()
+        n_skipped = len(self.graph.stages) - len(todo)
+        print(f'{len(self.graph.stages)} stages, {n_skipped} up to date, {len(todo)} to run')
+        if dry_run:
+            for stage in todo:
+                print(f'{stage.kind:>8}  {stage.output}')
+            return []
+        os.makedirs(self.graph.output_dir, exist_ok=True)
+        log_dir = os.path.join(self.graph.output_dir, 'logs')
+        os.makedirs(log_dir, exist_ok=True)
+        pending = {stage.output: stage for stage in todo}
+        todo = set(pending)
+        done, failed, running = set(), [], {} # running: future -> output
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            while pending or running:
+                # a stage whose dependency failed is skipped, and so are its own dependents
+                for output, stage in list(pending.items()):
+                    if any(dep.output in pending or dep.output in running.values() for dep in stage.deps):
+                        continue
+                    if any(dep.output in todo and dep.output not in done for dep in stage.deps):
+                        failed.append((stage, 'dependency failed'))
+                        del pending[output]
+                        continue
+                    n_kind = sum(1 for s in running.values() if self.graph.stages[s].kind == stage.kind)
+                    if len(running) < self.jobs and n_kind < self.limits.get(stage.kind, self.jobs):
+                        print(f'[{time.time() - start:7.1f}s] start {stage.kind} {stage.output}')
+                        running[pool.submit(run_stage, stage, log_dir)] = output
+                        del pending[output]
+                if not running:
+                    continue
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = self.graph.stages[running.pop(future)]
+                    try:
+                        future.result()
+                    except Exception as e:
+                        failed.append((stage, str(e)))
+                        print(f'[{time.time() - start:7.1f}s] FAILED {stage.kind} {stage.output}: {e}')
+                        continue
+                    done.add(stage.output)
+                    self.state[stage.output] = fingerprint(stage)
+                    self.save_state()
+                    print(f'[{time.time() - start:7.1f}s] done  {stage.kind} {stage.output}')
+        print(f'{len(done)} stages run, {len(failed)} failed or skipped, in {time.time() - start:.1f}s')
+        return failed
+
+
+def main(args):
+    with open(args.config, 'r') as f:
+        config = json.load(f)
+    graph = SweepGraph(config).build()
+    failed = SweepRunner(graph, jobs=args.jobs, force=args.force).run(dry_run=args.dry_run)
+    if len(failed) > 0:
+        for stage, reason in failed:
+            print(f'{stage.kind} {stage.output}: {reason}', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error(f'--jobs must be at least 1, got {args.jobs}')
+    main(args)
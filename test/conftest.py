@@ -0,0 +1,34 @@
+"""
+Shared fixtures; the scripts are top-level modules, so the repository root is put on the path
+"""
+import json
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def tiny_gpt2(tmp_path_factory):
+    """
+    Directory of a randomly initialized 2-layer GPT-2 with a byte-level tokenizer (no merges), saved as
+    --model_path expects it; no download is needed
+    """
+    torch = pytest.importorskip('torch')
+    transformers = pytest.importorskip('transformers')
+    from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+    path = tmp_path_factory.mktemp('tiny_gpt2')
+    vocab = {char: i for i, char in enumerate(sorted(bytes_to_unicode().values()))}
+    vocab['<|endoftext|>'] = len(vocab)
+    with open(path / 'vocab.json', 'w') as f:
+        json.dump(vocab, f)
+    with open(path / 'merges.txt', 'w') as f:
+        f.write('#version: 0.2\n')
+    tokenizer = transformers.GPT2Tokenizer(str(path / 'vocab.json'), str(path / 'merges.txt'))
+    tokenizer.save_pretrained(str(path))
+    torch.manual_seed(0)
+    config = transformers.GPT2Config(vocab_size=len(vocab), n_positions=256, n_embd=32, n_layer=2, n_head=2,
+                                     bos_token_id=len(vocab) - 1, eos_token_id=len(vocab) - 1)
+    transformers.GPT2LMHeadModel(config).eval().save_pretrained(str(path))
+    return str(path)
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+transformers = pytest.importorskip('transformers')
+from backends import BACKENDS, apply_backend, conv1d_to_linear
+
+TEXT = 'The quick brown fox jumps over the lazy dog, and then it runs back into the woods.'
+
+
+def nll(model, input_ids):
+    logits = model(input_ids).logits[0, :-1].float()
+    return -torch.log_softmax(logits, dim=-1).gather(-1, input_ids[0, 1:, None]).squeeze(-1)
+
+
+@torch.no_grad()
+def test_conv1d_to_linear(tiny_gpt2):
+    model = transformers.GPT2LMHeadModel.from_pretrained(tiny_gpt2).eval()
+    input_ids = transformers.GPT2Tokenizer.from_pretrained(tiny_gpt2)(TEXT, return_tensors='pt')['input_ids']
+    expected = model(input_ids).logits
+    conv1d_to_linear(model)
+    assert not any(type(m).__name__ == 'Conv1D' for m in model.modules())
+    torch.testing.assert_close(model(input_ids).logits, expected, rtol=1e-5, atol=1e-5)
+
+
+@torch.no_grad()
+@pytest.mark.parametrize('backend, tol', [('fp32', 1e-5), ('bf16', 0.1), ('int8', 0.1)])
+def test_backends_close_to_fp32(tiny_gpt2, backend, tol):
+    model = transformers.GPT2LMHeadModel.from_pretrained(tiny_gpt2).eval()
+    input_ids = transformers.GPT2Tokenizer.from_pretrained(tiny_gpt2)(TEXT, return_tensors='pt')['input_ids']
+    expected = nll(model, input_ids)
+    model = apply_backend(model, backend)
+    assert model(input_ids).logits.dtype == torch.float32
+    torch.testing.assert_close(nll(model, input_ids), expected, rtol=tol, atol=tol)
+
+
+@torch.no_grad()
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_custom_model_backends(tiny_gpt2, backend):
+    pytest.importorskip('modelscope')
+    from model import CustomModel
+    custom = CustomModel(tiny_gpt2, backend=backend)
+    # the LM head shortcut still applies after the conversion
+    assert custom.plain_lm_head
+    _, expected = custom.forward(TEXT)
+    np.testing.assert_allclose(custom.nll(TEXT).numpy(), expected.numpy(), rtol=1e-4, atol=1e-4)
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        apply_backend(torch.nn.Linear(2, 2), 'fp8')
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+from run_entropy_batch import create_parser, load_model, make_token_batches, padding_efficiency, process, process_sorted
+from ragged import read_nll
+
+TEXTS = ['The quick brown fox jumps over the lazy dog.', 'Hello world', 'a', '', 'Spectra of language',
+         'A somewhat longer line of text, so that the batches are padded differently.', 'abc abc abc']
+
+
+def test_token_batches():
+    lengths = [5, 1, 9, 0, 3, 3, 12]
+    batches = make_token_batches(lengths, max_tokens=10)
+    assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+    for batch in batches:
+        longest = max(lengths[i] for i in batch)
+        assert lengths[batch[0]] == longest
+        assert len(batch) == 1 or len(batch) * longest <= 10
+    assert [len(batch) for batch in batches if 12 in [lengths[i] for i in batch]] == [1] # longer than the budget
+    assert padding_efficiency(lengths, [[i] for i in range(len(lengths))]) == 1.0
+    assert padding_efficiency(lengths, [list(range(len(lengths)))]) == sum(lengths) / (12 * len(lengths))
+    assert padding_efficiency(lengths, batches) >= padding_efficiency(lengths, [[0, 1, 2], [3, 4, 5], [6]])
+
+
+def test_sorted_batches_equal_fixed_batches(tmp_path, tiny_gpt2):
+    path = tmp_path / 'x.txt'
+    path.write_text('\n'.join(TEXTS) + '\n')
+    args = create_parser().parse_args(['-i', str(path), '-o', str(tmp_path / 'fixed.nll'), '-bs', '3'])
+    args.model = tiny_gpt2 # a local directory, as load_model accepts
+    model, tokenizer = load_model(args)
+    process(model, tokenizer, args)
+    args.output, args.max_tokens = str(tmp_path / 'sorted.nll'), 64
+    process_sorted(model, tokenizer, args)
+    fixed = read_nll(str(tmp_path / 'fixed.nll'), keep_empty=True)
+    assert len(fixed) == len(TEXTS)
+    for x, y in zip(fixed, read_nll(str(tmp_path / 'sorted.nll'), keep_empty=True)):
+        np.testing.assert_allclose(x, y, atol=2e-4)
+
+
+def test_custom_model_batches(tmp_path, tiny_gpt2, capsys):
+    pytest.importorskip('modelscope')
+    from run_entropy_batch import process_custom
+    path = tmp_path / 'x.txt'
+    path.write_text('\n'.join(TEXTS) + '\n')
+    args = create_parser().parse_args(['-i', str(path), '-o', str(tmp_path / 'fixed.nll'), '-bs', '3',
+                                       '--model_path', tiny_gpt2])
+    process_custom(args)
+    args.output, args.max_tokens = str(tmp_path / 'sorted.nll'), 64
+    process_custom(args)
+    assert 'padding efficiency' in capsys.readouterr().out
+    fixed = read_nll(str(tmp_path / 'fixed.nll'), keep_empty=True)
+    assert len(fixed) == len(TEXTS)
+    for x, y in zip(fixed, read_nll(str(tmp_path / 'sorted.nll'), keep_empty=True)):
+        np.testing.assert_allclose(x, y, rtol=0.02, atol=0.02)
+
+
+def test_cached_rerun(tmp_path, tiny_gpt2):
+    # the cache is opened on the main thread and filled by the writer thread of the pipeline
+    path = tmp_path / 'x.txt'
+    path.write_text('\n'.join(TEXTS) + '\n')
+    args = create_parser().parse_args(['-i', str(path), '-o', str(tmp_path / 'first.nll'), '-bs', '3',
+                                       '--cache', str(tmp_path / 'cache.db')])
+    args.model = tiny_gpt2
+    model, tokenizer = load_model(args)
+    process(model, tokenizer, args)
+    args.output = str(tmp_path / 'second.nll')
+    process(model, tokenizer, args)
+    with open(tmp_path / 'first.nll') as f1, open(tmp_path / 'second.nll') as f2:
+        assert f1.read() == f2.read()
@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+import pytest
+import bootstrap
+import run_fft
+
+
+@pytest.mark.parametrize('exact_limit', [10 ** 8, 0])
+def test_bootstrap_ci_covers_mean(exact_limit):
+    values = np.random.default_rng(0).normal(1.0, 2.0, size=4000)
+    mean, low, high = bootstrap.bootstrap_ci(values, 2000, rng=1, exact_limit=exact_limit)
+    # the standard error of the mean is 2 / sqrt(4000)
+    assert low < mean < high
+    np.testing.assert_allclose(high - low, 2 * 1.96 * values.std() / np.sqrt(len(values)), rtol=0.1)
+
+
+def test_binned_means_match_exact():
+    values = np.random.default_rng(0).gamma(2.0, 1.0, size=3000)
+    exact = bootstrap.bootstrap_means(values, 4000, rng=1)
+    binned = bootstrap.bootstrap_means(values, 4000, rng=1, exact_limit=0)
+    np.testing.assert_allclose([binned.mean(), binned.std()], [exact.mean(), exact.std()], rtol=0.05)
+
+
+def test_non_finite_values_are_dropped():
+    assert bootstrap.bootstrap_ci([1.0, np.nan, 1.0, np.inf], 100)[:] == (1.0, 1.0, 1.0)
+    assert np.isnan(bootstrap.bootstrap_ci([np.nan], 100)[0])
+
+
+@pytest.mark.parametrize('test', [bootstrap.permutation_test, bootstrap.sign_flip_test])
+@pytest.mark.parametrize('exact_limit', [10 ** 8, 0])
+def test_p_values(test, exact_limit):
+    rng = np.random.default_rng(0)
+    values = rng.normal(size=2000)
+    shifted = values + 0.3 + 0.1 * rng.normal(size=2000)
+    diff, p_value = test(values, shifted, 999, rng=1, exact_limit=exact_limit)
+    assert diff < 0 and p_value == 1 / 1000
+    _, p_value = test(values, rng.permutation(values), 999, rng=1, exact_limit=exact_limit)
+    assert p_value > 0.05
+
+
+def test_seeded_summary():
+    df = pd.DataFrame({'SO': np.linspace(0, 1, 50), 'SAM': np.linspace(0, 0.5, 50)})
+    first = bootstrap.summarize(df, df * 1.1, n_resamples=500, seed=3)
+    second = bootstrap.summarize(df, df * 1.1, n_resamples=500, seed=3)
+    pd.testing.assert_frame_equal(first, second)
+    assert list(first.columns) == ['mean', 'low', 'high', 'mean2', 'low2', 'high2', 'diff', 'p_value']
+
+
+def test_human_vs_model(tmp_path, capsys):
+    rng = np.random.default_rng(0)
+    for name, amplitude in [('human', 0.0), ('model', 2.0)]:
+        # the model NLLs have a period of 5 tokens, the human ones are white noise
+        nlls = [2 + amplitude * np.sin(0.4 * np.pi * np.arange(80)) + rng.normal(size=80) for _ in range(30)]
+        (tmp_path / f'{name}.nll.txt').write_text('\n'.join(' '.join(f'{x:.4f}' for x in nll) for nll in nlls) + '\n')
+        run_fft.main(run_fft.parser.parse_args(['-i', str(tmp_path / f'{name}.nll.txt'),
+                                                '-o', str(tmp_path / f'{name}.fft.txt')]))
+    model_scores, human_scores = bootstrap.human_model_scores(str(tmp_path / 'human.fft.txt'),
+                                                              str(tmp_path / 'model.fft.txt'), ['SAM'])
+    assert len(model_scores) == len(human_scores) == 30
+    assert human_scores['SAM'].mean() < model_scores['SAM'].mean()
+    args = bootstrap.parser.parse_args(['--human', str(tmp_path / 'human.fft.txt'), '--model',
+                                        str(tmp_path / 'model.fft.txt'), '--metrics', 'SAM', '--paired',
+                                        '--n_resamples', '999', '-o', str(tmp_path / 'ci.csv')])
+    bootstrap.main(args)
+    result = pd.read_csv(tmp_path / 'ci.csv', index_col='metric')
+    assert result.loc['SAM', 'p_value'] < 0.01
+
+
+def test_scores_or_spectra():
+    with pytest.raises(ValueError):
+        bootstrap.main(bootstrap.parser.parse_args(['--human', 'human.fft.txt']))
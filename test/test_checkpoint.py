@@ -0,0 +1,91 @@
+import os
+import numpy as np
+import pytest
+from checkpoint import CheckpointedNLLWriter
+from ragged import read_nll, read_ragged
+
+NLLS = [np.round(np.random.default_rng(i).gamma(2.0, 1.0, size=i % 4 + 1), 4) for i in range(10)]
+
+
+def crash(fw):
+    # an interrupted run: the records after the last checkpoint are on disk, the last one torn
+    fw._journal.write(b'9\t1.0 2.')
+    fw._journal.flush()
+    fw._journal.close()
+
+
+@pytest.mark.parametrize('suffix', ['.nll', '.nll.rag'])
+def test_resume(tmp_path, suffix):
+    output = str(tmp_path / ('out' + suffix))
+    fw = CheckpointedNLLWriter(output, range(10), input_file='in.txt', every=3)
+    for i in range(7):
+        fw.write(i, NLLS[i])
+    crash(fw)
+    fw = CheckpointedNLLWriter(output, range(10), input_file='in.txt', every=3)
+    assert fw.done == set(range(6)) # checkpoints after 3 and 6 lines, line 6 is recomputed
+    for i in reversed(range(6, 10)): # in any order
+        fw.write(i, NLLS[i])
+    fw.finalize()
+    assert not os.path.exists(output + '.journal') and not os.path.exists(output + '.ckpt')
+    data = read_nll(output)
+    assert len(data) == 10
+    for x, y in zip(data, NLLS):
+        np.testing.assert_allclose(x, y, rtol=1e-6)
+    if suffix.endswith('.rag'):
+        assert len(read_ragged(output)) == 10
+
+
+def test_journal_without_checkpoint_is_discarded(tmp_path):
+    output = str(tmp_path / 'out.nll')
+    fw = CheckpointedNLLWriter(output, range(10), every=100)
+    fw.write(0, NLLS[0])
+    crash(fw)
+    assert CheckpointedNLLWriter(output, range(10), every=100).done == set()
+
+
+def test_checkpoint_of_another_input(tmp_path):
+    output = str(tmp_path / 'out.nll')
+    fw = CheckpointedNLLWriter(output, range(10), input_file='a.txt', every=1)
+    fw.write(0, NLLS[0])
+    crash(fw)
+    with pytest.raises(ValueError):
+        CheckpointedNLLWriter(output, range(10), input_file='b.txt')
+
+
+def test_missing_lines(tmp_path):
+    fw = CheckpointedNLLWriter(str(tmp_path / 'out.nll'), range(3))
+    fw.write(0, NLLS[0])
+    with pytest.raises(RuntimeError):
+        fw.finalize()
+
+
+@pytest.mark.parametrize('suffix', ['.nll', '.nll.rag'])
+def test_finished_output_is_skipped(tmp_path, suffix):
+    source, output = tmp_path / 'in.txt', str(tmp_path / ('out' + suffix))
+    source.write_text('texts\n')
+    fw = CheckpointedNLLWriter(output, range(10), input_file=str(source), meta={'model': 'gpt2'})
+    for i in range(10):
+        fw.write(i, NLLS[i])
+    fw.finalize()
+    with open(output, 'rb') as f:
+        finished = f.read()
+    fw = CheckpointedNLLWriter(output, range(10), input_file=str(source), meta={'model': 'gpt2'})
+    assert fw.complete and fw.done == set(range(10))
+    fw.finalize()
+    with open(output, 'rb') as f:
+        assert f.read() == finished
+    assert sorted(os.listdir(tmp_path)) == sorted(['in.txt', os.path.basename(output)])
+    # another number of lines, a newer input or (for .rag) another model is recomputed
+    def restarts(indices, model='gpt2'):
+        fw = CheckpointedNLLWriter(output, indices, input_file=str(source), meta={'model': model})
+        if fw.complete:
+            return False
+        fw._journal.close()
+        os.remove(output + '.journal')
+        return True
+    assert restarts(range(11))
+    if suffix.endswith('.rag'):
+        assert restarts(range(10), model='opt')
+    assert not restarts(range(10))
+    os.utime(source, (os.path.getmtime(output) + 10,) * 2)
+    assert restarts(range(10))
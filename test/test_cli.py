@@ -0,0 +1,47 @@
+import os
+import subprocess
+import sys
+import pytest
+import cli
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ['torch', 'transformers', 'pandas', 'scipy', 'modelscope']
+
+
+def loaded_modules(command):
+    # import the command's module and parse --help in a fresh interpreter, then list the heavy modules loaded
+    code = (f'import sys, cli\n'
+            f'try:\n    cli.main({command!r})\nexcept SystemExit:\n    pass\n'
+            f'print(sorted(m for m in {HEAVY!r} if m in sys.modules), file=sys.stderr)')
+    result = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr
+    return eval(result.stderr.strip().splitlines()[-1]), result.stdout
+
+
+@pytest.mark.parametrize('command', ['entropy', 'entropy-batch', 'fft', 'score', 'pipeline', 'leaderboard',
+                                     'bootstrap', 'serve', 'backends', 'convert'])
+def test_help_does_not_load_torch(command):
+    loaded, stdout = loaded_modules([command, '--help'])
+    assert f'usage: face {command}' in stdout
+    assert 'torch' not in loaded and 'transformers' not in loaded and 'modelscope' not in loaded
+
+
+def test_usage(capsys):
+    assert cli.main(['--help']) == 0
+    out = capsys.readouterr().out
+    assert all(name in out for name in cli.COMMANDS)
+    assert cli.main(['train']) == 2
+    assert 'unknown command train' in capsys.readouterr().err
+
+
+def test_score_ragged_spectra_without_scipy(tmp_path):
+    import numpy as np
+    from ragged import write_ragged
+    rng = np.random.default_rng(0)
+    for name in ['human', 'model']:
+        write_ragged(str(tmp_path / f'{name}.fft.rag'), {'freq': [np.linspace(0, 0.5, 20)] * 4,
+                                                         'power': [rng.gamma(2.0, 1.0, 20) for _ in range(4)]})
+    loaded, _ = loaded_modules(['score', '--human', str(tmp_path / 'human.fft.rag'), '--model',
+                                str(tmp_path / 'model.fft.rag'), '--metrics', 'SO', 'CORR', '--output', str(tmp_path / 'scores.csv')])
+    assert loaded in ([], ['pandas']) # pandas only writes the CSV output
+    assert (tmp_path / 'scores.csv').exists()
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('modelscope')
+from model import CustomModel, chunked_nll
+
+TEXTS = ['The quick brown fox jumps over the lazy dog.', 'Hello world', 'a',
+         'A somewhat longer line of text, so that the batch is padded.']
+
+
+@pytest.fixture(scope='module')
+def custom(tiny_gpt2):
+    return CustomModel(tiny_gpt2)
+
+
+def reference_nll(custom, text):
+    # one text alone, no padding
+    token_ids = custom.tokenizer(text, return_tensors='pt')['input_ids'].to(custom.model.device)
+    logits = custom.model(token_ids)['logits'][0].to(torch.float32)
+    log_probs = torch.log_softmax(logits[:-1], dim=-1)
+    return -log_probs.gather(-1, token_ids[0, 1:, None]).squeeze(-1).cpu().numpy()
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 100])
+def test_chunked_nll(chunk_size):
+    torch.manual_seed(0)
+    hidden, lm_head = torch.randn(17, 8), torch.nn.Linear(8, 50)
+    targets = torch.randint(0, 50, (17,))
+    expected = -torch.log_softmax(lm_head(hidden), dim=-1).gather(-1, targets[:, None]).squeeze(-1)
+    torch.testing.assert_close(chunked_nll(hidden, lm_head, targets, chunk_size), expected)
+
+
+def test_forward_and_nll(custom):
+    assert custom.plain_lm_head
+    for text in TEXTS:
+        logits, nlls = custom.forward(text)
+        n_tokens = len(custom.tokenizer(text)['input_ids'])
+        assert logits.shape == (n_tokens, len(custom.tokenizer)) and logits.dtype == torch.float32
+        np.testing.assert_allclose(nlls.numpy(), reference_nll(custom, text), rtol=1e-5, atol=1e-5)
+        np.testing.assert_allclose(custom.nll(text).numpy(), nlls.numpy(), rtol=0.02, atol=0.02)
+        _, _, token_ids = custom.forward(text, return_tokens=True)
+        assert token_ids.shape == (1, n_tokens)
+
+
+def test_rescaled_logits_use_full_logits(custom):
+    # as a model that scales its logits after the LM head (e.g. Cohere)
+    def scale(module, inputs, outputs):
+        outputs['logits'] = outputs['logits'] * 0.5
+        return outputs
+    handle = custom.model.register_forward_hook(scale)
+    try:
+        assert not custom._check_lm_head()
+        custom.plain_lm_head = False
+        for text in TEXTS:
+            np.testing.assert_allclose(custom.nll(text).numpy(), reference_nll(custom, text), rtol=1e-5, atol=1e-5)
+        for text, nlls in zip(TEXTS, custom.forward_batch(TEXTS)):
+            np.testing.assert_allclose(nlls.numpy(), reference_nll(custom, text), rtol=0.02, atol=0.02)
+    finally:
+        handle.remove()
+        custom.plain_lm_head = custom._check_lm_head()
+    assert custom.plain_lm_head
+
+
+def test_forward_batch_matches_single_texts(custom):
+    res = custom.forward_batch(TEXTS)
+    assert len(res) == len(TEXTS)
+    for text, nlls in zip(TEXTS, res):
+        np.testing.assert_allclose(nlls.numpy(), reference_nll(custom, text), rtol=0.02, atol=0.02)
+    assert [len(x) for x in custom.forward_batch(['a', 'b'])] == [0, 0]
@@ -0,0 +1,62 @@
+import random
+import threading
+import time
+import pytest
+from executor import PipelinedExecutor
+
+
+def jitter():
+    time.sleep(random.random() * 0.002)
+
+
+def test_order_and_threads():
+    main = threading.current_thread()
+    seen = {'prepare': set(), 'infer': set(), 'write': set()}
+    written = []
+
+    def prepare(item):
+        seen['prepare'].add(threading.current_thread())
+        jitter()
+        return item * 10
+
+    def infer(item, prepared):
+        seen['infer'].add(threading.current_thread())
+        jitter()
+        return prepared + 1
+
+    def write(item, result):
+        seen['write'].add(threading.current_thread())
+        jitter()
+        written.append((item, result))
+
+    executor = PipelinedExecutor(prepare, infer, write, depth=2, progress=False)
+    stats = executor.run(list(range(50)))
+    assert written == [(i, i * 10 + 1) for i in range(50)]
+    # inference on the calling thread, preparation and writing on two others
+    assert seen['infer'] == {main} and main not in seen['prepare'] | seen['write']
+    assert seen['prepare'] != seen['write']
+    assert set(stats) >= {'wall', 'prepare', 'infer', 'write'}
+    assert 'infer' in executor.report()
+    assert executor.run([]) is executor.stats
+
+
+@pytest.mark.parametrize('stage', ['prepare', 'infer', 'write'])
+def test_errors_propagate(stage):
+    written = []
+
+    def fail(item):
+        if item == 7:
+            raise RuntimeError(f'{stage} failed')
+
+    stages = {
+        'prepare': lambda item: fail(item) if stage == 'prepare' else item,
+        'infer': lambda item, prepared: fail(item) if stage == 'infer' else prepared,
+        'write': lambda item, result: fail(item) if stage == 'write' else written.append(item),
+    }
+    executor = PipelinedExecutor(stages['prepare'], stages['infer'], stages['write'], depth=2, progress=False)
+    n_threads = threading.active_count()
+    with pytest.raises(RuntimeError, match=f'{stage} failed'):
+        executor.run(list(range(100)))
+    # the results computed before the error are written, in order, and nothing after it
+    assert written == list(range(len(written))) and len(written) <= 7
+    assert threading.active_count() == n_threads # the producer and writer threads are joined
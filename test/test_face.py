@@ -0,0 +1,163 @@
+import numpy as np
+import pytest
+import face
+
+scipy = pytest.importorskip('scipy')
+from scipy.stats import pearsonr, spearmanr
+
+
+def aligned(n_pairs=50, n_grid=200, seed=0):
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 0.5, n_grid)
+    y1 = rng.gamma(2.0, 1.0, size=(n_pairs, n_grid))
+    y2 = y1 * rng.uniform(0.5, 1.5, size=(n_pairs, n_grid)) + rng.normal(0, 0.3, size=(n_pairs, n_grid))
+    # ties for the ranks
+    y1[::3, ::4] = 1.0
+    y2[::5, 1::3] = 2.0
+    return x, y1, y2
+
+
+def test_so():
+    x, y1, y2 = aligned()
+    area_floor, area_roof, so = face.computeSO(x, y1, y2)
+    for i in range(len(y1)):
+        floor = np.trapz(np.minimum(np.abs(y1[i]), np.abs(y2[i])), x)
+        roof = np.trapz(np.maximum(np.abs(y1[i]), np.abs(y2[i])), x)
+        np.testing.assert_allclose([area_floor[i], area_roof[i]], [floor, roof])
+        assert so[i] == round(floor / roof, 4)
+
+
+def test_corr_sam_spear():
+    x, y1, y2 = aligned()
+    corr, sam, spear = face.computePearson(x, y1, y2), face.computeSAM(x, y1, y2), face.computeSpearmanr(x, y1, y2)
+    for i in range(len(y1)):
+        np.testing.assert_allclose(corr[i], pearsonr(y1[i], y2[i])[0], rtol=1e-10)
+        cos = y1[i] @ y2[i] / np.linalg.norm(y1[i]) / np.linalg.norm(y2[i])
+        np.testing.assert_allclose(sam[i], np.arccos(cos) / np.pi, rtol=1e-10)
+        np.testing.assert_allclose(spear[i], spearmanr(y1[i], y2[i])[0], rtol=1e-10)
+
+
+def test_non_finite():
+    x, y1, y2 = aligned(n_pairs=3)
+    y1[1, 10] = np.inf # different numbers of finite points: repaired for CORR
+    y1[2, 5] = np.nan # NaN propagates to SPEAR
+    corr = face.computePearson(x, y1, y2)
+    assert np.isfinite(corr[1])
+    assert np.isnan(face.computeSpearmanr(x, y1, y2)[2])
+    # constant rows have no correlation
+    assert np.isnan(face.rowPearson(np.ones((1, 5)), np.arange(5.0)[None]))[0]
+
+
+def random_spectra(lengths, seed=0):
+    rng = np.random.default_rng(seed)
+    freqs = [np.sort(rng.choice(np.linspace(0, 0.6, 1000), size=n, replace=False)) for n in lengths]
+    powers = [rng.gamma(2.0, 1.0, size=n) for n in lengths]
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    return np.concatenate(freqs), np.concatenate(powers), offsets, freqs, powers
+
+
+def test_interpolate_batch_matches_interp1d():
+    from scipy.interpolate import interp1d
+    freq, power, offsets, freqs, powers = random_spectra([2, 3, 17, 64, 5, 300])
+    # the grid extends beyond the frequencies of every sequence at both ends
+    x = np.linspace(-0.1, 0.7, 333)
+    y = face.interpolateBatch(freq, power, offsets, x)
+    assert y.shape == (len(freqs), len(x))
+    for i, (f, p) in enumerate(zip(freqs, powers)):
+        np.testing.assert_allclose(y[i], interp1d(f, p, fill_value='extrapolate')(x), rtol=1e-9, atol=1e-9)
+
+
+def test_interpolate_batch_too_short():
+    freq, power, offsets, _, _ = random_spectra([4, 1, 4])
+    with pytest.raises(ValueError, match='sample 1'):
+        face.interpolateBatch(freq, power, offsets, face.getGrid())
+
+
+def write_spectra(path, freqs, powers):
+    from ragged import spectrum_dtypes, write_ragged
+    if path.endswith('.rag'):
+        write_ragged(path, {'freq': freqs, 'power': powers}, dtype=spectrum_dtypes('float32'))
+    else:
+        import pandas as pd
+        pd.DataFrame({'sid': np.repeat(np.arange(len(freqs)), [len(f) for f in freqs]),
+                      'freq': np.concatenate(freqs), 'power': np.concatenate(powers)}).to_csv(path, index=False)
+
+
+def reference_scores(freqs1, powers1, freqs2, powers2):
+    # the original per-pair implementation: one interpolant per sequence and scipy for each metric
+    from scipy.interpolate import interp1d
+    x = np.linspace(0, 0.5, 1000)
+    scores = {'SO': [], 'CORR': [], 'SAM': [], 'SPEAR': []}
+    for f1, p1, f2, p2 in zip(freqs1, powers1, freqs2, powers2):
+        y1 = interp1d(f1, p1, fill_value='extrapolate')(x)
+        y2 = interp1d(f2, p2, fill_value='extrapolate')(x)
+        floor = np.trapz(np.minimum(np.abs(y1), np.abs(y2)), x)
+        roof = np.trapz(np.maximum(np.abs(y1), np.abs(y2)), x)
+        scores['SO'].append(round(floor / roof, 4))
+        scores['CORR'].append(pearsonr(y1, y2)[0])
+        scores['SAM'].append(np.arccos(y1 @ y2 / np.linalg.norm(y1) / np.linalg.norm(y2)) / np.pi)
+        scores['SPEAR'].append(spearmanr(y1, y2)[0])
+    return scores
+
+
+def test_scores_match_reference(tmp_path):
+    rng = np.random.default_rng(2)
+    *_, freqs1, powers1 = random_spectra(rng.integers(2, 80, size=20), seed=1)
+    *_, freqs2, powers2 = random_spectra(rng.integers(2, 80, size=17), seed=2)
+    for f in freqs1 + freqs2:
+        f[0] = 0 # as every spectrum, so that the sequences of CSV files are delimited by their frequencies
+    human, model = str(tmp_path / 'human.fft.csv'), str(tmp_path / 'model.fft.csv')
+    write_spectra(human, freqs1, powers1)
+    write_spectra(model, freqs2, powers2)
+    expected = reference_scores(freqs1, powers1, freqs2, powers2)
+    scores = face.getScores(human, model)
+    assert list(scores) == ['SO', 'CORR', 'SAM', 'SPEAR']
+    for name, values in scores.items():
+        assert len(values) == 17
+        np.testing.assert_allclose(values, expected[name], rtol=1e-9, atol=1e-12)
+    # any subset, in the requested order, and the file-based wrappers agree
+    assert list(face.getScores(human, model, metrics=['SAM', 'SO'])) == ['SAM', 'SO']
+    np.testing.assert_array_equal(face.getSO(human, model)[2], scores['SO'])
+    np.testing.assert_array_equal(face.getSAM(human, model), scores['SAM'])
+
+
+def test_unknown_metric(tmp_path):
+    with pytest.raises(ValueError):
+        face.getScores('human.fft.csv', 'model.fft.csv', metrics=['SO', 'KL'])
+
+
+@pytest.mark.parametrize('suffix', ['.fft.rag', '.fft.csv'])
+@pytest.mark.parametrize('block_size', [1, 7, 1000])
+def test_chunked_scores_equal_whole_file(tmp_path, suffix, block_size):
+    rng = np.random.default_rng(2)
+    *_, freqs1, powers1 = random_spectra(rng.integers(2, 80, size=40), seed=1)
+    *_, freqs2, powers2 = random_spectra(rng.integers(2, 80, size=37), seed=2)
+    for f in freqs1 + freqs2:
+        f[0] = 0 # as every spectrum, so that the sequences of CSV files are delimited by their frequencies
+    human, model = str(tmp_path / ('human' + suffix)), str(tmp_path / ('model' + suffix))
+    write_spectra(human, freqs1, powers1)
+    write_spectra(model, freqs2, powers2)
+    whole = face.getScores(human, model)
+    blocks = list(face.scoreChunks(human, model, block_size=block_size))
+    for name, values in whole.items():
+        assert len(values) == 37
+        np.testing.assert_array_equal(np.concatenate([block[name] for block in blocks]), values)
+    # several files are concatenated in order
+    whole = face.getScores(face.concatSpectra([human, human]), face.concatSpectra([model, model]))
+    blocks = list(face.scoreChunks([human, human], [model, model], block_size=block_size))
+    for name, values in whole.items():
+        assert len(values) == 74
+        np.testing.assert_array_equal(np.concatenate([block[name] for block in blocks]), values)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 13, 100000])
+def test_read_spectrum_parts(tmp_path, chunk_size):
+    *_, freqs, powers = random_spectra([5, 2, 30, 9], seed=3)
+    for f in freqs:
+        f[0] = 0
+    for suffix in ('.fft.csv', '.fft.rag'):
+        path = str(tmp_path / ('x' + suffix))
+        write_spectra(path, freqs, powers)
+        joined = face.joinSpectra(list(face.readSpectrumParts(path, chunk_size=chunk_size)))
+        for a, b in zip(joined, face.getSpectra(path)):
+            np.testing.assert_array_equal(a, b)
@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+import pytest
+import face
+import leaderboard
+import run_fft
+
+
+def nll_lines(n, seed, min_len=2):
+    rng = np.random.default_rng(seed)
+    return [' '.join(f'{x:.4f}' for x in rng.gamma(2.0, 1.5, size=rng.integers(min_len, 60))) for _ in range(n)]
+
+
+def write_lines(path, lines):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text('\n'.join(lines) + '\n')
+
+
+def to_spectra(nll, output):
+    run_fft.main(run_fft.parser.parse_args(['-i', str(nll), '-o', str(output)]))
+
+
+def test_natural_key():
+    files = ['split.1000.nll', 'split.200.nll', 'split.30.nll']
+    assert sorted(files, key=leaderboard.natural_key) == ['split.30.nll', 'split.200.nll', 'split.1000.nll']
+
+
+def test_scores_match_face(tmp_path):
+    human = {domain: nll_lines(12, seed) for seed, domain in enumerate(['news', 'wiki'])}
+    for domain, lines in human.items():
+        write_lines(tmp_path / 'human' / f'{domain}.nll', lines)
+    models = {}
+    for k, model in enumerate(['opt', 'gpt2']):
+        for j, domain in enumerate(['news', 'wiki']):
+            lines = nll_lines(10, 10 + 2 * k + j)
+            models[(model, domain)] = lines
+            # in natural order, split.2 before split.10
+            write_lines(tmp_path / 'data' / model / f'{domain}_split' / 'split.2.nll', lines[:4])
+            write_lines(tmp_path / 'data' / model / f'{domain}_split' / 'split.10.nll', lines[4:])
+    args = leaderboard.parser.parse_args(['--human', f'news={tmp_path}/human/news.nll', f'wiki={tmp_path}/human/wiki.nll',
+                                          '--data_dir', str(tmp_path / 'data'), '-o', str(tmp_path / 'board.csv')])
+    leaderboard.main(args)
+    board = pd.read_csv(tmp_path / 'board.csv')
+    assert len(board) == 4 * 4
+    for (model, domain), lines in models.items():
+        write_lines(tmp_path / 'expected' / 'model.nll', lines)
+        to_spectra(tmp_path / 'expected' / 'model.nll', tmp_path / 'expected' / 'model.fft.csv')
+        to_spectra(tmp_path / 'human' / f'{domain}.nll', tmp_path / 'expected' / 'human.fft.csv')
+        expected = face.getScores(str(tmp_path / 'expected' / 'human.fft.csv'), str(tmp_path / 'expected' / 'model.fft.csv'))
+        for metric, values in expected.items():
+            row = board[(board.model == model) & (board.domain == domain) & (board.metric == metric)].iloc[0]
+            assert row['n_pairs'] == 10
+            np.testing.assert_allclose(row['mean'], np.mean(values), rtol=1e-6)
+            np.testing.assert_allclose(row['median'], np.median(values), rtol=1e-6)
+
+
+def test_one_point_spectrum_scores_nan(tmp_path):
+    write_lines(tmp_path / 'human.nll', nll_lines(5, 0))
+    lines = nll_lines(5, 1)
+    lines[2] = '1.5000' # one NLL, a spectrum of one point
+    write_lines(tmp_path / 'data' / 'opt' / 'news_split' / 'a.nll', lines)
+    leaderboard.main(leaderboard.parser.parse_args(['--human', str(tmp_path / 'human.nll'), '--data_dir',
+                                                    str(tmp_path / 'data'), '-o', str(tmp_path / 'board.csv')]))
+    board = pd.read_csv(tmp_path / 'board.csv')
+    assert (board['n_pairs'] == 5).all() and (board['count'] == 4).all()
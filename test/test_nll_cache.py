@@ -0,0 +1,69 @@
+import threading
+import time
+import numpy as np
+from nll_cache import NLLCache, write_cached
+
+
+def test_hits_and_misses(tmp_path):
+    cache = NLLCache(str(tmp_path / 'cache.db'), {'model': 'a'})
+    assert cache.get_many(['x', 'y']) == [None, None]
+    cache.put_many(['x'], [np.array([1.0, 2.0])])
+    x, y = cache.get_many(['x', 'y'])
+    np.testing.assert_array_equal(x, [1.0, 2.0])
+    assert y is None
+    assert (cache.hits, cache.misses) == (1, 3)
+    # another fingerprint does not see the entries
+    assert NLLCache(str(tmp_path / 'cache.db'), {'model': 'b'}).get('x') is None
+    cache.close()
+
+
+def test_used_across_threads(tmp_path):
+    # opened on this thread, filled and read by others, as by the writer thread of run_entropy_batch.py
+    cache = NLLCache(str(tmp_path / 'cache.db'), {'model': 'a'}, evict_every=10)
+    errors = []
+
+    def work(k):
+        try:
+            for i in range(20):
+                text = f'{k} {i}'
+                cache.put(text, np.full(i + 1, k, dtype=np.float32))
+                np.testing.assert_array_equal(cache.get(text), np.full(i + 1, k))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(k,)) for k in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert cache.hits == 80
+    assert sum(value is not None for value in cache.get_many([f'{k} {i}' for k in range(4) for i in range(20)])) == 80
+    cache.close()
+
+
+def test_write_cached(tmp_path):
+    from checkpoint import CheckpointedNLLWriter
+    from ragged import read_nll
+    cache = NLLCache(str(tmp_path / 'cache.db'), {'model': 'a'})
+    data = ['x', 'y', 'z']
+    cache.put_many(['x', 'z'], [np.array([1.0, 2.0]), np.array([3.0])])
+    fw = CheckpointedNLLWriter(str(tmp_path / 'out.nll'), range(3))
+    write_cached(cache, fw, data)
+    assert fw.done == {0, 2} # only y is left to compute
+    fw.write(1, [4.0])
+    fw.finalize()
+    assert [x.tolist() for x in read_nll(str(tmp_path / 'out.nll'))] == [[1.0, 2.0], [4.0], [3.0]]
+    cache.close()
+
+
+def test_eviction(tmp_path):
+    cache = NLLCache(str(tmp_path / 'cache.db'), {'model': 'a'}, max_bytes=4 * 100 * 3, evict_every=1000)
+    for i in range(5):
+        cache.put(str(i), np.zeros(100))
+        time.sleep(0.001)
+    cache.get('0') # recently used, kept
+    cache.evict()
+    assert [value is not None for value in cache.get_many([str(i) for i in range(5)])] == \
+        [True, False, False, True, True]
+    cache.close()
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+import face
+from pairing import ExactIndex, IVFIndex, embed_spectra, make_index
+
+
+def clustered(n, dim=64, n_clusters=20, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dim))
+    return embed_spectra(centers[rng.integers(n_clusters, size=n)] + 0.3 * rng.normal(size=(n, dim)))
+
+
+def brute_force(queries, base, k):
+    scores = queries @ base.T
+    ids = np.argsort(-scores, axis=1, kind='stable')[:, :k]
+    return np.take_along_axis(scores, ids, axis=1), ids
+
+
+def test_embed_spectra():
+    vectors = embed_spectra(np.array([[3.0, 4.0], [0.0, 0.0], [np.nan, 2.0]]))
+    np.testing.assert_allclose(vectors, [[0.6, 0.8], [0.0, 0.0], [0.0, 1.0]])
+
+
+@pytest.mark.parametrize('k', [1, 3])
+@pytest.mark.parametrize('block_elements', [1, 500, 1 << 24])
+def test_exact_matches_brute_force(k, block_elements):
+    base, queries = clustered(300), clustered(50, seed=1)
+    scores, ids = ExactIndex(block_elements=block_elements).fit(base).search(queries, k)
+    expected_scores, expected_ids = brute_force(queries, base, k)
+    np.testing.assert_allclose(scores, expected_scores, rtol=1e-5)
+    np.testing.assert_array_equal(ids, expected_ids)
+
+
+@pytest.mark.parametrize('k', [1, 4])
+def test_ivf_probing_all_lists_is_exact(k):
+    base, queries = clustered(300), clustered(50, seed=1)
+    scores, ids = IVFIndex(n_lists=10, n_probe=10, block_elements=700).fit(base).search(queries, k)
+    expected_scores, expected_ids = brute_force(queries, base, k)
+    np.testing.assert_allclose(scores, expected_scores, rtol=1e-5)
+    np.testing.assert_array_equal(ids, expected_ids)
+
+
+def test_ivf_recall():
+    base, queries = clustered(2000), clustered(200, seed=1)
+    _, ids = IVFIndex(n_probe=4).fit(base).search(queries, 1)
+    _, expected = brute_force(queries, base, 1)
+    assert (ids == expected).mean() >= 0.9
+
+
+def test_ivf_short_lists():
+    # one probed list of 2 vectors, 3 neighbours asked for
+    base = embed_spectra(np.array([[1.0, 0.0], [0.9, 0.1], [0.0, 1.0], [0.1, 0.9]]))
+    index = IVFIndex(n_lists=2, n_probe=1, n_iter=5).fit(base)
+    scores, ids = index.search(embed_spectra(np.array([[1.0, 0.05]])), 3)
+    assert sorted(ids[0, :2]) == [0, 1]
+    assert ids[0, 2] == -1 and scores[0, 2] == -np.inf
+
+
+def test_unknown_index():
+    with pytest.raises(ValueError):
+        make_index('hnsw')
+
+
+def test_nearest_pairing_scores():
+    rng = np.random.default_rng(0)
+    freq = np.linspace(0, 0.5, 20)
+    human = [rng.gamma(2.0, 1.0, size=20) for _ in range(8)]
+    # model spectrum i is a rescaled, slightly noisy copy of human spectrum 7 - i
+    model = [2.0 * human[7 - i] * rng.uniform(0.99, 1.01, size=20) for i in range(8)]
+    offsets = np.arange(0, 8 * 20 + 1, 20)
+    human_file = (np.tile(freq, 8), np.concatenate(human), offsets)
+    model_file = (np.tile(freq, 8), np.concatenate(model), offsets)
+    scores = face.getScores(human_file, model_file, metrics=['SAM', 'CORR'], pairing='exact', neighbors=1)
+    assert (scores['SAM'] < 0.01).all()
+    assert (scores['CORR'] > 0.999).all()
+    scores = face.getScores(human_file, model_file, metrics=['SAM'], pairing='ivf', neighbors=2, n_lists=2, n_probe=2)
+    assert len(scores['SAM']) == 16
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+import face
+import pipeline
+import run_entropy_batch
+import run_fft
+from pipeline import FACEPipeline, NLLEstimator, Spectra
+
+HUMAN = ['The quick brown fox jumps over the lazy dog.', 'Hello world, how are you today?',
+         'Spectra of language are computed from the NLLs of each token.', 'a',
+         'A somewhat longer line of text, so that the spectra have more points than the others.']
+MODEL = ['The lazy dog sleeps under the tree.', 'Hello there, I am fine.',
+         'The spectrum of a text is the Fourier transform of its NLLs.', 'One more line.']
+
+
+@pytest.fixture(scope='module')
+def estimator(tiny_gpt2):
+    return NLLEstimator(model_path=tiny_gpt2, max_tokens=64)
+
+
+def file_scores(tmp_path, tiny_gpt2, texts):
+    # the same steps with run_entropy_batch.py, run_fft.py and face.py, through files
+    paths = {}
+    for name, lines in texts.items():
+        source = tmp_path / f'{name}.txt'
+        source.write_text('\n'.join(lines) + '\n')
+        args = run_entropy_batch.create_parser().parse_args(['-i', str(source), '-o', str(tmp_path / f'{name}.nll.rag')])
+        args.model = tiny_gpt2
+        run_entropy_batch.process(*run_entropy_batch.load_model(args), args)
+        paths[name] = str(tmp_path / f'{name}.fft.csv')
+        run_fft.main(run_fft.parser.parse_args(['-i', str(tmp_path / f'{name}.nll.rag'), '-o', paths[name]]))
+    return face.getScores(paths['human'], paths['model'])
+
+
+def test_pipeline_equals_file_steps(tmp_path, tiny_gpt2, estimator):
+    scores = FACEPipeline(estimator).run(MODEL, HUMAN, save_nll=str(tmp_path / 'saved.nll.rag'))
+    expected = file_scores(tmp_path, tiny_gpt2, {'human': HUMAN, 'model': MODEL})
+    assert list(scores) == list(expected)
+    for name in expected:
+        assert len(scores[name]) == len(MODEL)
+        np.testing.assert_allclose(scores[name], expected[name], atol=2e-3)
+    from ragged import read_nll
+    assert len(read_nll(str(tmp_path / 'saved.nll.rag'), keep_empty=True)) == len(MODEL)
+
+
+@pytest.mark.parametrize('suffix', ['.fft.rag', '.fft.csv'])
+def test_spectra_save_and_load(tmp_path, estimator, suffix):
+    pipe = FACEPipeline(estimator)
+    spectra = pipe.spectra(estimator(HUMAN))
+    assert len(spectra) == len(HUMAN) - 1 # the one-token text has no spectrum
+    path = str(tmp_path / ('human' + suffix))
+    spectra.save(path)
+    loaded = Spectra.load(path)
+    np.testing.assert_array_equal(loaded.offsets, spectra.offsets)
+    np.testing.assert_allclose(loaded.on_grid(), spectra.on_grid(), rtol=1e-5, atol=1e-6)
+    # the interpolation is cached
+    assert spectra.on_grid() is spectra.on_grid()
+
+
+def test_main_reuses_human_spectra(tmp_path, tiny_gpt2):
+    for name, lines in (('human', HUMAN), ('model', MODEL)):
+        (tmp_path / f'{name}.txt').write_text('\n'.join(lines) + '\n')
+    first, second = str(tmp_path / 'first.csv'), str(tmp_path / 'second.csv')
+    human_spectra = str(tmp_path / 'human.fft.rag')
+    pipeline.main(pipeline.parser.parse_args(['--human', str(tmp_path / 'human.txt'), '--human_spectra', human_spectra,
+                                              '--model', str(tmp_path / 'model.txt'), '--model_path', tiny_gpt2,
+                                              '-o', first]))
+    pipeline.main(pipeline.parser.parse_args(['--human_spectra', human_spectra, '--model', str(tmp_path / 'model.txt'),
+                                              '--model_path', tiny_gpt2, '-o', second]))
+    import pandas as pd
+    # the saved human spectra are float32
+    np.testing.assert_allclose(pd.read_csv(second).to_numpy(), pd.read_csv(first).to_numpy(), atol=1e-3)
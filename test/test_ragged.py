@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+from ragged import (RaggedWriter, is_ragged, iter_nll, nll_text_to_ragged, open_nll_writer, ragged_to_nll_text,
+                    read_nll, read_ragged, write_ragged)
+
+NLLS = [np.array([1.5, 2.25, 0.125]), np.array([]), np.array([3.0]), np.array([]), np.arange(10) / 4]
+
+
+def write_nll_text(path, nlls):
+    with open_nll_writer(str(path)) as fw:
+        for x in nlls:
+            fw.write(x)
+
+
+@pytest.mark.parametrize('mmap', [True, False])
+@pytest.mark.parametrize('dtype', ['float32', 'float16'])
+def test_round_trip(tmp_path, mmap, dtype):
+    path = str(tmp_path / 'x.rag')
+    write_ragged(path, {'value': NLLS}, dtype=dtype, meta={'kind': 'nll', 'model': 'gpt2'})
+    assert is_ragged(path) and not is_ragged(str(tmp_path / 'missing.rag'))
+    rag = read_ragged(path, mmap=mmap)
+    assert len(rag) == len(NLLS) and rag.meta == {'kind': 'nll', 'model': 'gpt2'}
+    np.testing.assert_array_equal(rag.lengths, [len(x) for x in NLLS])
+    for i, x in enumerate(NLLS):
+        assert rag[i].dtype == np.dtype(dtype)
+        np.testing.assert_array_equal(rag[i], x) # exactly representable values
+
+
+def test_several_fields(tmp_path):
+    path = str(tmp_path / 'x.fft.rag')
+    with RaggedWriter(path, fields=('freq', 'power'), dtype={'freq': 'float32', 'power': 'float16'}) as writer:
+        writer.write([0, 0.25, 0.5], [1, 2, 3])
+        writer.write([0, 0.5], [4, 5])
+    rag = read_ragged(path)
+    assert rag.fields == ('freq', 'power')
+    np.testing.assert_array_equal(rag.field('power'), [1, 2, 3, 4, 5])
+    freqs = rag.split('freq')
+    np.testing.assert_array_equal(freqs[1], [0, 0.5])
+    with pytest.raises(ValueError):
+        RaggedWriter(str(tmp_path / 'y.rag'), fields=('freq', 'power')).write([0, 1])
+
+
+def test_truncated_file(tmp_path):
+    path = tmp_path / 'x.rag'
+    write_ragged(str(path), {'value': NLLS})
+    path.write_bytes(path.read_bytes()[:-4])
+    with pytest.raises(ValueError):
+        read_ragged(str(path))
+
+
+def test_failed_write_leaves_no_file(tmp_path):
+    path = tmp_path / 'x.rag'
+    with pytest.raises(RuntimeError):
+        with RaggedWriter(str(path)) as writer:
+            writer.write([1.0, 2.0])
+            raise RuntimeError('interrupted')
+    assert list(tmp_path.iterdir()) == []
+    # an earlier complete file is kept
+    write_ragged(str(path), {'value': NLLS})
+    with pytest.raises(RuntimeError):
+        with RaggedWriter(str(path)) as writer:
+            raise RuntimeError('interrupted')
+    assert len(read_ragged(str(path))) == len(NLLS)
+    assert [p.name for p in tmp_path.iterdir()] == ['x.rag']
+
+
+def test_empty_sequences_same_in_both_formats(tmp_path):
+    text, rag = tmp_path / 'x.nll', tmp_path / 'x.nll.rag'
+    write_nll_text(text, NLLS)
+    nll_text_to_ragged(str(text), str(rag))
+    non_empty = [x for x in NLLS if len(x) > 0]
+    for path in (text, rag):
+        data = read_nll(str(path))
+        assert len(data) == len(non_empty)
+        for x, y in zip(data, non_empty):
+            np.testing.assert_array_equal(x, y)
+        assert len(read_nll(str(path), N=2)) == 2
+        assert [len(x) for x in read_nll(str(path), keep_empty=True)] == [len(x) for x in NLLS]
+        chunks = list(iter_nll(str(path), chunk_size=2))
+        assert all(len(x) > 0 for chunk in chunks for x in chunk)
+        assert sum(len(chunk) for chunk in chunks) == len(non_empty)
+
+
+def test_text_conversion_keeps_lines(tmp_path):
+    text, rag, back = tmp_path / 'x.nll', tmp_path / 'x.nll.rag', tmp_path / 'y.nll'
+    write_nll_text(text, NLLS)
+    nll_text_to_ragged(str(text), str(rag))
+    assert len(read_ragged(str(rag))) == len(NLLS)
+    ragged_to_nll_text(str(rag), str(back))
+    assert back.read_text() == text.read_text()
+
+
+def test_fft_of_both_formats(tmp_path):
+    from run_fft import FFTProcessor
+    text, rag = tmp_path / 'x.nll', tmp_path / 'x.nll.rag'
+    write_nll_text(text, NLLS)
+    nll_text_to_ragged(str(text), str(rag))
+    processor = FFTProcessor('fft', 'none', 'norm', require_sid=True)
+    from_text, from_rag = processor.process(str(text)), processor.process(str(rag))
+    assert from_text['sid'].nunique() == 3
+    np.testing.assert_allclose(from_rag.to_numpy(), from_text.to_numpy(), atol=1e-6)
+    with pytest.raises(ValueError, match='empty sequence'):
+        processor._fft_batch(NLLS)
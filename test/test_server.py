@@ -0,0 +1,70 @@
+import http.client
+import json
+import threading
+import numpy as np
+import pytest
+
+TEXTS = ['The cat sat on the mat and looked out of the window.', 'A short one.', 'x',
+         'Spectra of the negative log-likelihoods of a text.']
+
+
+@pytest.fixture
+def server(tiny_gpt2, tmp_path):
+    from pipeline import FACEPipeline, NLLEstimator
+    from server import MicroBatcher, ScoringService, make_server
+    # the cache is opened here and used by the batcher thread
+    estimator = NLLEstimator(model_path=tiny_gpt2, cache=str(tmp_path / 'cache.db'))
+    batcher = MicroBatcher(estimator, window=0.01)
+    server = make_server(ScoringService(FACEPipeline(estimator), batcher), port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    batcher.close()
+    estimator.cache.close()
+
+
+def request(server, method, path, body=None):
+    conn = http.client.HTTPConnection(*server.server_address)
+    conn.request(method, path, json.dumps(body) if body is not None else None)
+    response = conn.getresponse()
+    result = response.status, json.loads(response.read())
+    conn.close()
+    return result
+
+
+def test_nll_with_cache(server):
+    estimator = server.service.batcher.estimator
+    status, first = request(server, 'POST', '/nll', {'texts': TEXTS})
+    assert status == 200
+    assert [len(x) for x in first['nll']] == [len(ids) - 1 for ids in estimator.tokenizer(TEXTS)['input_ids']]
+    status, second = request(server, 'POST', '/nll', {'texts': TEXTS})
+    assert status == 200
+    np.testing.assert_allclose(np.concatenate(second['nll']), np.concatenate(first['nll']), rtol=1e-6)
+    assert estimator.cache.hits == len(TEXTS)
+
+
+def test_concurrent_requests(server):
+    results = [None] * 8
+
+    def post(k):
+        results[k] = request(server, 'POST', '/nll', {'texts': TEXTS[k % len(TEXTS):]})
+
+    threads = [threading.Thread(target=post, args=(k,)) for k in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert all(status == 200 for status, _ in results)
+    status, health = request(server, 'GET', '/health')
+    assert status == 200 and health['stats']['requests'] == 8
+
+
+def test_spectra_and_score(server):
+    status, body = request(server, 'POST', '/spectra', {'texts': TEXTS})
+    assert status == 200 and len(body['spectra']) == len(TEXTS)
+    status, body = request(server, 'POST', '/score', {'texts': TEXTS[:2], 'human': TEXTS[2:]})
+    assert status == 200 and set(body['scores']) == {'SO', 'CORR', 'SAM', 'SPEAR'}
+    assert request(server, 'POST', '/score', {'texts': TEXTS})[0] == 400
+    assert request(server, 'POST', '/unknown', {'texts': TEXTS})[0] == 404
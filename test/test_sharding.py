@@ -0,0 +1,48 @@
+import os
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+from ragged import open_nll_writer, read_nll
+from run_entropy import create_parser, merge_shards, process, load_model, process_sharded, shard_path
+
+TEXTS = ['The quick brown fox jumps over the lazy dog.', 'Hello world', 'a', 'Spectra of language',
+         'A somewhat longer line of text.']
+
+
+def test_shard_path():
+    assert shard_path('out.nll.txt', 0, 1) == 'out.nll.txt'
+    assert shard_path('dir/out.nll.txt', 2, 4) == 'dir/out.nll.shard2of4.txt'
+    assert shard_path('out.nll.rag', 1, 3).endswith('.rag')
+
+
+@pytest.mark.parametrize('suffix', ['.nll.txt', '.nll.rag'])
+def test_merge_shards(tmp_path, suffix):
+    output = str(tmp_path / ('out' + suffix))
+    args = create_parser().parse_args(['-i', 'in.txt', '-o', output])
+    nlls = [np.array([float(i), i + 0.5]) if i % 4 else np.array([]) for i in range(7)]
+    for k in range(3):
+        with open_nll_writer(shard_path(output, k, 3)) as fw:
+            for x in nlls[k::3]:
+                fw.write(x)
+    merge_shards(args, 3)
+    assert os.listdir(tmp_path) == [os.path.basename(output)]
+    merged = read_nll(output, keep_empty=True)
+    assert [x.tolist() for x in merged] == [x.tolist() for x in nlls]
+
+
+def test_sharded_equals_single_process(tmp_path, tiny_gpt2, capsys):
+    source = tmp_path / 'in.txt'
+    source.write_text('\n'.join(TEXTS) + '\n')
+    args = create_parser().parse_args(['-i', str(source), '-o', str(tmp_path / 'single.nll'),
+                                       '--model_path', tiny_gpt2])
+    process(*load_model(args), args)
+    args.output, args.workers, args.threads = str(tmp_path / 'sharded.nll'), 2, 1
+    process_sharded(args)
+    single, sharded = read_nll(str(tmp_path / 'single.nll')), read_nll(args.output)
+    assert len(sharded) == len(TEXTS) - 1 # the one-token line has no NLLs
+    for x, y in zip(single, sharded):
+        np.testing.assert_allclose(x, y, atol=2e-4)
+    # a finished output is not recomputed
+    process_sharded(args)
+    assert 'is complete' in capsys.readouterr().out
@@ -0,0 +1,73 @@
+import argparse
+import pytest
+
+torch = pytest.importorskip('torch')
+
+TEXT = 'The quick brown fox jumps over the lazy dog, and then it runs back into the woods. ' * 3
+
+
+@pytest.fixture(scope='module')
+def gpt2(tiny_gpt2):
+    from run_entropy import load_model
+    return load_model(argparse.Namespace(model='gpt2', model_path=tiny_gpt2, backend=None))
+
+
+def full_nll(model, input_ids):
+    log_probs = torch.log_softmax(model(input_ids).logits[0, :-1], dim=-1)
+    return -log_probs.gather(-1, input_ids[0, 1:, None]).squeeze(-1)
+
+
+@pytest.mark.parametrize('n_tokens, window, stride', [(1, 4, 1), (4, 4, 3), (10, 4, 1), (10, 4, 3), (11, 8, 5),
+                                                      (100, 16, 7)])
+def test_windows_score_every_target_once(n_tokens, window, stride):
+    from model import sliding_windows
+    targets = []
+    for begin, end, first in sliding_windows(n_tokens, window, stride):
+        assert 0 <= begin < first <= end <= n_tokens and end - begin <= window
+        targets.extend(range(first, end))
+    assert targets == list(range(1, n_tokens))
+
+
+@pytest.mark.parametrize('stride', [0, 4, 5])
+def test_stride_must_be_smaller_than_window(stride):
+    from model import sliding_windows
+    with pytest.raises(ValueError):
+        list(sliding_windows(10, 4, stride))
+
+
+@torch.no_grad()
+def test_window_nll_equals_full_context_when_it_fits(gpt2):
+    from run_entropy import window_nll
+    model, tokenizer = gpt2
+    input_ids = tokenizer(TEXT, return_tensors='pt')['input_ids']
+    n_tokens = input_ids.shape[1]
+    torch.testing.assert_close(window_nll(model, input_ids, n_tokens, 1), full_nll(model, input_ids))
+    # the targets of the first window see the same context as in one pass over the whole text
+    nlls = window_nll(model, input_ids, 32, 12)
+    assert nlls.shape == (n_tokens - 1,)
+    torch.testing.assert_close(nlls[:31], full_nll(model, input_ids)[:31])
+
+
+@torch.no_grad()
+def test_window_nll_context(gpt2):
+    from run_entropy import window_nll
+    model, tokenizer = gpt2
+    input_ids = tokenizer(TEXT, return_tensors='pt')['input_ids']
+    nlls = window_nll(model, input_ids, 32, 12)
+    # the targets 32..43 of the second window are predicted from tokens 12..43
+    torch.testing.assert_close(nlls[31:43], full_nll(model, input_ids[:, 12:44])[-12:])
+
+
+@torch.no_grad()
+def test_custom_model_windows(tiny_gpt2, gpt2):
+    pytest.importorskip('modelscope')
+    from model import CustomModel
+    from run_entropy import window_nll
+    _, tokenizer = gpt2
+    custom = CustomModel(tiny_gpt2)
+    model = custom.model.to(torch.float32) # loaded as bfloat16
+    input_ids = tokenizer(TEXT, return_tensors='pt')['input_ids']
+    torch.testing.assert_close(custom.nll(TEXT, max_len=1024, stride=8), full_nll(model, input_ids),
+                               rtol=1e-4, atol=1e-4)
+    torch.testing.assert_close(custom.nll(TEXT, max_len=32, stride=8), window_nll(model, input_ids, 32, 8),
+                               rtol=1e-4, atol=1e-4)
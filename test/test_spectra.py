@@ -0,0 +1,137 @@
+import numpy as np
+import pytest
+import run_fft
+from run_fft import METHODS, FFTProcessor
+
+scipy = pytest.importorskip('scipy')
+
+
+def sequences(lengths, seed=0):
+    rng = np.random.default_rng(seed)
+    return [rng.gamma(2.0, 1.5, size=n) for n in lengths]
+
+
+def reference_fft(x, value='norm'):
+    # the original per-sequence implementation
+    from scipy.fft import fft, fftfreq, fftshift
+    freq_x = fftshift(fftfreq(len(x)))
+    fft_res = fftshift(fft(x))
+    sp_x = {'norm': np.abs(fft_res), 'real': fft_res.real, 'imag': fft_res.imag}[value]
+    return freq_x[len(freq_x) // 2:], sp_x[len(sp_x) // 2:]
+
+
+@pytest.mark.parametrize('value', ['norm', 'real', 'imag'])
+def test_fft_matches_reference(value):
+    data = sequences([1, 2, 3, 7, 8, 8, 64, 3, 101])
+    freqs, powers, sids = FFTProcessor('fft', 'none', value, require_sid=True)._fft_batch(data, require_sid=True)
+    for i, x in enumerate(data):
+        f, p = reference_fft(x, value)
+        np.testing.assert_allclose(freqs[i], f)
+        np.testing.assert_allclose(powers[i], p, atol=1e-9)
+        np.testing.assert_array_equal(sids[i], i)
+
+
+@pytest.mark.parametrize('method, reference', [
+    ('periodogram', lambda x: scipy.signal.periodogram(x)),
+    ('welch', lambda x: scipy.signal.welch(x, nperseg=min(16, len(x)), noverlap=min(16, len(x)) // 2)),
+])
+def test_scipy_estimators_per_sequence(method, reference):
+    data = sequences([2, 3, 5, 16, 16, 40, 41, 100])
+    processor = FFTProcessor(method, 'none', 'norm', require_sid=False, nperseg=16, block_elements=32)
+    freqs, powers, _ = processor.compute(data)
+    for i, x in enumerate(data):
+        f, p = reference(x)
+        np.testing.assert_allclose(freqs[i], f)
+        np.testing.assert_allclose(powers[i], p, rtol=1e-10, atol=1e-12)
+
+
+@pytest.mark.parametrize('method', METHODS)
+def test_short_sequences(method):
+    # every length from 1 up, including the lengths below the multitaper bandwidth (2 * nw + 1)
+    data = sequences(range(1, 20))
+    freqs, powers, _ = FFTProcessor(method, 'none', 'norm', require_sid=False).compute(data)
+    for x, f, p in zip(data, freqs, powers):
+        assert len(f) == len(p) > 0
+        assert np.isfinite(p).all() and (f >= 0).all()
+        if method == 'multitaper':
+            np.testing.assert_allclose(f, np.fft.rfftfreq(len(x)))
+
+
+@pytest.mark.parametrize('nw, n_tapers', [(2.5, 0), (4, 7), (1, 1)])
+def test_multitaper(nw, n_tapers):
+    rng = np.random.default_rng(1)
+    x = rng.standard_normal((4, 2048))
+    f, p = FFTProcessor('multitaper', 'none', 'norm', require_sid=False, nw=nw, n_tapers=n_tapers)._multitaper(x)
+    # one-sided density: the power integrates to the variance
+    np.testing.assert_allclose(p.sum(axis=1) * (f[1] - f[0]), (x - x.mean(axis=1, keepdims=True)).var(axis=1),
+                               rtol=0.05)
+    # a constant sequence has no power
+    _, p = FFTProcessor('multitaper', 'none', 'norm', require_sid=False, nw=nw, n_tapers=n_tapers)._multitaper(
+        np.full((1, 64), 3.0))
+    np.testing.assert_allclose(p, 0, atol=1e-20)
+
+
+def test_multitaper_more_tapers_than_points():
+    # --n_tapers above the length of a sequence uses one taper per point
+    processor = FFTProcessor('multitaper', 'none', 'norm', require_sid=False, nw=4, n_tapers=12)
+    x = np.random.default_rng(2).standard_normal((3, 10))
+    _, p = processor._multitaper(x)
+    assert np.isfinite(p).all()
+    freqs, powers, _ = processor.compute(sequences([10, 11, 50]))
+    assert all(np.isfinite(p).all() for p in powers)
+
+
+def reference_preprocess(x, preprocess):
+    # the original per-sequence loop
+    if preprocess in ('log', 'logzs'):
+        x = np.log(x + 1)
+    if preprocess in ('zscore', 'logzs'):
+        x = (x - x.mean()) / (x.std() + 1e-6)
+    if preprocess == 'minmax':
+        x = (x - x.min()) / (x.max() - x.min())
+    return x
+
+
+@pytest.mark.parametrize('preprocess', ['none', 'zscore', 'minmax', 'log', 'logzs'])
+@pytest.mark.parametrize('block_elements', [1, 1 << 11, 1 << 20])
+def test_preprocess(preprocess, block_elements):
+    data = sequences([1 << 10, 3, 17, 1 << 12, 2])
+    processor = FFTProcessor('fft', preprocess, 'norm', require_sid=False)
+    out = processor._preprocess(data, block_elements=block_elements)
+    assert len(out) == len(data)
+    for x, y in zip(data, out):
+        np.testing.assert_allclose(y, reference_preprocess(x, preprocess), rtol=1e-12, atol=1e-12)
+
+
+def test_preprocess_edge_cases():
+    processor = FFTProcessor('fft', 'minmax', 'norm', require_sid=False)
+    # constant sequences map to 0, empty sequences pass through
+    out = processor._preprocess([np.full(5, 2.0), np.array([]), np.array([1.0, 3.0])])
+    np.testing.assert_array_equal(out[0], 0)
+    assert len(out[1]) == 0
+    np.testing.assert_array_equal(out[2], [0, 1])
+    with pytest.raises(ValueError):
+        FFTProcessor('fft', 'rank', 'norm', require_sid=False)._preprocess([np.ones(3)])
+
+
+def test_unknown_method():
+    with pytest.raises(ValueError):
+        FFTProcessor('wavelet', 'none', 'norm', require_sid=False)
+
+
+def test_fft_rejects_empty_sequence():
+    with pytest.raises(ValueError, match='empty sequence'):
+        FFTProcessor('fft', 'none', 'norm', require_sid=False)._fft_batch(sequences([3, 0]))
+
+
+@pytest.mark.parametrize('suffix', ['.fft.txt', '.fft.rag'])
+@pytest.mark.parametrize('chunk_size', [1, 3, 1000])
+def test_streaming_equals_in_memory(tmp_path, suffix, chunk_size):
+    from ragged import write_ragged
+    nll = str(tmp_path / 'x.nll.rag')
+    write_ragged(nll, {'value': sequences([5, 2, 9, 9, 1, 30, 4])})
+    whole, streamed = str(tmp_path / ('whole' + suffix)), str(tmp_path / ('streamed' + suffix))
+    run_fft.main(run_fft.parser.parse_args(['-i', nll, '-o', whole]))
+    run_fft.main(run_fft.parser.parse_args(['-i', nll, '-o', streamed, '--chunk_size', str(chunk_size)]))
+    with open(whole, 'rb') as f1, open(streamed, 'rb') as f2:
+        assert f1.read() == f2.read()
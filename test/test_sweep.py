@@ -0,0 +1,85 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import face
+import sweep
+
+
+def write_nlls(path, n, seed):
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        for _ in range(n):
+            f.write(' '.join(f'{x:.4f}' for x in rng.gamma(2.0, 1.5, size=rng.integers(8, 40))) + '\n')
+
+
+def make_config(tmp_path, domains=('news',)):
+    write_nlls(str(tmp_path / 'human.nll'), 6, 0)
+    for k, domain in enumerate(domains):
+        write_nlls(str(tmp_path / 'opt' / f'{domain}_split' / 'x.split.0.nll'), 3, 1 + k)
+        write_nlls(str(tmp_path / 'opt' / f'{domain}_split' / 'x.split.3.nll'), 3, 11 + k)
+    return {'output_dir': str(tmp_path / 'sweep'), 'domains': list(domains), 'human': str(tmp_path / 'human.nll'),
+            'models': {'opt': str(tmp_path / 'opt' / '{domain}_split' / '*.split.*.nll')},
+            'score': {'args': ['--metrics', 'SO', 'CORR']}}
+
+
+def kinds(graph):
+    return sorted(stage.kind for stage in graph.stages.values())
+
+
+def test_shared_human_spectra_computed_once(tmp_path):
+    config = make_config(tmp_path, domains=('news', 'story', 'wiki'))
+    graph = sweep.SweepGraph(config).build()
+    model_dir = str(tmp_path / 'sweep' / 'opt')
+    human = [stage.output for stage in graph.stages.values()
+             if stage.kind == 'fft' and not stage.output.startswith(model_dir)]
+    assert human == [str(tmp_path / 'sweep' / 'human' / 'human.fft.rag')]
+    assert kinds(graph) == ['fft'] * 7 + ['score'] * 3 + ['summary']
+
+
+def test_same_work_is_one_stage(tmp_path):
+    config = make_config(tmp_path)
+    # a second name for the same files does not compute their spectra again
+    config['models']['opt-copy'] = config['models']['opt']
+    graph = sweep.SweepGraph(config).build()
+    assert kinds(graph) == ['fft'] * 3 + ['score'] * 2 + ['summary']
+
+
+def test_invalid_jobs(tmp_path):
+    config = make_config(tmp_path)
+    with pytest.raises(ValueError):
+        sweep.SweepRunner(sweep.SweepGraph(config).build(), jobs=0)
+    config['fft'] = {'jobs': 0}
+    with pytest.raises(ValueError):
+        sweep.SweepRunner(sweep.SweepGraph(config).build(), jobs=2)
+
+
+def test_incremental_run(tmp_path):
+    config = make_config(tmp_path)
+    assert sweep.SweepRunner(sweep.SweepGraph(config).build(), jobs=2).run() == []
+    summary = pd.read_csv(tmp_path / 'sweep' / 'summary.csv')
+    scores = pd.read_csv(tmp_path / 'sweep' / 'opt' / 'news.scores.csv')
+    assert len(scores) == 6 and list(summary['metric']) == ['SO', 'CORR']
+    np.testing.assert_allclose(summary['mean'], [scores['SO'].mean(), scores['CORR'].mean()])
+    # nothing to do on a rerun
+    assert len(sweep.SweepRunner(sweep.SweepGraph(config).build()).plan()) == 0
+    # a changed split file reruns its spectra, the score and the summary
+    write_nlls(str(tmp_path / 'opt' / 'news_split' / 'x.split.3.nll'), 3, 99)
+    plan = sweep.SweepRunner(sweep.SweepGraph(config).build()).plan()
+    assert [stage.kind for stage in plan] == ['fft', 'score', 'summary']
+    # changing a parameter reruns everything downstream of it
+    config['fft'] = {'args': ['--method', 'periodogram']}
+    assert len(sweep.SweepRunner(sweep.SweepGraph(config).build()).plan()) == 5
+
+
+def test_concat_spectra(tmp_path):
+    rng = np.random.default_rng(0)
+    paths = []
+    for i, n in enumerate([3, 2]):
+        paths.append(str(tmp_path / f'{i}.fft.csv'))
+        freq = np.concatenate([np.linspace(0, 0.5, 10)] * n)
+        pd.DataFrame({'freq': freq, 'power': rng.random(len(freq))}).to_csv(paths[-1], index=False)
+    freq, power, offsets = face.concatSpectra(paths)
+    np.testing.assert_array_equal(offsets, np.arange(0, 51, 10))
+    np.testing.assert_array_equal(power, np.concatenate([face.getSpectra(path)[1] for path in paths]))